@@ -0,0 +1,158 @@
+"""
+Benchmark reading the tile windows of a CGLS LWQ netcdf subdataset one
+tile at a time against streaming the subdataset one row of chunks at a
+time with `read_windows_by_chunk_rows`, on a synthetic netcdf file with
+the layout of the CGLS LWQ files. Streaming decompresses each chunk once,
+while reading one tile at a time decompresses the chunks shared by
+neighbouring tiles again unless they are still in GDAL's block cache or
+the netCDF library's chunk cache, so GDAL's block cache is kept small.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import warnings
+
+import netCDF4
+import numpy as np
+import rasterio
+import rioxarray  # noqa F401
+from odc.geo.xr import assign_crs
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.windows import Window
+
+from water_quality.cgls_lwq.netcdf import (
+    get_netcdf_subdataset_uri,
+    get_netcdf_subdatasets_uris,
+    read_netcdf_url,
+)
+from water_quality.cgls_lwq.tile_windows import (
+    create_tile_window_plan,
+    read_windows_by_chunk_rows,
+)
+from water_quality.cgls_lwq.tiles import get_africa_tiles
+from water_quality.logs import setup_logging
+
+# Suppress the warning
+warnings.filterwarnings("ignore", category=NotGeoreferencedWarning)
+
+# Grid of the synthetic netcdf file, coarser than the 300m product to keep it small
+resolution = 0.02
+chunk_size = (150, 300)
+measurements = {
+    "num_obs": ("i4", 0),
+    "chla_mean": ("f4", 9.96921e36),
+    "turbidity_mean": ("f4", 9.96921e36),
+    "first_obs": ("f4", 9.96921e36),
+    "last_obs": ("f4", 9.96921e36),
+    "trophic_state_index": ("f4", 9.96921e36),
+}
+# Share of the pixels with observations
+valid_fraction = 0.01
+grid_res = 300
+variable = "chla_mean"
+# GDAL block cache size in MB
+gdal_cachemax = 16
+repeats = 3
+
+# Setup logging level
+setup_logging()
+log = logging.getLogger(__name__)
+
+
+def create_synthetic_netcdf(netcdf_path: str):
+    """Write a global netcdf file with sparse valid pixels in each measurement."""
+    rng = np.random.default_rng(0)
+    nlat, nlon = round(180 / resolution), round(360 / resolution)
+    with netCDF4.Dataset(netcdf_path, "w") as nc:
+        nc.title = "Synthetic CGLS LWQ"
+        nc.createDimension("lat", nlat)
+        nc.createDimension("lon", nlon)
+        lat = nc.createVariable("lat", "f8", ("lat",))
+        lat[:] = 90 - resolution / 2 - np.arange(nlat) * resolution
+        lat.units = "degrees_north"
+        lon = nc.createVariable("lon", "f8", ("lon",))
+        lon[:] = -180 + resolution / 2 + np.arange(nlon) * resolution
+        lon.units = "degrees_east"
+        crs = nc.createVariable("crs", "i4")
+        crs.grid_mapping_name = "latitude_longitude"
+        crs.spatial_ref = rasterio.CRS.from_epsg(4326).to_wkt()
+
+        valid = rng.random((nlat, nlon)) < valid_fraction
+        for name, (dtype, fill_value) in measurements.items():
+            variable = nc.createVariable(
+                name, dtype, ("lat", "lon"), fill_value=fill_value, zlib=True, chunksizes=chunk_size
+            )
+            variable.grid_mapping = "crs"
+            variable.long_name = name
+            data = np.full((nlat, nlon), fill_value, dtype=dtype)
+            data[valid] = (rng.random(valid.sum()) * 100).astype(dtype)
+            variable[:] = data
+
+
+def get_source_geobox(netcdf_path: str):
+    subdataset_uri = list(get_netcdf_subdatasets_uris(netcdf_path).values())[0]
+    da = read_netcdf_url(subdataset_uri).squeeze()
+    da = assign_crs(da, da.rio.crs)
+    return da.odc.geobox
+
+
+def count_chunk_reads(windows: list, chunk_shape: tuple[int, int]) -> tuple[int, int]:
+    """Count the chunks overlapped by each window and the distinct chunks overlapped."""
+    chunk_rows, chunk_cols = chunk_shape
+    chunks = []
+    for rows, cols in windows:
+        chunks.extend(
+            (chunk_row, chunk_col)
+            for chunk_row in range(rows.start // chunk_rows, (rows.stop - 1) // chunk_rows + 1)
+            for chunk_col in range(cols.start // chunk_cols, (cols.stop - 1) // chunk_cols + 1)
+        )
+    return len(chunks), len(set(chunks))
+
+
+def read_per_tile(subdataset_uri: str, windows: list) -> int:
+    pixels = 0
+    with rasterio.open(subdataset_uri) as src:
+        for roi in windows:
+            pixels += src.read(1, window=Window.from_slices(*roi)).size
+    return pixels
+
+
+def read_chunk_rows(subdataset_uri: str, windows: list) -> int:
+    pixels = 0
+    with rasterio.open(subdataset_uri) as src:
+        for _, data in read_windows_by_chunk_rows(src, windows):
+            pixels += data.size
+    return pixels
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        netcdf_path = os.path.join(tmp_dir, "c_gls_LWQ300_202503010000_GLOBE_OLCI_V2.0.0.nc")
+        create_synthetic_netcdf(netcdf_path)
+
+        tile_windows = create_tile_window_plan(
+            get_africa_tiles(grid_res), get_source_geobox(netcdf_path), grid_res
+        )["tiles"]
+        windows = [roi for _, roi, _ in tile_windows]
+        with rasterio.open(get_netcdf_subdataset_uri(netcdf_path, variable)) as src:
+            chunk_shape = src.block_shapes[0]
+        chunk_reads, distinct_chunks = count_chunk_reads(windows, chunk_shape)
+        log.info(
+            f"Reading {len(windows)} tiles of {variable} overlapping {chunk_reads} chunks, "
+            f"{distinct_chunks} distinct chunks of {chunk_shape}"
+        )
+
+        with rasterio.Env(GDAL_CACHEMAX=gdal_cachemax):
+            for name, read in [("per tile", read_per_tile), ("chunk rows", read_chunk_rows)]:
+                elapsed = []
+                for repeat in range(repeats):
+                    # GDAL keeps the blocks read from a file cached across datasets
+                    copy_path = os.path.join(tmp_dir, f"{repeat}_{name.replace(' ', '_')}.nc")
+                    shutil.copy(netcdf_path, copy_path)
+                    start = time.perf_counter()
+                    pixels = read(get_netcdf_subdataset_uri(copy_path, variable), windows)
+                    elapsed.append(time.perf_counter() - start)
+                log.info(f"{name}: best of {repeats} {min(elapsed):.2f}s, {pixels} pixels read")
@@ -0,0 +1,221 @@
+"""
+Benchmark single stream vs multi-connection ranged downloads against a
+local HTTP server that limits the throughput of each connection, to
+mimic the per-connection bottleneck of the VITO download server. The
+server sends ETag and Last-Modified validators, so the benchmark also
+covers resuming an interrupted download with an If-Range request and
+skipping an unchanged file with a conditional GET.
+"""
+
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from water_quality.io import (
+    download_file_from_url,
+    download_file_from_url_in_ranges,
+    get_download_checkpoint_paths,
+)
+from water_quality.logs import setup_logging
+
+file_size_mb = 256
+per_connection_mb_per_sec = 32
+connections = 8
+chunks = 8
+
+# Setup logging level
+setup_logging()
+log = logging.getLogger(__name__)
+
+
+class ThrottledRangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serve files with support for single byte range requests, If-Range
+    and conditional GET requests, and a throughput limit per connection."""
+
+    accept_ranges = True
+    bytes_per_sec = per_connection_mb_per_sec * 1024**2
+    # Total number of bytes sent by all connections
+    bytes_sent = 0
+    # Number of bytes after which a response is cut off, None to send whole responses
+    max_bytes_per_response = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def end_headers(self):
+        if self.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def get_validators(self, path: str) -> tuple[str, str]:
+        stat = os.stat(path)
+        return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"', self.date_time_string(stat.st_mtime)
+
+    def send_validators(self, etag: str, last_modified: str):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+
+    def do_HEAD(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_validators(*self.get_validators(path))
+        self.end_headers()
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        etag, last_modified = self.get_validators(path)
+        # If-None-Match takes precedence over If-Modified-Since
+        if_none_match = self.headers.get("If-None-Match")
+        if (if_none_match is not None and if_none_match == etag) or (
+            if_none_match is None and self.headers.get("If-Modified-Since") == last_modified
+        ):
+            self.send_response(304)
+            self.send_validators(etag, last_modified)
+            self.end_headers()
+            return
+
+        total = os.path.getsize(path)
+        start, end = 0, total - 1
+        range_header = self.headers.get("Range")
+        # The range only applies if the file still matches the If-Range validator
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range not in (etag, last_modified):
+            range_header = None
+        # Multiple ranges are not supported, so the whole file is sent instead
+        if self.accept_ranges and range_header and "," not in range_header:
+            match = re.match(r"bytes=(\d+)-(\d*)", range_header)
+            start = int(match.group(1))
+            end = min(int(match.group(2)), total - 1) if match.group(2) else total - 1
+            if start >= total:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{total}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{total}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_validators(etag, last_modified)
+        self.end_headers()
+
+        block_size = 1024**2
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            if self.max_bytes_per_response is not None:
+                remaining = min(remaining, self.max_bytes_per_response)
+                # Drop the connection once the response is cut off
+                self.close_connection = True
+            while remaining > 0:
+                block = f.read(min(block_size, remaining))
+                self.wfile.write(block)
+                remaining -= len(block)
+                type(self).bytes_sent += len(block)
+                time.sleep(len(block) / self.bytes_per_sec)
+
+
+class NoRangeRequestHandler(ThrottledRangeRequestHandler):
+    accept_ranges = False
+
+
+def serve(directory: str, handler) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timed(func, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_dir = os.path.join(tmp_dir, "source")
+        os.makedirs(source_dir)
+        source_file = os.path.join(source_dir, "test.nc")
+        with open(source_file, "wb") as f:
+            f.write(os.urandom(file_size_mb * 1024**2))
+
+        for handler in [ThrottledRangeRequestHandler, NoRangeRequestHandler]:
+            server = serve(source_dir, handler)
+            url = f"http://127.0.0.1:{server.server_address[1]}/test.nc"
+            log.info(f"Serving {file_size_mb} MB with {handler.__name__}")
+
+            single_file = os.path.join(tmp_dir, "single.nc")
+            single_time = timed(download_file_from_url, url, single_file, chunks=chunks)
+
+            ranged_file = os.path.join(tmp_dir, "ranged.nc")
+            ranged_time = timed(
+                download_file_from_url_in_ranges,
+                url,
+                ranged_file,
+                connections=connections,
+                chunks=chunks,
+            )
+
+            with open(single_file, "rb") as f1, open(ranged_file, "rb") as f2:
+                assert f1.read() == f2.read(), "Downloaded files differ"
+
+            log.info(f"Single stream: {single_time:.1f}s")
+            log.info(f"{connections} connections: {ranged_time:.1f}s")
+            log.info(f"Speedup: {single_time / ranged_time:.1f}x")
+
+            if handler.accept_ranges:
+                # Interrupt a download half way, then resume it with an If-Range request
+                resumed_file = os.path.join(tmp_dir, "resumed.nc")
+                handler.max_bytes_per_response = file_size_mb * 1024**2 // 2
+                try:
+                    download_file_from_url(url, resumed_file, chunks=chunks)
+                except Exception as error:
+                    log.info(f"Download interrupted: {error!r}")
+                handler.max_bytes_per_response = None
+                part_file, _ = get_download_checkpoint_paths(resumed_file)
+                assert os.path.exists(part_file), "Interrupted download left no partial file"
+
+                bytes_sent = handler.bytes_sent
+                resume_time = timed(download_file_from_url, url, resumed_file, chunks=chunks)
+                with open(single_file, "rb") as f1, open(resumed_file, "rb") as f2:
+                    assert f1.read() == f2.read(), "Resumed file differs"
+                log.info(
+                    f"Resumed download: {resume_time:.1f}s, "
+                    f"{(handler.bytes_sent - bytes_sent) / 1024**2:.0f} MB sent"
+                )
+
+                # Download again with a ledger, which only sends a conditional GET
+                ledger_path = os.path.join(tmp_dir, "download_ledger.db")
+                download_file_from_url(url, resumed_file, chunks=chunks, ledger_path=ledger_path)
+                bytes_sent = handler.bytes_sent
+                unchanged_time = timed(
+                    download_file_from_url,
+                    url,
+                    resumed_file,
+                    chunks=chunks,
+                    ledger_path=ledger_path,
+                )
+                log.info(
+                    f"Unchanged file: {unchanged_time:.2f}s, "
+                    f"{(handler.bytes_sent - bytes_sent) / 1024**2:.0f} MB sent"
+                )
+                os.remove(resumed_file)
+
+            server.shutdown()
+            os.remove(single_file)
+            os.remove(ranged_file)
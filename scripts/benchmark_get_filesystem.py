@@ -0,0 +1,92 @@
+"""
+Microbenchmark the per-call cost of classifying paths and getting a
+filesystem with `water_quality.io`, against the previous implementation
+which ran `fsspec.core.url_to_fs` for every check and built a new
+filesystem on every call.
+"""
+
+import logging
+import time
+
+import fsspec
+from fsspec.implementations.http import HTTPFileSystem
+from fsspec.implementations.local import LocalFileSystem
+from gcsfs import GCSFileSystem
+from s3fs.core import S3FileSystem
+
+from water_quality.io import get_filesystem, is_local_path, is_s3_path
+from water_quality.logs import setup_logging
+
+calls = 2000
+paths = [
+    "s3://deafrica-input-datasets/cgls_lwq300_2024_nrt/x018/y008/2025/03/01/file.tif",
+    "gs://bucket/cgls_lwq300_2024_nrt/x018/y008/2025/03/01/file.tif",
+    "tmp/cgls_lwq300_2024_nrt/x018/y008/2025/03/01/file.tif",
+]
+
+# Setup logging level
+setup_logging()
+log = logging.getLogger(__name__)
+
+
+def previous_is_s3_path(path: str) -> bool:
+    fs, _ = fsspec.core.url_to_fs(path)
+    return isinstance(fs, S3FileSystem)
+
+
+def previous_is_gcsfs_path(path: str) -> bool:
+    fs, _ = fsspec.core.url_to_fs(path)
+    return isinstance(fs, GCSFileSystem)
+
+
+def previous_is_http_url(path: str) -> bool:
+    fs, _ = fsspec.core.url_to_fs(path)
+    return isinstance(fs, HTTPFileSystem)
+
+
+def previous_is_local_path(path: str) -> bool:
+    fs, _ = fsspec.core.url_to_fs(path)
+    return isinstance(fs, LocalFileSystem)
+
+
+def previous_get_filesystem(path: str, anon: bool = True):
+    if previous_is_s3_path(path=path):
+        fs = S3FileSystem(
+            anon=anon,
+            s3_additional_kwargs={"ACL": "bucket-owner-full-control"},
+        )
+    elif previous_is_gcsfs_path(path=path):
+        if anon:
+            fs = GCSFileSystem(token="anon")
+        else:
+            fs = GCSFileSystem()
+    elif previous_is_http_url(path):
+        fs = HTTPFileSystem()
+    elif previous_is_local_path(path=path):
+        fs = LocalFileSystem()
+    return fs
+
+
+def per_call_us(func, path: str) -> float:
+    # Leave out the one off cost of importing and setting up the filesystem
+    func(path)
+    start = time.perf_counter()
+    for _ in range(calls):
+        func(path)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+if __name__ == "__main__":
+    for path in paths:
+        log.info(path)
+        for name, previous_func, func in [
+            ("is_s3_path", previous_is_s3_path, is_s3_path),
+            ("is_local_path", previous_is_local_path, is_local_path),
+            ("get_filesystem", previous_get_filesystem, get_filesystem),
+        ]:
+            previous_time = per_call_us(previous_func, path)
+            current_time = per_call_us(func, path)
+            log.info(
+                f"  {name}: {previous_time:.1f} us -> {current_time:.1f} us per call "
+                f"({previous_time / current_time:.0f}x)"
+            )
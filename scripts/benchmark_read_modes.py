@@ -0,0 +1,113 @@
+"""
+Benchmark reading tile windows from a CGLS LWQ netcdf file after
+downloading it (--read-mode local) against reading the windows directly
+over HTTP with GDAL /vsicurl/ (--read-mode remote), for a subset of the
+variables and tiles. The file is served by a local HTTP server that
+limits the throughput of each connection, to mimic the VITO download server.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import warnings
+
+import rasterio
+import rioxarray  # noqa F401
+from odc.geo.xr import assign_crs
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.windows import Window
+
+from benchmark_downloads import ThrottledRangeRequestHandler, serve
+from water_quality.cgls_lwq.netcdf import get_netcdf_subdatasets_uris, read_netcdf_url
+from water_quality.cgls_lwq.tile_windows import create_tile_window_plan
+from water_quality.cgls_lwq.tiles import get_africa_tiles
+from water_quality.io import GDAL_VSICURL_CONFIG, download_file_from_url, get_gdal_vsi_prefix
+from water_quality.logs import setup_logging
+
+# Suppress the warning
+warnings.filterwarnings("ignore", category=NotGeoreferencedWarning)
+
+# Local copy of a CGLS LWQ netcdf file to serve
+netcdf_file = "tmp/cgls_lwq300_2024_nrt/netcdfs/c_gls_LWQ300_202503010000_GLOBE_OLCI_V2.0.0.nc"
+grid_res = 300
+per_connection_mb_per_sec = 32
+# Subsets of the variables and tiles to read, None to read all of them
+variables = ["num_obs"]
+max_tiles = 10
+
+# Setup logging level
+setup_logging()
+log = logging.getLogger(__name__)
+
+
+def read_tile_windows(netcdf_path: str, tile_windows: list) -> int:
+    """Read the tile windows of the selected variables and return the number of pixels read."""
+    pixels = 0
+    subdatasets_uris = get_netcdf_subdatasets_uris(netcdf_path)
+    for var, subdataset_uri in subdatasets_uris.items():
+        if variables is not None and var not in variables:
+            continue
+        with rasterio.open(subdataset_uri) as src:
+            for _, roi, _ in tile_windows:
+                pixels += src.read(1, window=Window.from_slices(*roi)).size
+    return pixels
+
+
+def read_local(url: str, tmp_dir: str, tile_windows: list) -> int:
+    output_file_path = os.path.join(tmp_dir, os.path.basename(url))
+    download_file_from_url(url, output_file_path)
+    try:
+        return read_tile_windows(output_file_path, tile_windows)
+    finally:
+        os.remove(output_file_path)
+
+
+def read_remote(url: str, tile_windows: list) -> int:
+    with rasterio.Env(**GDAL_VSICURL_CONFIG):
+        return read_tile_windows(get_gdal_vsi_prefix(url), tile_windows)
+
+
+def get_source_geobox(netcdf_path: str):
+    subdataset_uri = list(get_netcdf_subdatasets_uris(netcdf_path).values())[0]
+    da = read_netcdf_url(subdataset_uri).squeeze()
+    # Same assumption as download_cogs when the crs is missing
+    da = assign_crs(da, da.rio.crs or "EPSG:4326")
+    return da.odc.geobox
+
+
+if __name__ == "__main__":
+    source_geobox = get_source_geobox(netcdf_file)
+    tiles = get_africa_tiles(grid_res)
+    if max_tiles is not None:
+        tiles = tiles[:max_tiles]
+    tile_windows = create_tile_window_plan(tiles, source_geobox, grid_res)["tiles"]
+
+    ThrottledRangeRequestHandler.bytes_per_sec = per_connection_mb_per_sec * 1024**2
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_dir = os.path.join(tmp_dir, "source")
+        os.makedirs(source_dir)
+        shutil.copy(netcdf_file, source_dir)
+        server = serve(source_dir, ThrottledRangeRequestHandler)
+        url = f"http://127.0.0.1:{server.server_address[1]}/{os.path.basename(netcdf_file)}"
+        log.info(
+            f"Reading {len(tile_windows)} tiles of {variables or 'all variables'} "
+            f"from {os.path.getsize(netcdf_file) / 1024**2:.1f} MB"
+        )
+
+        for read_mode in ["local", "remote"]:
+            ThrottledRangeRequestHandler.bytes_sent = 0
+            start = time.perf_counter()
+            if read_mode == "local":
+                pixels = read_local(url, tmp_dir, tile_windows)
+            else:
+                pixels = read_remote(url, tile_windows)
+            elapsed = time.perf_counter() - start
+            log.info(
+                f"{read_mode}: {elapsed:.1f}s, "
+                f"{ThrottledRangeRequestHandler.bytes_sent / 1024**2:.1f} MB transferred, "
+                f"{pixels} pixels read"
+            )
+
+        server.shutdown()
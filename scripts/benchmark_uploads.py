@@ -0,0 +1,74 @@
+"""
+Benchmark uploading tile COGs held in memory to S3 one at a time through
+`fs.open(..., "wb")` against the background uploads used by
+download_cogs for remote cog output directories, for a set of small tile
+COGs and a few large ones.
+
+To run against a local S3 stand-in such as moto or minio, start the
+server, create the bucket and point the AWS SDK at it, e.g.
+    moto_server -p 5555
+    export AWS_ENDPOINT_URL=http://127.0.0.1:5555 AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x
+"""
+
+import logging
+import os
+import time
+
+from water_quality.io import get_filesystem, join_url, upload_files_in_background
+from water_quality.logs import setup_logging
+
+output_dir = "s3://wq-benchmark/uploads"
+small_cogs = 200
+small_cog_mb = 0.5
+large_cogs = 4
+large_cog_mb = 64
+max_in_flight = 16
+
+# Setup logging level
+setup_logging()
+log = logging.getLogger(__name__)
+
+
+def get_files(mode: str) -> list[tuple[str, bytes]]:
+    files = []
+    for i in range(small_cogs):
+        files.append(
+            (join_url(output_dir, mode, f"small_{i}.tif"), os.urandom(int(small_cog_mb * 1024**2)))
+        )
+    for i in range(large_cogs):
+        files.append(
+            (join_url(output_dir, mode, f"large_{i}.tif"), os.urandom(int(large_cog_mb * 1024**2)))
+        )
+    return files
+
+
+def upload_one_at_a_time(files: list[tuple[str, bytes]]):
+    fs = get_filesystem(output_dir, anon=False)
+    for path, data in files:
+        with fs.open(path, "wb") as f:
+            f.write(data)
+
+
+def upload_in_background(files: list[tuple[str, bytes]]):
+    for path, error in upload_files_in_background(iter(files), max_in_flight=max_in_flight):
+        if error is not None:
+            raise error
+
+
+if __name__ == "__main__":
+    fs = get_filesystem(output_dir, anon=False)
+    log.info(
+        f"Uploading {small_cogs} x {small_cog_mb} MB and {large_cogs} x {large_cog_mb} MB "
+        f"files to {output_dir}"
+    )
+    for mode, upload in [
+        ("one_at_a_time", upload_one_at_a_time),
+        ("background", upload_in_background),
+    ]:
+        files = get_files(mode)
+        start = time.perf_counter()
+        upload(files)
+        elapsed = time.perf_counter() - start
+        total_mb = sum(len(data) for _, data in files) / 1024**2
+        log.info(f"{mode}: {elapsed:.1f}s, {total_mb / elapsed:.0f} MB/s")
+        fs.rm(join_url(output_dir, mode), recursive=True)
@@ -10,6 +10,7 @@ from water_quality.cgls_lwq.download_cogs import get_expected_cog_url
 from water_quality.cgls_lwq.netcdf import (
     get_netcdf_urls_from_manifest,
 )
+from water_quality.cgls_lwq.skipped_tiles import read_skipped_tiles_manifests
 from water_quality.cgls_lwq.tiles import (
     get_africa_tiles,
 )
@@ -46,13 +47,19 @@ tiles = get_africa_tiles(grid_res)
 
 measurements = MEASUREMENTS[product_name]
 
+# Tiles with no valid observations are intentionally not written
+skipped_tiles = read_skipped_tiles_manifests(cog_output_dir)
+
 log.info(f"Getting the expected cog files to exist in {cog_output_dir}")
 expected_cogs = []
 for idx, netcdf_url in enumerate(all_netcdf_urls):
     log.info(f"Processing {netcdf_url} {idx + 1}/{len(all_netcdf_urls)}")
+    netcdf_skipped_tiles = skipped_tiles.get(posixpath.basename(netcdf_url), set())
     for measurement_name in measurements:
         for tile in tiles:
             tile_idx, tile_geobox = tile
+            if tile_idx in netcdf_skipped_tiles:
+                continue
             expected_output_cog_url = get_expected_cog_url(
                 output_dir=cog_output_dir,
                 source_netcdf_url=netcdf_url,
@@ -64,9 +71,9 @@ log.info("Done")
 log.info(f"Expecting {len(expected_cogs)} cog files in {cog_output_dir}")
 
 if is_local_path(cog_output_dir):
-    expected_dataset_paths = list(set(os.path.dirname(i) for i in expected_cogs))
+    expected_dataset_paths = set(os.path.dirname(i) for i in expected_cogs)
 else:
-    expected_dataset_paths = list(set(posixpath.dirname(i) for i in expected_cogs))
+    expected_dataset_paths = set(posixpath.dirname(i) for i in expected_cogs)
 log.info(f"Expecting {len(expected_dataset_paths)} datasets in {cog_output_dir}")
 
 log.info(f"Getting the cog files actually in {cog_output_dir}")
@@ -0,0 +1,88 @@
+"""
+Write the product definitions for the CGLS LWQ cogs written with
+`download-cgls-lwq-cogs --pack-measurements` to products/packed/, from the
+product definitions in products/ with the data type, nodata value, scale
+factor and offset of the packed measurements in `PACKED_MEASUREMENTS`.
+
+Packed products are named after the product with the suffix `_packed`, so
+they can be added to the same datacube as the unpacked products.
+"""
+
+import glob
+import logging
+import os
+
+import yaml
+
+from water_quality.cgls_lwq.constants import PACKED_MEASUREMENTS
+from water_quality.logs import setup_logging
+
+products_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "products"))
+output_dir = os.path.join(products_dir, "packed")
+
+PACKED_PRODUCT_SUFFIX = "_packed"
+
+# Setup logging level
+setup_logging()
+log = logging.getLogger(__name__)
+
+
+class ProductDefinitionDumper(yaml.SafeDumper):
+    """Dump yaml in the layout of the hand written product definitions."""
+
+    def increase_indent(self, flow=False, indentless=False):
+        # Indent the items of lists under their key
+        return super().increase_indent(flow, False)
+
+    def represent_str(self, data):
+        # Keep multi line descriptions folded
+        style = ">" if "\n" in data else None
+        return self.represent_scalar("tag:yaml.org,2002:str", data, style=style)
+
+
+ProductDefinitionDumper.add_representer(str, ProductDefinitionDumper.represent_str)
+
+
+def get_packed_product_definition(product_definition: dict) -> dict:
+    """
+    Rename the product and set the data type, nodata value, scale factor
+    and offset of the packed measurements.
+    """
+    measurements = []
+    for measurement in product_definition["measurements"]:
+        packing = PACKED_MEASUREMENTS.get(measurement["name"])
+        if packing is not None:
+            measurement = dict(
+                measurement,
+                dtype=packing["dtype"],
+                nodata=packing["nodata"],
+                scale_factor=packing["scale_factor"],
+                add_offset=packing["add_offset"],
+            )
+        measurements.append(measurement)
+    name = product_definition["name"] + PACKED_PRODUCT_SUFFIX
+    metadata = dict(product_definition["metadata"])
+    metadata["product"] = dict(metadata["product"], name=name)
+    return dict(product_definition, name=name, metadata=metadata, measurements=measurements)
+
+
+if __name__ == "__main__":
+    os.makedirs(output_dir, exist_ok=True)
+    for product_yaml in sorted(glob.glob(os.path.join(products_dir, "*.odc-product.yaml"))):
+        with open(product_yaml) as f:
+            product_definition = yaml.safe_load(f)
+
+        packed_product_definition = get_packed_product_definition(product_definition)
+        output_yaml = os.path.join(
+            output_dir, f"{packed_product_definition['name']}.odc-product.yaml"
+        )
+        with open(output_yaml, "w") as f:
+            yaml.dump(
+                packed_product_definition,
+                f,
+                Dumper=ProductDefinitionDumper,
+                sort_keys=False,
+                allow_unicode=True,
+                explicit_start=True,
+            )
+        log.info(f"Written {output_yaml}")
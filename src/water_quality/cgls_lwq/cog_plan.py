@@ -0,0 +1,115 @@
+"""
+Read and write plans of the COGs still missing for a
+Copernicus Global Land Service - Lake Water Quality product, so a rerun
+only processes the netcdf files, measurements and tiles that need work.
+"""
+
+import json
+import logging
+from datetime import datetime, timezone
+
+from water_quality.cgls_lwq.tiles import get_tile_index_int_tuple, get_tile_index_str
+from water_quality.io import create_parent_directory, get_filesystem, join_url
+
+log = logging.getLogger(__name__)
+
+
+def get_cog_plan_url(output_dir: str) -> str:
+    """
+    Get the default file path of the COG plan for a product.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory the product's COG files are written to.
+
+    Returns
+    -------
+    str
+        File path of the COG plan.
+    """
+    return join_url(output_dir, "cog_plan.txt")
+
+
+def write_cog_plan(
+    plan_url: str,
+    product_name: str,
+    output_dir: str,
+    missing_cogs: dict[str, dict[str, list[tuple[int, int]]]],
+    skipped_tiles: dict[str, set[tuple[int, int]]],
+):
+    """
+    Write the COGs missing for each netcdf file as compact JSON, with the
+    tiles skipped for the netcdf file so they stay recorded as skipped.
+
+    Parameters
+    ----------
+    plan_url : str
+        File path to write the COG plan to.
+    product_name : str
+        Name of the product the COGs are for.
+    output_dir : str
+        Directory the product's COG files are written to.
+    missing_cogs : dict[str, dict[str, list[tuple[int, int]]]]
+        Indices of the missing tiles for each measurement of each netcdf url.
+    skipped_tiles : dict[str, set[tuple[int, int]]]
+        Indices of the tiles skipped for each netcdf url with missing COGs.
+    """
+    netcdfs = {}
+    for netcdf_url, measurements in missing_cogs.items():
+        netcdf_plan = dict(
+            missing={
+                measurement_name: sorted(get_tile_index_str(i) for i in tile_indices)
+                for measurement_name, tile_indices in measurements.items()
+            }
+        )
+        if skipped_tiles.get(netcdf_url):
+            netcdf_plan["skipped"] = sorted(
+                get_tile_index_str(i) for i in skipped_tiles[netcdf_url]
+            )
+        netcdfs[netcdf_url] = netcdf_plan
+
+    plan_doc = dict(
+        product_name=product_name,
+        cog_output_dir=output_dir,
+        created=datetime.now(timezone.utc).isoformat(),
+        netcdfs=netcdfs,
+    )
+
+    create_parent_directory(plan_url)
+    fs = get_filesystem(plan_url, anon=False)
+    with fs.open(plan_url, "w") as f:
+        json.dump(plan_doc, f, separators=(",", ":"))
+
+
+def read_cog_plan(plan_url: str) -> dict:
+    """
+    Read a COG plan written by `write_cog_plan`.
+
+    Parameters
+    ----------
+    plan_url : str
+        File path of the COG plan.
+
+    Returns
+    -------
+    dict
+        COG plan containing the product name, the cog output directory and,
+        for each netcdf url, the indices of the missing tiles for each
+        measurement under "missing" and of the skipped tiles under "skipped".
+    """
+    fs = get_filesystem(plan_url, anon=True)
+    with fs.open(plan_url, "r") as f:
+        plan_doc = json.load(f)
+
+    netcdfs = {}
+    for netcdf_url, netcdf_plan in plan_doc["netcdfs"].items():
+        netcdfs[netcdf_url] = dict(
+            missing={
+                measurement_name: {get_tile_index_int_tuple(i) for i in tile_indices}
+                for measurement_name, tile_indices in netcdf_plan["missing"].items()
+            },
+            skipped={get_tile_index_int_tuple(i) for i in netcdf_plan.get("skipped", [])},
+        )
+    plan_doc["netcdfs"] = netcdfs
+    return plan_doc
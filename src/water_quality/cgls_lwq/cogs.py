@@ -0,0 +1,674 @@
+"""
+Write Cloud Optimized Geotiffs for tiles cropped from the
+Copernicus Global Land Service - Lake Water Quality NetCDF subdatasets.
+"""
+
+import itertools
+import logging
+import math
+import posixpath
+import re
+from collections import deque
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import dask
+import numpy as np
+import xarray as xr
+from odc.geo.xr import mask
+from rasterio.io import DatasetReader
+
+from water_quality.cgls_lwq.constants import PACKED_MEASUREMENTS
+from water_quality.cgls_lwq.skipped_tiles import is_empty_tile
+from water_quality.cgls_lwq.tile_windows import (
+    read_windows_by_chunk_rows,
+    split_windows_into_strips,
+)
+from water_quality.io import (
+    check_file_exists,
+    create_file_exclusively,
+    get_filesystem,
+    is_local_path,
+    join_url,
+    upload_file_from_bytes,
+)
+
+log = logging.getLogger(__name__)
+
+# Target size in bytes of the chunks of the dask array of a netcdf subdataset
+DASK_CHUNK_SIZE = 64 * 1024**2
+
+# Rows of tiles held in shared memory at once by `write_tile_cogs_in_pool`,
+# so the next row is read while the workers write the tiles of the previous one
+POOL_ROWS_IN_FLIGHT = 2
+
+
+def get_cog_encoding_url(output_dir: str) -> str:
+    """Get the file path of the record of how the cogs in a cog output directory are encoded."""
+    # Not .json, as the stac files under the output directory are indexed with **/*.json
+    return join_url(output_dir, "cog_encoding.txt")
+
+
+def get_cog_output_encoding(output_dir: str, encoding: str) -> str:
+    """
+    Get how the cogs in a cog output directory are encoded, recording
+    `encoding` for a new output directory. Cogs written before the
+    encoding was recorded are unpacked.
+
+    Packed and unpacked cogs of a measurement get the same file paths and
+    are indexed with different product definitions, so a cog output
+    directory must only hold cogs with one encoding.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory the COG files are written to.
+    encoding : str
+        Encoding of the cogs to write, "packed" or "unpacked".
+
+    Returns
+    -------
+    str
+        Encoding of the cogs in the output directory.
+    """
+    encoding_url = get_cog_encoding_url(output_dir)
+    if not check_file_exists(encoding_url):
+        fs = get_filesystem(output_dir, anon=True)
+        try:
+            dir_names = [posixpath.basename(i.rstrip("/")) for i in fs.ls(output_dir, detail=False)]
+        except FileNotFoundError:
+            dir_names = []
+        if any(re.match(r"^x\d{3}$", i) for i in dir_names):
+            return "unpacked"
+        if create_file_exclusively(encoding_url, encoding.encode()):
+            return encoding
+
+    fs = get_filesystem(encoding_url, anon=False)
+    fs.invalidate_cache(encoding_url)
+    return fs.cat_file(encoding_url).decode().strip()
+
+
+def get_measurement_packing(
+    measurement: str, da: xr.DataArray, nodata: float | None
+) -> dict | None:
+    """
+    Get the scaled integer encoding to write the COGs of a measurement with.
+
+    Parameters
+    ----------
+    measurement : str
+        Name of the netcdf subdataset.
+    da : xr.DataArray
+        Lazily loaded netcdf subdataset, to take the data type and the
+        `scale_factor` and `add_offset` of the stored values from.
+    nodata : float | None
+        Nodata value of the netcdf subdataset.
+
+    Returns
+    -------
+    dict | None
+        Packed data type, scale factor, offset and nodata value from
+        `PACKED_MEASUREMENTS`, plus the nodata value, scale factor and
+        offset of the source values, or None if the measurement is not
+        packed.
+    """
+    packing = PACKED_MEASUREMENTS.get(measurement)
+    if packing is None:
+        return None
+
+    if not np.issubdtype(da.dtype, np.floating):
+        log.warning(f"{measurement} is stored as {da.dtype}, writing its cogs unpacked")
+        return None
+
+    return dict(
+        packing,
+        source_nodata=nodata,
+        source_scale_factor=float(da.attrs.get("scale_factor", 1.0)),
+        source_add_offset=float(da.attrs.get("add_offset", 0.0)),
+    )
+
+
+def pack_tile(cropped_da: xr.DataArray, tags: dict, packing: dict) -> tuple[xr.DataArray, dict]:
+    """
+    Encode a netcdf subdataset cropped to a tile as scaled integers.
+
+    Values outside the range of the packed data type are clipped to it.
+
+    Parameters
+    ----------
+    cropped_da : xr.DataArray
+        Netcdf subdataset cropped and masked to the tile extent.
+    tags : dict
+        Tags to write to the COG.
+    packing : dict
+        Scaled integer encoding of the measurement, from `get_measurement_packing`.
+
+    Returns
+    -------
+    tuple[xr.DataArray, dict]
+        Packed tile, with the scale factor and offset to set as the band
+        scale and offset, and the tags with the scale factor, offset and
+        nodata value of the packed values.
+    """
+    data = cropped_da.values
+    valid = ~np.isnan(data)
+    source_nodata = packing["source_nodata"]
+    if source_nodata is not None and not np.isnan(source_nodata):
+        valid &= data != source_nodata
+
+    values = data.astype(np.float64) * packing["source_scale_factor"] + packing["source_add_offset"]
+    packed = np.round((values - packing["add_offset"]) / packing["scale_factor"])
+
+    dtype_info = np.iinfo(packing["dtype"])
+    nodata = packing["nodata"]
+    if nodata == dtype_info.min:
+        min_value, max_value = dtype_info.min + 1, dtype_info.max
+    else:
+        min_value, max_value = dtype_info.min, dtype_info.max - 1
+    num_clipped = np.count_nonzero(valid & ((packed < min_value) | (packed > max_value)))
+    if num_clipped:
+        log.warning(
+            f"Clipped {num_clipped} {cropped_da.name} values outside the range of "
+            f"{packing['dtype']} scaled by {packing['scale_factor']}"
+        )
+
+    packed = np.where(valid, np.clip(packed, min_value, max_value), nodata)
+    packed_da = cropped_da.copy(data=packed.astype(packing["dtype"]))
+    packed_da.attrs.update(
+        _FillValue=nodata,
+        scale_factor=packing["scale_factor"],
+        add_offset=packing["add_offset"],
+        # Written by odc.write_cog as the band scale and offset, read by GDAL
+        scales=packing["scale_factor"],
+        offsets=packing["add_offset"],
+    )
+    packed_tags = dict(
+        tags,
+        _FillValue=nodata,
+        scale_factor=packing["scale_factor"],
+        add_offset=packing["add_offset"],
+    )
+    return packed_da, packed_tags
+
+
+def write_tile_cog(
+    cropped_da: xr.DataArray, output_cog_url: str, tags: dict, packing: dict | None = None
+):
+    """
+    Write a netcdf subdataset cropped to a tile as a COG.
+
+    Parameters
+    ----------
+    cropped_da : xr.DataArray
+        Netcdf subdataset cropped and masked to the tile extent.
+    output_cog_url : str
+        File path to write the COG to.
+    tags : dict
+        Tags to write to the COG.
+    packing : dict | None, optional
+        Scaled integer encoding to write the COG with, from
+        `get_measurement_packing`, by default None to write the values as read.
+    """
+    if packing is not None:
+        cropped_da, tags = pack_tile(cropped_da, tags, packing)
+
+    if is_local_path(output_cog_url):
+        cropped_da.odc.write_cog(
+            fname=output_cog_url,
+            overwrite=True,
+            tags=tags,
+        )
+    else:
+        cog_bytes = cropped_da.odc.write_cog(fname=":mem:", overwrite=True, tags=tags)
+        upload_file_from_bytes(output_cog_url, cog_bytes)
+
+
+def encode_tile_cogs(
+    tile_reads: Iterable[tuple[tuple, xr.DataArray]],
+    nodata: float | None,
+    tags: dict,
+    check_empty: bool,
+    empty_tiles: set,
+    packing: dict | None = None,
+):
+    """
+    Encode the tile COGs of a netcdf subdataset in memory, for uploading
+    with `upload_files_in_background`.
+
+    Parameters
+    ----------
+    tile_reads : Iterable[tuple[tuple, xr.DataArray]]
+        Tile index, source window, tile extent and output COG file path
+        of each tile to write, with the netcdf subdataset cropped to the
+        tile, from `read_tile_windows`.
+    nodata : float | None
+        Nodata value of the netcdf subdataset.
+    tags : dict
+        Tags to write to the COGs.
+    check_empty : bool
+        If True, tiles with no valid pixels are not encoded.
+    empty_tiles : set
+        Set to add the indices of the tiles with no valid pixels to.
+    packing : dict | None, optional
+        Scaled integer encoding to write the COGs with, from
+        `get_measurement_packing`, by default None to write the values as read.
+
+    Yields
+    ------
+    tuple[str, bytes]
+        Output COG file path and COG bytes for each tile not skipped.
+    """
+    for (tile_idx, _, _, output_cog_url), cropped_da in tile_reads:
+        if check_empty and is_empty_tile(cropped_da, nodata):
+            empty_tiles.add(tile_idx)
+            continue
+
+        cog_tags = tags
+        if packing is not None:
+            cropped_da, cog_tags = pack_tile(cropped_da, tags, packing)
+        yield (
+            output_cog_url,
+            cropped_da.odc.write_cog(fname=":mem:", overwrite=True, tags=cog_tags),
+        )
+
+
+def _read_tile_from_shared_memory(shm: SharedMemory, task: dict) -> xr.DataArray:
+    """Crop and mask a tile from a band of a netcdf subdataset held in shared memory."""
+    band = np.ndarray(task["shape"], dtype=task["dtype"], buffer=shm.buf)
+    row_offset, col_offset = task["origin"]
+    rows, cols = task["roi"]
+    data = band[
+        rows.start - row_offset : rows.stop - row_offset,
+        cols.start - col_offset : cols.stop - col_offset,
+    ]
+
+    cropped_da = xr.DataArray(
+        data,
+        coords=task["coords"].coords,
+        dims=task["dims"],
+        name=task["name"],
+        attrs=task["attrs"],
+    )
+    cropped_da.encoding = task["encoding"]
+    # Masking copies the data out of shared memory
+    cropped_da = mask(cropped_da, task["tile_extent"], all_touched=True)
+    return cropped_da
+
+
+def write_tile_cog_from_shared_memory(task: dict) -> tuple[str, str | None]:
+    """
+    Crop a tile from a band of a netcdf subdataset held in shared memory
+    and write it as a COG. Runs in a worker process.
+
+    Parameters
+    ----------
+    task : dict
+        Shared memory block name, band shape, dtype and origin on the
+        source grid, plus the tile window, coordinates, attributes and
+        output file path needed to write the tile COG.
+
+    Returns
+    -------
+    tuple[str, str | None]
+        Status of the tile, one of "written", "empty" or "failed", and
+        the error message if the tile failed.
+    """
+    try:
+        shm = SharedMemory(name=task["shm_name"])
+        try:
+            cropped_da = _read_tile_from_shared_memory(shm, task)
+        finally:
+            shm.close()
+
+        if task["check_empty"] and is_empty_tile(cropped_da, task["nodata"]):
+            return "empty", None
+
+        write_tile_cog(cropped_da, task["output_cog_url"], task["attrs"], task["packing"])
+    except Exception as error:
+        return "failed", repr(error)
+    return "written", None
+
+
+def write_tile_cogs_in_pool(
+    executor: ProcessPoolExecutor,
+    src: DatasetReader,
+    da: xr.DataArray,
+    tile_tasks: list[tuple],
+    check_empty: bool,
+    memory_budget: int | None = None,
+    packing: dict | None = None,
+):
+    """
+    Crop a netcdf subdataset to tiles and write the tile COGs using a
+    pool of worker processes.
+
+    The subdataset is read one row of tiles at a time into shared memory
+    which the workers crop their tiles from, so the source array is never
+    pickled. The rows of tiles are read with `read_windows_by_chunk_rows`,
+    so the chunks shared by neighbouring rows of tiles are decompressed once.
+    The next row of tiles is read while the workers write the tiles of the
+    previous rows, with up to `POOL_ROWS_IN_FLIGHT` rows in shared memory.
+
+    Parameters
+    ----------
+    executor : ProcessPoolExecutor
+        Pool of worker processes to encode and write the tile COGs.
+    src : DatasetReader
+        Open rasterio dataset for the netcdf subdataset.
+    da : xr.DataArray
+        Lazily loaded netcdf subdataset to take the coordinates and
+        attributes of the cropped arrays from.
+    tile_tasks : list[tuple]
+        Tile index, source window, tile extent and output COG file path
+        for each tile to write.
+    check_empty : bool
+        If True, tiles with no valid pixels are not written.
+    memory_budget : int | None, optional
+        Maximum number of bytes of source pixels to hold while reading. If
+        set, the tiles are read in strips of columns of tiles, see
+        `split_windows_into_strips`, and each row of tiles of a strip is
+        read into shared memory separately. The rows in shared memory come
+        on top of the budget. By default None for no limit.
+    packing : dict | None, optional
+        Scaled integer encoding to write the COGs with, from
+        `get_measurement_packing`, by default None to write the values as read.
+
+    Yields
+    ------
+    tuple[str, str | None]
+        Status and error message for each tile, in the order of `tile_tasks`.
+    """
+    y_dim, x_dim = da.odc.spatial_dims
+
+    if memory_budget is None:
+        strips = [list(range(len(tile_tasks)))]
+    else:
+        strips = split_windows_into_strips(
+            [task[1] for task in tile_tasks],
+            src.block_shapes[0],
+            np.dtype(src.dtypes[0]).itemsize,
+            memory_budget,
+        )
+
+    # Tile indices are (x, y), group the tiles in each row of tiles of each strip
+    tile_rows = []
+    strip_rows = []
+    for strip in strips:
+        row_groups = itertools.groupby(
+            sorted(((i, tile_tasks[i]) for i in strip), key=lambda i: i[1][0][1]),
+            key=lambda i: i[1][0][1],
+        )
+        first_row = len(tile_rows)
+        tile_rows.extend(list(row_tasks) for _, row_tasks in row_groups)
+        strip_rows.append(range(first_row, len(tile_rows)))
+    row_windows = []
+    for row_tasks in tile_rows:
+        rois = [task[1] for _, task in row_tasks]
+        row_windows.append(
+            (
+                slice(min(roi[0].start for roi in rois), max(roi[0].stop for roi in rois)),
+                slice(min(roi[1].start for roi in rois), max(roi[1].stop for roi in rois)),
+            )
+        )
+
+    def read_rows():
+        # Read the strips one after the other
+        for rows in strip_rows:
+            for i, row_data in read_windows_by_chunk_rows(src, [row_windows[j] for j in rows]):
+                yield rows[i], row_data
+
+    # Rows of tiles being written, with their shared memory and the futures of their tiles
+    rows_in_flight = deque()
+
+    def collect_row(results: dict):
+        row_tasks, shm, futures = rows_in_flight.popleft()
+        try:
+            for (task_idx, _), future in zip(row_tasks, futures):
+                results[task_idx] = future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    results = {}
+    next_result = 0
+    try:
+        for row_idx, row_data in read_rows():
+            row_tasks = tile_rows[row_idx]
+            row_start, col_start = row_windows[row_idx][0].start, row_windows[row_idx][1].start
+
+            shape = row_data.shape
+            dtype = row_data.dtype
+            shm = SharedMemory(create=True, size=max(row_data.nbytes, 1))
+            try:
+                band = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                band[...] = row_data
+                del band, row_data
+
+                futures = []
+                for _, (tile_idx, roi, tile_extent, output_cog_url) in row_tasks:
+                    cropped_template = da.isel({y_dim: roi[0], x_dim: roi[1]})
+                    task = dict(
+                        shm_name=shm.name,
+                        shape=shape,
+                        dtype=dtype.str,
+                        origin=(row_start, col_start),
+                        roi=roi,
+                        tile_extent=tile_extent,
+                        coords=cropped_template.coords.to_dataset(),
+                        dims=cropped_template.dims,
+                        name=cropped_template.name,
+                        attrs=cropped_template.attrs,
+                        encoding=cropped_template.encoding,
+                        nodata=src.nodata,
+                        check_empty=check_empty,
+                        packing=packing,
+                        output_cog_url=output_cog_url,
+                    )
+                    futures.append(executor.submit(write_tile_cog_from_shared_memory, task))
+            except BaseException:
+                shm.close()
+                shm.unlink()
+                raise
+            rows_in_flight.append((row_tasks, shm, futures))
+
+            # Wait for the oldest rows before reading the next one
+            while len(rows_in_flight) >= POOL_ROWS_IN_FLIGHT:
+                collect_row(results)
+
+            # Hand back results in order as soon as they are available
+            while next_result in results:
+                yield results.pop(next_result)
+                next_result += 1
+
+        while rows_in_flight:
+            collect_row(results)
+        while next_result in results:
+            yield results.pop(next_result)
+            next_result += 1
+    finally:
+        # Free the shared memory of the rows left when stopped early
+        for _, shm, futures in rows_in_flight:
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                if not future.cancelled():
+                    future.exception()
+            shm.close()
+            shm.unlink()
+
+
+def get_dask_chunks(
+    chunk_shape: tuple[int, int], itemsize: int, chunk_size: int = DASK_CHUNK_SIZE
+) -> tuple[int, int]:
+    """
+    Get the shape of the dask chunks of a netcdf subdataset, a whole number
+    of netcdf chunks along each dimension so each netcdf chunk is
+    decompressed by a single dask chunk.
+
+    Parameters
+    ----------
+    chunk_shape : tuple[int, int]
+        Rows and columns of the netcdf chunks of the subdataset.
+    itemsize : int
+        Number of bytes per pixel.
+    chunk_size : int, optional
+        Target size in bytes of the dask chunks, by default DASK_CHUNK_SIZE
+
+    Returns
+    -------
+    tuple[int, int]
+        Rows and columns of the dask chunks.
+    """
+    chunk_rows, chunk_cols = chunk_shape
+    factor = max(1, math.isqrt(chunk_size // (chunk_rows * chunk_cols * itemsize)))
+    return chunk_rows * factor, chunk_cols * factor
+
+
+def encode_tile_cog(
+    cropped_da: xr.DataArray,
+    tile_extent,
+    tags: dict,
+    nodata: float | None,
+    check_empty: bool,
+    packing: dict | None = None,
+) -> tuple[str, bytes | str | None]:
+    """
+    Mask a netcdf subdataset cropped to a tile window and encode it as a
+    COG in memory. Runs as a dask task.
+
+    Parameters
+    ----------
+    cropped_da : xr.DataArray
+        Netcdf subdataset cropped to the tile window.
+    tile_extent : Geometry
+        Tile extent in the source crs, used to mask pixels outside the tile.
+    tags : dict
+        Tags to write to the COG.
+    nodata : float | None
+        Nodata value of the netcdf subdataset.
+    check_empty : bool
+        If True, tiles with no valid pixels are not encoded.
+    packing : dict | None, optional
+        Scaled integer encoding to write the COG with, from
+        `get_measurement_packing`, by default None to write the values as read.
+
+    Returns
+    -------
+    tuple[str, bytes | str | None]
+        Status of the tile, one of "encoded", "empty" or "failed", and the
+        COG bytes if the tile was encoded or the error message if it failed.
+    """
+    try:
+        # Mask pixels outside the tile the same way `crop_tile_window` does
+        cropped_da = mask(cropped_da, tile_extent, all_touched=True)
+        if check_empty and is_empty_tile(cropped_da, nodata):
+            return "empty", None
+
+        if packing is not None:
+            cropped_da, tags = pack_tile(cropped_da, tags, packing)
+        cog_bytes = cropped_da.odc.write_cog(fname=":mem:", overwrite=True, tags=tags)
+    except Exception as error:
+        return "failed", repr(error)
+    return "encoded", cog_bytes
+
+
+def upload_tile_cog(encoded: tuple[str, bytes | str | None], output_cog_url: str):
+    """
+    Write a tile COG encoded by `encode_tile_cog`. Runs as a dask task.
+
+    Parameters
+    ----------
+    encoded : tuple[str, bytes | str | None]
+        Status of the tile and COG bytes, from `encode_tile_cog`.
+    output_cog_url : str
+        File path to write the COG to.
+
+    Returns
+    -------
+    tuple[str, str | None]
+        Status of the tile, one of "written", "empty" or "failed", and
+        the error message if the tile failed.
+    """
+    status, cog_bytes = encoded
+    if status != "encoded":
+        return status, cog_bytes
+
+    try:
+        upload_file_from_bytes(output_cog_url, cog_bytes)
+    except Exception as error:
+        return "failed", repr(error)
+    return "written", None
+
+
+def write_tile_cogs_with_dask(
+    src: DatasetReader,
+    da: xr.DataArray,
+    tile_tasks: list[tuple],
+    check_empty: bool,
+    scheduler="threads",
+    num_workers: int | None = None,
+    chunk_size: int = DASK_CHUNK_SIZE,
+    packing: dict | None = None,
+) -> list[tuple[str, str | None]]:
+    """
+    Crop a netcdf subdataset to tiles and write the tile COGs by building
+    and computing a dask graph.
+
+    The subdataset is wrapped in a lazily read dask array with chunks
+    aligned to the netcdf chunks, see `get_dask_chunks`. Each tile gets a
+    task cropping and encoding it from the dask chunks its window overlaps
+    and a task writing the encoded COG, so the dask scheduler decides how
+    many source chunks and encoded COGs are held in memory at once.
+
+    Parameters
+    ----------
+    src : DatasetReader
+        Open rasterio dataset for the netcdf subdataset, to take the
+        netcdf chunk shape, data type and nodata value from.
+    da : xr.DataArray
+        Lazily loaded netcdf subdataset.
+    tile_tasks : list[tuple]
+        Tile index, source window, tile extent and output COG file path
+        for each tile to write.
+    check_empty : bool
+        If True, tiles with no valid pixels are not written.
+    scheduler : str | distributed.Client, optional
+        Dask scheduler to compute the graph with, "threads" for the
+        threaded scheduler or a client of a dask cluster, by default "threads"
+    num_workers : int | None, optional
+        Number of threads of the threaded scheduler, by default None for
+        the number of CPUs.
+    chunk_size : int, optional
+        Target size in bytes of the dask chunks, by default DASK_CHUNK_SIZE
+    packing : dict | None, optional
+        Scaled integer encoding to write the COGs with, from
+        `get_measurement_packing`, by default None to write the values as read.
+
+    Returns
+    -------
+    list[tuple[str, str | None]]
+        Status and error message for each tile, in the order of `tile_tasks`.
+    """
+    y_dim, x_dim = da.odc.spatial_dims
+    chunk_rows, chunk_cols = get_dask_chunks(
+        src.block_shapes[0], np.dtype(src.dtypes[0]).itemsize, chunk_size
+    )
+    # GDAL cannot read a file from several threads at once
+    source = da.chunk({y_dim: chunk_rows, x_dim: chunk_cols}, lock=True).data
+
+    tasks = []
+    for _, roi, tile_extent, output_cog_url in tile_tasks:
+        cropped_da = da.isel({y_dim: roi[0], x_dim: roi[1]}).copy(deep=False, data=source[roi])
+        encoded = dask.delayed(encode_tile_cog)(
+            cropped_da, tile_extent, da.attrs, src.nodata, check_empty, packing
+        )
+        tasks.append(dask.delayed(upload_tile_cog)(encoded, output_cog_url))
+
+    compute_kwargs = dict(scheduler=scheduler)
+    if scheduler == "threads":
+        compute_kwargs["num_workers"] = num_workers
+    log.info(
+        f"Computing {len(tasks)} tiles with dask from chunks of {chunk_rows}x{chunk_cols} pixels"
+    )
+    return list(dask.compute(*tasks, **compute_kwargs))
@@ -62,3 +62,26 @@ MEASUREMENTS = {
     "cgls_lwq100_2024_nrt": MEASUREMENTS_4,
 }
 NAMING_PREFIX = "c_gls"
+# Measurement whose nodata pixels mark where no observations
+# were made, and hence where every other measurement is nodata.
+NUM_OBSERVATIONS_MEASUREMENT = "num_obs"
+# Scaled integer encoding of the float measurements written with
+# --pack-measurements, real_value = pixel_value * scale_factor + add_offset.
+# The nodata value is kept out of the range of valid packed values.
+PACKED_MEASUREMENTS = {
+    # 0 - 655.34 mg/m³
+    "chla_mean": dict(dtype="uint16", scale_factor=0.01, add_offset=0.0, nodata=65535),
+    # 0 - 655.34 %
+    "chla_uncertainty": dict(dtype="uint16", scale_factor=0.01, add_offset=0.0, nodata=65535),
+    # 0 - 655.34
+    "trophic_state_index": dict(dtype="uint16", scale_factor=0.01, add_offset=0.0, nodata=65535),
+    "trophic_state_mean": dict(dtype="uint16", scale_factor=0.01, add_offset=0.0, nodata=65535),
+    # 0 - 3276.7 g/m³
+    "tsm_mean": dict(dtype="uint16", scale_factor=0.05, add_offset=0.0, nodata=65535),
+    # 0 - 655.34 %
+    "tsm_uncertainty": dict(dtype="uint16", scale_factor=0.01, add_offset=0.0, nodata=65535),
+    # 0 - 3276.7 NTU
+    "turbidity_mean": dict(dtype="uint16", scale_factor=0.05, add_offset=0.0, nodata=65535),
+    "turbidity_blended_mean": dict(dtype="uint16", scale_factor=0.05, add_offset=0.0, nodata=65535),
+    "turbidity_sigma": dict(dtype="uint16", scale_factor=0.05, add_offset=0.0, nodata=65535),
+}
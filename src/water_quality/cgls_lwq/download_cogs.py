@@ -3,43 +3,84 @@ Download the Copernicus Global Land Service Lake Water Quality NetCDF files,
 crop and convert to Cloud Optimized Geotiffs, and push to an S3 bucket.
 """
 
+import functools
 import json
 import logging
 import os
-import posixpath
 import sys
+import time
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 import click
 import numpy as np
+import rasterio
 import rioxarray  # noqa F401
+from distributed import Client, LocalCluster
 from odc.geo.xr import assign_crs
 from rasterio.errors import NotGeoreferencedWarning
 from tqdm import tqdm
 
-from water_quality.cgls_lwq.constants import MANIFEST_FILE_URLS, MEASUREMENTS
+from water_quality.cgls_lwq.constants import (
+    MANIFEST_FILE_URLS,
+    MEASUREMENTS,
+    NUM_OBSERVATIONS_MEASUREMENT,
+)
+from water_quality.cgls_lwq.cog_plan import read_cog_plan
+from water_quality.cgls_lwq.cogs import (
+    encode_tile_cogs,
+    get_cog_output_encoding,
+    get_measurement_packing,
+    write_tile_cog,
+    write_tile_cogs_in_pool,
+    write_tile_cogs_with_dask,
+)
 from water_quality.cgls_lwq.netcdf import (
+    get_netcdf_sizes,
+    get_netcdf_sizes_url,
     get_netcdf_subdatasets_uris,
     get_netcdf_urls_from_manifest,
+    get_netcdf_urls_from_manifest_if_modified,
     parse_netcdf_subdatasets_uri,
     parse_netcdf_url,
     read_netcdf_url,
+    sort_netcdf_urls_newest_first,
+)
+from water_quality.cgls_lwq.skipped_tiles import is_empty_tile, write_skipped_tiles_manifest
+from water_quality.cgls_lwq.tile_windows import (
+    get_tile_window_plan,
+    get_tile_window_plan_url,
+    read_tile_windows,
 )
 from water_quality.cgls_lwq.tiles import (
-    get_africa_tiles,
     get_tile_index_str,
     get_tile_index_str_tuple,
 )
 from water_quality.io import (
+    GDAL_VSICURL_CONFIG,
     check_directory_exists,
     check_file_exists,
-    download_file_from_url,
+    create_parent_directory,
     get_filesystem,
+    get_gdal_vsi_prefix,
+    get_url_validators,
+    is_geotiff,
     is_local_path,
     join_url,
+    list_files_under_prefixes,
+    prefetch_files_from_urls,
+    upload_files_in_background,
 )
 from water_quality.logs import setup_logging
+from water_quality.processing_ledger import (
+    get_processing_ledger_dir,
+    get_processing_ledger_shard,
+    get_unprocessed_urls,
+    record_processed_file,
+)
+from water_quality.sharding import split_tasks_by_size
+from water_quality.work_queue import complete_task, iterate_work_queue
 
 # Suppress the warning
 warnings.filterwarnings("ignore", category=NotGeoreferencedWarning)
@@ -124,18 +165,82 @@ def get_output_cog_url(
         tile_index=tile_index,
     )
 
-    if is_local_path(output_cog_url):
-        parent_dir = os.path.dirname(output_cog_url)
-    else:
-        parent_dir = posixpath.dirname(output_cog_url)
-
-    if not check_directory_exists(parent_dir):
-        fs = get_filesystem(parent_dir, anon=False)
-        fs.makedirs(parent_dir, exist_ok=True)
+    create_parent_directory(output_cog_url)
 
     return output_cog_url
 
 
+def get_existing_cog_urls(
+    output_dir: str, netcdf_urls: list[str], tile_indices: list[tuple[int, int]]
+) -> set[str]:
+    """
+    List the COG files already written for a set of netcdf files, with one
+    listing per tile and year prefix instead of checking each file.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory the COG files are written to.
+    netcdf_urls : list[str]
+        URLs of the CGLS Lake Water Quality NetCDF files the COGs are derived from.
+    tile_indices : list[tuple[int, int]]
+        Tile indices of the COG files.
+
+    Returns
+    -------
+    set[str]
+        File paths of the existing COG files, in the same form as the paths
+        returned by `get_expected_cog_url`.
+    """
+    years = set()
+    for netcdf_url in netcdf_urls:
+        _, _, date_str, _, _, _, _ = parse_netcdf_url(netcdf_url)
+        years.add(str(datetime.strptime(date_str, "%Y%m%d%H%M%S").year))
+
+    prefixes = []
+    for tile_index in tile_indices:
+        tile_index_str_x, tile_index_str_y = get_tile_index_str_tuple(
+            get_tile_index_str(tile_index)
+        )
+        for year in sorted(years):
+            prefixes.append(join_url(output_dir, tile_index_str_x, tile_index_str_y, year))
+
+    existing_cog_urls = {i for i in list_files_under_prefixes(prefixes) if is_geotiff(i)}
+    return existing_cog_urls
+
+
+def write_failed_tasks(failed_tasks: list[str]) -> str:
+    """
+    Append a list of failed tasks as a JSON array to the failed tasks file.
+
+    Parameters
+    ----------
+    failed_tasks : list[str]
+        Descriptions of the failed tasks.
+
+    Returns
+    -------
+    str
+        File path of the failed tasks file.
+    """
+    log = logging.getLogger(__name__)
+    failed_tasks_json_array = json.dumps(failed_tasks)
+
+    tasks_directory = "/tmp/"
+    failed_tasks_output_file = join_url(tasks_directory, "failed_tasks")
+
+    fs = get_filesystem(path=tasks_directory, anon=False)
+
+    if not check_directory_exists(path=tasks_directory):
+        fs.mkdirs(path=tasks_directory, exist_ok=True)
+        log.info(f"Created directory {tasks_directory}")
+
+    with fs.open(failed_tasks_output_file, "a") as file:
+        file.write(failed_tasks_json_array + "\n")
+    log.info(f"Failed tasks written to {failed_tasks_output_file}")
+    return failed_tasks_output_file
+
+
 @click.command(
     "download-cgls-lwq-cogs",
     help="Download the Copernicus Global Land Service Lake Water Quality datasets,"
@@ -174,6 +279,193 @@ def get_output_cog_url(
     type=str,
     help="Filter to select netcdf urls to download cogs for.",
 )
+@click.option(
+    "--plan-file",
+    default=None,
+    type=str,
+    help="Cog plan written by plan-cgls-lwq-cogs. Only the netcdf files, measurements and "
+    "tiles the plan lists as missing are processed.",
+)
+@click.option(
+    "--incremental/--no-incremental",
+    default=False,
+    show_default=True,
+    help="Only process the netcdf files that are new or have changed on the server since "
+    "they were last processed, according to the processing ledger kept in the cog output "
+    "directory, and record the files processed in the ledger.",
+)
+@click.option(
+    "--run-id",
+    default=None,
+    type=str,
+    help="Identifier of the workflow run, the same for all its workers. With --incremental "
+    "the first worker saves the netcdf files to process so every worker splits the same "
+    "list, even once other workers have recorded files in the processing ledger, and with "
+    "--shard-by size it saves the file sizes so every worker computes the same split.",
+)
+@click.option(
+    "--watch/--no-watch",
+    default=False,
+    show_default=True,
+    help="Keep running after the netcdf files in the manifest are processed, polling the "
+    "manifest file for new netcdf files and processing them newest first. Meant for the "
+    "near real time products, with a single worker.",
+)
+@click.option(
+    "--poll-interval",
+    default=60,
+    show_default=True,
+    type=float,
+    help="Number of minutes to wait between polls of the manifest file with --watch.",
+)
+@click.option(
+    "--shard-by",
+    type=click.Choice(["count", "size"], case_sensitive=True),
+    default="count",
+    show_default=True,
+    help="Split the netcdf files between the workers into equal numbers of files (count), "
+    "or into about equal total sizes in bytes (size), using the file sizes reported by "
+    "the server. With --max-parallel-steps above 1 splitting by size needs --run-id, so "
+    "the first worker saves the sizes in the cog output directory for the other workers. "
+    "Files are split by count if the server does not report every size.",
+)
+@click.option(
+    "--work-queue-dir",
+    default=None,
+    type=str,
+    help="Directory on a shared filesystem or object store to keep a work queue of the "
+    "netcdf files in. Each worker then claims files from the queue until every file is "
+    "processed, instead of processing a fixed share of the files. Use a new directory "
+    "for each run of the workflow.",
+)
+@click.option(
+    "--lease-duration",
+    default=10,
+    show_default=True,
+    type=float,
+    help="Number of minutes a worker's claim on a file in the work queue lasts without "
+    "being renewed, after which another worker can claim the file.",
+)
+@click.option(
+    "--skip-empty-tiles/--no-skip-empty-tiles",
+    default=False,
+    show_default=True,
+    help="Skip writing cogs for tiles with no valid observations and record the "
+    "skipped tiles in a manifest in the cog output directory.",
+)
+@click.option(
+    "--pack-measurements/--no-pack-measurements",
+    default=False,
+    show_default=True,
+    help="Write the cogs of float measurements such as chla_mean, tsm_mean and "
+    "turbidity_mean as scaled 16 bit integers, with the scale factor, offset and nodata "
+    "value in the cog tags. Index them with the product definitions in products/packed/. "
+    "Packed and unpacked cogs cannot be written to the same cog output directory.",
+)
+@click.option(
+    "--cog-workers",
+    default=1,
+    show_default=True,
+    type=int,
+    help="Number of processes to use to crop, encode and write the tile cogs.",
+)
+@click.option(
+    "--prefetch",
+    default=0,
+    show_default=True,
+    type=int,
+    help="Number of netcdf files to download in the background ahead of the file being processed.",
+)
+@click.option(
+    "--prefetch-disk-budget",
+    default=None,
+    type=float,
+    help="Maximum disk space in GB the downloaded netcdf files can take up at once. "
+    "Defaults to the free space in the download directory.",
+)
+@click.option(
+    "--download-connections",
+    default=1,
+    show_default=True,
+    type=int,
+    help="Number of concurrent connections to download each netcdf file over "
+    "using HTTP Range requests.",
+)
+@click.option(
+    "--keep-netcdfs/--no-keep-netcdfs",
+    default=False,
+    show_default=True,
+    help="Keep the downloaded netcdf files after the cogs are written, so later runs "
+    "only download them again if they have changed on the server.",
+)
+@click.option(
+    "--netcdf-cache-dir",
+    default=None,
+    type=str,
+    help="Local directory to cache the downloaded netcdf files in, shared by the "
+    "workers on the same node. By default each worker downloads to its own "
+    "temporary directory.",
+)
+@click.option(
+    "--netcdf-cache-size",
+    default=None,
+    type=float,
+    help="Maximum size in GB of the netcdf cache, least recently used files are "
+    "evicted to stay within it. Unbounded by default.",
+)
+@click.option(
+    "--read-mode",
+    type=click.Choice(["local", "remote"], case_sensitive=True),
+    default="local",
+    show_default=True,
+    help="Download each netcdf file before reading it (local), or read only the tile "
+    "windows needed directly over HTTP using GDAL /vsicurl/ (remote).",
+)
+@click.option(
+    "--memory-budget",
+    default=None,
+    type=float,
+    help="Maximum memory in GB to hold source pixels in while reading each netcdf "
+    "subdataset. The tiles are then read in strips of columns of tiles streamed one row "
+    "of chunks at a time, so memory use does not grow with the width of the product. "
+    "Encoding a tile cog needs memory for the tile on top. With --engine dask it is split "
+    "between the workers of --dask-scheduler local-cluster as their memory limit. "
+    "Unbounded by default.",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["native", "dask"], case_sensitive=True),
+    default="native",
+    show_default=True,
+    help="Read the tile windows of each netcdf subdataset with the package's own reading "
+    "loop and write the cogs in this process or the --cog-workers processes (native), or "
+    "build a dask graph with one crop and encode task and one write task per tile, "
+    "computed with --dask-scheduler (dask).",
+)
+@click.option(
+    "--dask-scheduler",
+    type=click.Choice(["threads", "local-cluster"], case_sensitive=True),
+    default="threads",
+    show_default=True,
+    help="Compute the dask graph with the threaded scheduler (threads), or on a local "
+    "dask cluster of single threaded worker processes which spill to disk once their "
+    "share of --memory-budget is used (local-cluster). Used with --engine dask.",
+)
+@click.option(
+    "--dask-workers",
+    default=None,
+    type=int,
+    help="Number of threads or worker processes to compute the dask graph with. "
+    "Defaults to the number of CPUs. Used with --engine dask.",
+)
+@click.option(
+    "--max-uploads-in-flight",
+    default=16,
+    show_default=True,
+    type=int,
+    help="Maximum number of encoded cogs held in memory while they are uploaded to a "
+    "remote cog output directory, when writing the cogs in a single process.",
+)
 def download_cogs(
     product_name: str,
     cog_output_dir: str,
@@ -181,6 +473,29 @@ def download_cogs(
     max_parallel_steps: int,
     worker_idx: int,
     url_filter: str,
+    plan_file: str,
+    incremental: bool,
+    run_id: str,
+    watch: bool,
+    poll_interval: float,
+    shard_by: str,
+    work_queue_dir: str,
+    lease_duration: float,
+    skip_empty_tiles: bool,
+    pack_measurements: bool,
+    cog_workers: int,
+    prefetch: int,
+    prefetch_disk_budget: float,
+    download_connections: int,
+    keep_netcdfs: bool,
+    netcdf_cache_dir: str,
+    netcdf_cache_size: float,
+    read_mode: str,
+    memory_budget: float,
+    engine: str,
+    dask_scheduler: str,
+    dask_workers: int,
+    max_uploads_in_flight: int,
 ):
     # Setup logging level
     setup_logging()
@@ -196,6 +511,48 @@ def download_cogs(
             f"Required measurements not configured for the product {product_name}"
         )
 
+    if watch and (max_parallel_steps > 1 or work_queue_dir):
+        raise click.UsageError(
+            "--watch runs a single worker, it cannot be used with --max-parallel-steps "
+            "above 1 or --work-queue-dir"
+        )
+
+    if incremental and max_parallel_steps > 1 and not (run_id or work_queue_dir):
+        raise click.UsageError(
+            "Workers diffing the manifest against the processing ledger at different times "
+            "split different lists, use --run-id or --work-queue-dir with --incremental and "
+            "--max-parallel-steps above 1"
+        )
+
+    if shard_by == "size" and max_parallel_steps > 1 and not (run_id or work_queue_dir):
+        raise click.UsageError(
+            "Workers getting the file sizes from the server on their own can compute different "
+            "splits, use --run-id with --shard-by size and --max-parallel-steps above 1"
+        )
+
+    if engine == "dask" and read_mode == "remote":
+        raise click.UsageError(
+            "--engine dask reads downloaded netcdf files, it cannot be used with --read-mode remote"
+        )
+
+    if engine == "dask" and cog_workers > 1:
+        raise click.UsageError("--engine dask uses --dask-workers instead of --cog-workers")
+
+    if engine == "dask" and dask_scheduler == "threads" and memory_budget:
+        raise click.UsageError(
+            "The threaded dask scheduler cannot bound the memory it uses, use "
+            "--dask-scheduler local-cluster with --memory-budget"
+        )
+
+    # Packed and unpacked cogs get the same paths, so they are kept apart
+    cog_encoding = "packed" if pack_measurements else "unpacked"
+    output_encoding = get_cog_output_encoding(cog_output_dir, cog_encoding)
+    if output_encoding != cog_encoding:
+        raise click.UsageError(
+            f"{cog_output_dir} holds {output_encoding} cogs, write {cog_encoding} cogs to a "
+            "different --cog-output-dir"
+        )
+
     # Read urls available for the product
     all_netcdf_urls = get_netcdf_urls_from_manifest(MANIFEST_FILE_URLS[product_name])
     log.info(f"Found {len(all_netcdf_urls)} netcdf urls in the manifest file")
@@ -211,169 +568,500 @@ def download_cogs(
             log.info(
                 f"Found {len(all_netcdf_urls)} netcdf urls in the manifest file that match the filter '{url_filter}'"
             )
+    manifest_netcdf_urls = all_netcdf_urls
+
+    if plan_file:
+        # Only process the cogs still missing when the plan was made
+        cog_plan = read_cog_plan(plan_file)
+        if cog_plan["cog_output_dir"] != cog_output_dir:
+            log.warning(
+                f"Cog plan {plan_file} was made for the cog output directory "
+                f"{cog_plan['cog_output_dir']}"
+            )
+        all_netcdf_urls = [i for i in all_netcdf_urls if i in cog_plan["netcdfs"]]
+        log.info(f"Found {len(all_netcdf_urls)} netcdf urls with missing cogs in {plan_file}")
+        if not all_netcdf_urls and not watch:
+            log.info(f"Worker {worker_idx} has no netcdf files to process")
+            sys.exit(0)
+    else:
+        cog_plan = None
+
+    changed_netcdf_urls = set()
+    if incremental:
+        # Only process the files which are new or changed since the last run
+        processing_ledger_dir = get_processing_ledger_dir(cog_output_dir)
+        all_netcdf_urls, changed_netcdf_urls, netcdf_validators = get_unprocessed_urls(
+            processing_ledger_dir, all_netcdf_urls, run_id=run_id
+        )
+        log.info(
+            f"Found {len(all_netcdf_urls)} netcdf urls that are new or have changed "
+            f"since they were last processed, {len(changed_netcdf_urls)} of them changed"
+        )
+        # The cogs of the changed files exist but are stale, so they are overwritten
+        changed_netcdf_urls = set(changed_netcdf_urls)
+        if not all_netcdf_urls and not watch:
+            log.info(f"Worker {worker_idx} has no netcdf files to process")
+            sys.exit(0)
+        processing_ledger_path = get_processing_ledger_shard(
+            processing_ledger_dir,
+            worker_idx,
+            local_dir=f"tmp/{product_name}/processing_ledger/",
+        )
+
+    if work_queue_dir:
+        # Every worker claims files from the queue, starting from its share of the files
+        netcdf_urls = all_netcdf_urls
+        start = worker_idx * len(netcdf_urls) // max_parallel_steps
+        log.info(f"Worker {worker_idx} to claim netcdf files from the work queue {work_queue_dir}")
+    elif watch:
+        # Process the most recent files first, as they are the ones waited for
+        netcdf_urls = sort_netcdf_urls_newest_first(all_netcdf_urls)
+        log.info(f"Watching the manifest file, {len(netcdf_urls)} netcdf files to process first")
+    else:
+        netcdf_sizes = None
+        if shard_by == "size":
+            netcdf_sizes = get_netcdf_sizes(
+                all_netcdf_urls, get_netcdf_sizes_url(cog_output_dir, run_id) if run_id else None
+            )
+            if netcdf_sizes is None:
+                log.warning("Splitting the netcdf files by count, as not every size is known")
 
-    # Split files equally among the workers
-    task_chunks = np.array_split(np.array(all_netcdf_urls), max_parallel_steps)
-    task_chunks = [chunk.tolist() for chunk in task_chunks]
-    task_chunks = list(filter(None, task_chunks))
+        if netcdf_sizes is not None:
+            # Split files among the workers by total size, as file sizes vary a lot
+            task_chunks = split_tasks_by_size(all_netcdf_urls, netcdf_sizes, max_parallel_steps)
+            task_chunks = list(filter(None, task_chunks))
 
-    # In case of the index being bigger than the number of positions in the array, the extra POD isn't necessary
-    if len(task_chunks) <= worker_idx:
-        log.warning(f"Worker {worker_idx} Skipped!")
-        sys.exit(0)
+            chunk_sizes = [sum(netcdf_sizes[i] for i in chunk) for chunk in task_chunks]
+            log.info(
+                f"Split {sum(chunk_sizes) / 1024**3:.2f} GB of netcdf files into "
+                f"{len(task_chunks)} shards of {min(chunk_sizes) / 1024**3:.2f} to "
+                f"{max(chunk_sizes) / 1024**3:.2f} GB"
+            )
+        else:
+            # Split files equally among the workers
+            task_chunks = np.array_split(np.array(all_netcdf_urls), max_parallel_steps)
+            task_chunks = [chunk.tolist() for chunk in task_chunks]
+            task_chunks = list(filter(None, task_chunks))
 
-    log.info(f"Executing worker {worker_idx}")
+        # In case of the index being bigger than the number of positions in the array, the extra POD isn't necessary
+        if len(task_chunks) <= worker_idx:
+            log.warning(f"Worker {worker_idx} Skipped!")
+            sys.exit(0)
 
-    netcdf_urls = task_chunks[worker_idx]
-    log.info(f"Worker {worker_idx} to process {len(netcdf_urls)} netcdf files.")
+        log.info(f"Executing worker {worker_idx}")
+
+        netcdf_urls = task_chunks[worker_idx]
+        log.info(f"Worker {worker_idx} to process {len(netcdf_urls)} netcdf files.")
 
     # Define the tiles over Africa
-    if "300m" in netcdf_urls[0]:
+    if "300m" in manifest_netcdf_urls[0]:
         grid_res = 300
-    elif "100m" in netcdf_urls[0]:
+    elif "100m" in manifest_netcdf_urls[0]:
         grid_res = 100
 
-    tiles = get_africa_tiles(grid_res)
+    # Tile windows are shared by every netcdf of the product so are only
+    # computed once the grid of the first subdataset is known.
+    tile_window_plan_url = get_tile_window_plan_url(cog_output_dir)
+    tile_window_plan = None
+    # Existing cogs are listed once the tiles are known, to decide which to skip.
+    # The cog plan already lists only the missing cogs.
+    existing_cog_urls = set() if cog_plan else None
+
+    if cog_workers > 1:
+        cog_executor = ProcessPoolExecutor(max_workers=cog_workers)
+        log.info(f"Writing cogs using {cog_workers} processes")
+    else:
+        cog_executor = None
+
+    if memory_budget:
+        memory_budget = int(memory_budget * 1024**3)
+        # GDAL's block cache only needs to hold the chunks of one row of chunks
+        gdal_cache_config = dict(GDAL_CACHEMAX=memory_budget // 8)
+        read_memory_budget = memory_budget - memory_budget // 8
+    else:
+        gdal_cache_config = {}
+        read_memory_budget = None
+
+    dask_client = None
+    if engine == "dask":
+        dask_workers = dask_workers or os.cpu_count()
+        if dask_scheduler == "local-cluster":
+            dask_client = Client(
+                LocalCluster(
+                    n_workers=dask_workers,
+                    threads_per_worker=1,
+                    memory_limit=memory_budget // dask_workers if memory_budget else "auto",
+                )
+            )
+            log.info(f"Writing cogs using a local dask cluster of {dask_workers} workers")
+        else:
+            log.info(f"Writing cogs using dask with {dask_workers} threads")
 
     tmp_dir = f"tmp/{product_name}/netcdfs/"
+    # Checksums and server validators of the downloaded netcdf files
+    download_ledger_path = join_url(tmp_dir, "download_ledger.db")
     failed_tasks = []
     max_retries = 5
-    for idx, netcdf_url in enumerate(netcdf_urls):
-        log.info(f"Processing {netcdf_url} {idx + 1}/{len(netcdf_urls)}")
-        # Download file instead.
-        output_netcdf_file_path = join_url(tmp_dir, posixpath.basename(netcdf_url))
-        log.info(f"Downloading {netcdf_url} to {output_netcdf_file_path}")
-
-        if check_file_exists(output_netcdf_file_path):
-            log.info(f"{output_netcdf_file_path} already exists! Skippping download ...")
-        else:
-            try:
-                output_netcdf_file_path = download_file_from_url(
-                    url=netcdf_url, output_file_path=output_netcdf_file_path, chunks=100
+    # Download the next netcdf files in the background while the current one is processed.
+    if read_mode == "remote":
+        # Read only the tile windows needed straight from the server
+        log.info("Reading the netcdf files remotely over HTTP")
+
+        def get_downloads(urls):
+            return ((url, get_gdal_vsi_prefix(url), None) for url in urls)
+
+        gdal_env = rasterio.Env(**GDAL_VSICURL_CONFIG, **gdal_cache_config)
+    else:
+        if netcdf_cache_dir:
+            log.info(f"Using the netcdf cache {netcdf_cache_dir}")
+        get_downloads = functools.partial(
+            prefetch_files_from_urls,
+            output_dir=netcdf_cache_dir or tmp_dir,
+            prefetch=prefetch,
+            disk_budget=int(prefetch_disk_budget * 1024**3) if prefetch_disk_budget else None,
+            chunks=100,
+            connections=download_connections,
+            ledger_path=download_ledger_path,
+            cache=bool(netcdf_cache_dir),
+            cache_size=int(netcdf_cache_size * 1024**3) if netcdf_cache_size else None,
+        )
+        gdal_env = rasterio.Env(**gdal_cache_config)
+
+    def watch_downloads():
+        """
+        Yield the downloads of the netcdf files to process, then keep polling
+        the manifest file and yield the downloads of the files added to it,
+        newest first. The tile windows, existing cogs and filesystem clients
+        stay in memory between polls. Files that failed are retried at the
+        next poll.
+        """
+        manifest_validators = None
+        seen_urls = set(manifest_netcdf_urls)
+        batch = list(netcdf_urls)
+        while True:
+            retry_urls = []
+            for download in get_downloads(batch):
+                num_failed = len(failed_tasks)
+                yield download
+                if len(failed_tasks) > num_failed:
+                    retry_urls.append(download[0])
+
+            if failed_tasks:
+                write_failed_tasks(failed_tasks)
+                log.error(f"{len(failed_tasks)} tasks failed, retrying at the next poll")
+                failed_tasks.clear()
+
+            new_urls = []
+            while not new_urls:
+                log.info(f"Polling the manifest file again in {poll_interval} minutes")
+                time.sleep(poll_interval * 60)
+                urls, manifest_validators = get_netcdf_urls_from_manifest_if_modified(
+                    MANIFEST_FILE_URLS[product_name], manifest_validators
                 )
-                log.info("Download complete!")
-            except Exception as error:
-                log.exception(error)
+                if urls is None:
+                    log.info("Manifest file not modified")
+                    urls = []
+                if url_filter:
+                    urls = [i for i in urls if url_filter in i]
+                new_urls = [i for i in urls if i not in seen_urls]
+                seen_urls.update(new_urls)
+                log.info(f"Found {len(new_urls)} new netcdf urls in the manifest file")
+                new_urls += [i for i in retry_urls if i not in new_urls]
+
+            if incremental:
+                netcdf_validators.update(get_url_validators(new_urls))
+            netcdf_urls.extend(new_urls)
+            batch = sort_netcdf_urls_newest_first(new_urls)
+
+    if work_queue_dir:
+        downloads = iterate_work_queue(
+            work_queue_dir,
+            netcdf_urls,
+            lease_duration * 60,
+            start=start,
+            pipeline=get_downloads,
+        )
+    elif watch:
+        downloads = watch_downloads()
+    else:
+        downloads = get_downloads(netcdf_urls)
+    with gdal_env:
+        for idx, (netcdf_url, output_netcdf_file_path, download_error) in enumerate(downloads):
+            log.info(f"Processing {netcdf_url} {idx + 1}/{len(netcdf_urls)}")
+            if download_error is not None:
+                log.exception(download_error)
                 log.error(f"Failed to download {netcdf_url}")
                 failed_tasks.append(f"Failed to download {netcdf_url}")
                 continue
 
-        if check_file_exists(output_netcdf_file_path):
-            log.info(f"Generating cog files for {output_netcdf_file_path}")
-            try:
-                # Get the subdatasets in the netcdf
-                netcdf_subdatasets_uris = get_netcdf_subdatasets_uris(output_netcdf_file_path)
-                # Filter by required measurements
-                netcdf_subdatasets_uris = {
-                    k: v
-                    for k, v in netcdf_subdatasets_uris.items()
-                    if k in MEASUREMENTS[product_name]
-                }
-                if product_name != "cgls_lwq100_2019_2024":
-                    # Check
-                    assert len(netcdf_subdatasets_uris) == len(MEASUREMENTS[product_name])
-
-                for var, subdataset_uri in netcdf_subdatasets_uris.items():
-                    # da = rioxarray.open_rasterio(subdataset_uri).squeeze()
-                    da = read_netcdf_url(subdataset_uri, max_retries=max_retries)
-                    da = da.squeeze()
-
-                    if "spatial_ref" in list(da.coords):
-                        crs_coord_name = "spatial_ref"
-                    elif "crs" in list(da.coords):
-                        crs_coord_name = "crs"
-
-                    crs = da.rio.crs
-
-                    if crs is None:
-                        # Assumption drawn from product manual is
-                        # data is either in EPSG:4326 or OGC:CRS84
-                        if da.dims[0] in ["y", "lat", "latitude"]:
-                            crs = "EPSG:4326"
-                        elif da.dims[0] in ["x", "lon", "longitude"]:
-                            crs = "OGC:CRS84"
-
-                    da = assign_crs(da, crs, crs_coord_name=crs_coord_name)
-
-                    # Get attributes to be used in tiled COGs
-                    attrs = da.attrs
-                    exclude = [
-                        "lon#",
-                        "lat#",
-                        "number_of_regions",
-                        "TileSize",
-                        "NETCDF_",
-                        "coordinates",
-                    ]
-                    filtered_attrs = {
+            if read_mode == "remote" or check_file_exists(output_netcdf_file_path):
+                log.info(f"Generating cog files for {output_netcdf_file_path}")
+                num_failed_tasks = len(failed_tasks)
+                try:
+                    # Get the subdatasets in the netcdf
+                    netcdf_subdatasets_uris = get_netcdf_subdatasets_uris(output_netcdf_file_path)
+                    # Filter by required measurements
+                    netcdf_subdatasets_uris = {
                         k: v
-                        for k, v in attrs.items()
-                        if not any(sub.lower() in k.lower() for sub in exclude)
+                        for k, v in netcdf_subdatasets_uris.items()
+                        if k in MEASUREMENTS[product_name]
                     }
-                    da.attrs = filtered_attrs
-
-                    # Crop the netcdf subdataset to each tile
-                    with tqdm(
-                        iterable=tiles,
-                        desc=f"Cropping {var} subdataset",
-                        total=len(tiles),
-                    ) as tiles:
-                        for tile in tiles:
-                            tile_idx, tile_geobox = tile
+                    if product_name != "cgls_lwq100_2019_2024":
+                        # Check
+                        assert len(netcdf_subdatasets_uris) == len(MEASUREMENTS[product_name])
+
+                    if skip_empty_tiles:
+                        if NUM_OBSERVATIONS_MEASUREMENT in netcdf_subdatasets_uris:
+                            # Process the number of observations first to find the
+                            # empty tiles to skip for all the other measurements.
+                            netcdf_subdatasets_uris = {
+                                NUM_OBSERVATIONS_MEASUREMENT: netcdf_subdatasets_uris.pop(
+                                    NUM_OBSERVATIONS_MEASUREMENT
+                                ),
+                                **netcdf_subdatasets_uris,
+                            }
+                        else:
+                            log.warning(
+                                f"{NUM_OBSERVATIONS_MEASUREMENT} subdataset not found, "
+                                "empty tiles will not be skipped"
+                            )
+                    empty_tiles = set()
+
+                    # The cogs of a file which changed since it was processed are all stale
+                    overwrite_netcdf = overwrite or netcdf_url in changed_netcdf_urls
+
+                    # Files added to the manifest after the plan was made are processed in full
+                    netcdf_plan = (
+                        cog_plan["netcdfs"].get(netcdf_url)
+                        if cog_plan and netcdf_url not in changed_netcdf_urls
+                        else None
+                    )
+                    if netcdf_plan is not None:
+                        # Keep the tiles skipped in earlier runs recorded as skipped
+                        empty_tiles.update(netcdf_plan["skipped"])
+
+                    # Tiles of the product, known once the first subdataset is read
+                    num_tiles = (
+                        len(tile_window_plan["tiles"]) if tile_window_plan is not None else 0
+                    )
+                    for var, subdataset_uri in netcdf_subdatasets_uris.items():
+                        if netcdf_plan is not None and var not in netcdf_plan["missing"]:
+                            continue
+
+                        # da = rioxarray.open_rasterio(subdataset_uri).squeeze()
+                        da = read_netcdf_url(subdataset_uri, max_retries=max_retries)
+                        da = da.squeeze()
+
+                        if "spatial_ref" in list(da.coords):
+                            crs_coord_name = "spatial_ref"
+                        elif "crs" in list(da.coords):
+                            crs_coord_name = "crs"
+
+                        crs = da.rio.crs
+
+                        if crs is None:
+                            # Assumption drawn from product manual is
+                            # data is either in EPSG:4326 or OGC:CRS84
+                            if da.dims[0] in ["y", "lat", "latitude"]:
+                                crs = "EPSG:4326"
+                            elif da.dims[0] in ["x", "lon", "longitude"]:
+                                crs = "OGC:CRS84"
+
+                        da = assign_crs(da, crs, crs_coord_name=crs_coord_name)
+
+                        # Get attributes to be used in tiled COGs
+                        attrs = da.attrs
+                        exclude = [
+                            "lon#",
+                            "lat#",
+                            "number_of_regions",
+                            "TileSize",
+                            "NETCDF_",
+                            "coordinates",
+                        ]
+                        filtered_attrs = {
+                            k: v
+                            for k, v in attrs.items()
+                            if not any(sub.lower() in k.lower() for sub in exclude)
+                        }
+                        da.attrs = filtered_attrs
+
+                        if (
+                            tile_window_plan is None
+                            or tile_window_plan["source_geobox"] != da.odc.geobox
+                        ):
+                            tile_window_plan = get_tile_window_plan(
+                                tile_window_plan_url, da.odc.geobox, grid_res
+                            )
+                        tile_windows = tile_window_plan["tiles"]
+                        num_tiles = len(tile_windows)
+
+                        if not overwrite and existing_cog_urls is None:
+                            existing_cog_urls = get_existing_cog_urls(
+                                cog_output_dir,
+                                netcdf_urls,
+                                [tile_idx for tile_idx, _, _ in tile_windows],
+                            )
+                            log.info(f"Found {len(existing_cog_urls)} existing cogs")
+
+                        # Get the tiles still to be written for the subdataset
+                        tile_tasks = []
+                        for tile_idx, roi, tile_extent in tile_windows:
+                            if tile_idx in empty_tiles:
+                                continue
+                            if (
+                                netcdf_plan is not None
+                                and tile_idx not in netcdf_plan["missing"][var]
+                            ):
+                                continue
+
                             output_cog_url = get_output_cog_url(
                                 cog_output_dir, subdataset_uri, tile_idx
                             )
-                            if not overwrite:
-                                if check_file_exists(output_cog_url):
+                            if not overwrite_netcdf:
+                                if output_cog_url in existing_cog_urls:
                                     continue
 
-                            cropped_da = da.odc.crop(tile_geobox.extent.to_crs(da.odc.geobox.crs))
+                            tile_tasks.append((tile_idx, roi, tile_extent, output_cog_url))
+
+                        check_empty = skip_empty_tiles and var == NUM_OBSERVATIONS_MEASUREMENT
 
-                            # Write cog files
-                            if is_local_path(output_cog_url):
-                                cropped_da.odc.write_cog(
-                                    fname=output_cog_url,
-                                    overwrite=True,
-                                    tags=filtered_attrs,
+                        # Read the netcdf subdataset one tile window at a time
+                        with rasterio.open(subdataset_uri) as src:
+                            packing = (
+                                get_measurement_packing(var, da, src.nodata)
+                                if pack_measurements
+                                else None
+                            )
+                            if (
+                                engine == "native"
+                                and cog_executor is None
+                                and not is_local_path(cog_output_dir)
+                            ):
+                                # Encode the next cogs while the previous ones are uploaded
+                                cogs = encode_tile_cogs(
+                                    tqdm(
+                                        iterable=read_tile_windows(
+                                            src, da, tile_tasks, read_memory_budget
+                                        ),
+                                        desc=f"Cropping {var} subdataset",
+                                        total=len(tile_tasks),
+                                    ),
+                                    src.nodata,
+                                    filtered_attrs,
+                                    check_empty,
+                                    empty_tiles,
+                                    packing,
                                 )
+                                for output_cog_url, error in upload_files_in_background(
+                                    cogs, max_in_flight=max_uploads_in_flight
+                                ):
+                                    if error is None:
+                                        if existing_cog_urls is not None:
+                                            existing_cog_urls.add(output_cog_url)
+                                    else:
+                                        log.error(f"Failed to write {output_cog_url}: {error!r}")
+                                        failed_tasks.append(f"Failed to write {output_cog_url}")
+                            elif engine == "native" and cog_executor is None:
+                                for tile_task, cropped_da in tqdm(
+                                    iterable=read_tile_windows(
+                                        src, da, tile_tasks, read_memory_budget
+                                    ),
+                                    desc=f"Cropping {var} subdataset",
+                                    total=len(tile_tasks),
+                                ):
+                                    tile_idx, _, _, output_cog_url = tile_task
+                                    if check_empty and is_empty_tile(cropped_da, src.nodata):
+                                        empty_tiles.add(tile_idx)
+                                        continue
+
+                                    write_tile_cog(
+                                        cropped_da, output_cog_url, filtered_attrs, packing
+                                    )
+                                    if existing_cog_urls is not None:
+                                        existing_cog_urls.add(output_cog_url)
                             else:
-                                cog_bytes = cropped_da.odc.write_cog(
-                                    fname=":mem:", overwrite=True, tags=filtered_attrs
-                                )
-                                fs = get_filesystem(output_cog_url, anon=False)
-                                with fs.open(output_cog_url, "wb") as f:
-                                    f.write(cog_bytes)
-
-                    log.info(f"Written COGs for {var} subdataset")
-            except Exception as error:
-                log.exception(error)
-                log.error(f"Failed to generate cogs for the netcdf {output_netcdf_file_path}")
-                failed_tasks.append(
-                    f"Failed to generate cogs for the netcdf {output_netcdf_file_path}"
-                )
-            # Once done remove the file to save on storage in volume
-            os.remove(output_netcdf_file_path)
-            log.info(f"Deleted {output_netcdf_file_path}")
-        else:
-            error = f"File {output_netcdf_file_path} downloaded from {netcdf_url} but not detected on file system!"
-            log.error(error)
-            failed_tasks.append(error)
-            continue
+                                if engine == "dask":
+                                    results = write_tile_cogs_with_dask(
+                                        src,
+                                        da,
+                                        tile_tasks,
+                                        check_empty,
+                                        scheduler=dask_client or "threads",
+                                        num_workers=dask_workers,
+                                        packing=packing,
+                                    )
+                                else:
+                                    results = write_tile_cogs_in_pool(
+                                        cog_executor,
+                                        src,
+                                        da,
+                                        tile_tasks,
+                                        check_empty,
+                                        memory_budget=read_memory_budget,
+                                        packing=packing,
+                                    )
+                                for tile_task, (status, error) in tqdm(
+                                    iterable=zip(tile_tasks, results),
+                                    desc=f"Cropping {var} subdataset",
+                                    total=len(tile_tasks),
+                                ):
+                                    tile_idx, _, _, output_cog_url = tile_task
+                                    if status == "written" and existing_cog_urls is not None:
+                                        existing_cog_urls.add(output_cog_url)
+                                    elif status == "empty":
+                                        empty_tiles.add(tile_idx)
+                                    elif status == "failed":
+                                        log.error(f"Failed to write {output_cog_url}: {error}")
+                                        failed_tasks.append(f"Failed to write {output_cog_url}")
 
-    if failed_tasks:
-        failed_tasks_json_array = json.dumps(failed_tasks)
+                        log.info(f"Written COGs for {var} subdataset")
 
-        tasks_directory = "/tmp/"
-        failed_tasks_output_file = join_url(tasks_directory, "failed_tasks")
+                    if skip_empty_tiles:
+                        skipped_tiles_manifest_url = write_skipped_tiles_manifest(
+                            cog_output_dir, netcdf_url, empty_tiles
+                        )
+                        log.info(
+                            f"Skipped {len(empty_tiles)} empty tiles, "
+                            f"recorded in {skipped_tiles_manifest_url}"
+                        )
 
-        fs = get_filesystem(path=tasks_directory, anon=False)
+                    if incremental and len(failed_tasks) == num_failed_tasks:
+                        record_processed_file(
+                            processing_ledger_dir,
+                            processing_ledger_path,
+                            netcdf_url,
+                            netcdf_validators[netcdf_url],
+                            output_count=len(netcdf_subdatasets_uris)
+                            * (num_tiles - len(empty_tiles)),
+                            skipped_count=len(netcdf_subdatasets_uris) * len(empty_tiles),
+                        )
+                except Exception as error:
+                    log.exception(error)
+                    log.error(f"Failed to generate cogs for the netcdf {output_netcdf_file_path}")
+                    failed_tasks.append(
+                        f"Failed to generate cogs for the netcdf {output_netcdf_file_path}"
+                    )
+                if work_queue_dir and len(failed_tasks) == num_failed_tasks:
+                    # Failed files are released for the other workers to retry instead
+                    complete_task(work_queue_dir, netcdf_url)
+                if read_mode == "local" and not (keep_netcdfs or netcdf_cache_dir):
+                    # Once done remove the file to save on storage in volume
+                    os.remove(output_netcdf_file_path)
+                    log.info(f"Deleted {output_netcdf_file_path}")
+            else:
+                error = f"File {output_netcdf_file_path} downloaded from {netcdf_url} but not detected on file system!"
+                log.error(error)
+                failed_tasks.append(error)
+                continue
 
-        if not check_directory_exists(path=tasks_directory):
-            fs.mkdirs(path=tasks_directory, exist_ok=True)
-            log.info(f"Created directory {tasks_directory}")
+    if cog_executor is not None:
+        cog_executor.shutdown()
 
-        with fs.open(failed_tasks_output_file, "a") as file:
-            file.write(failed_tasks_json_array + "\n")
-        log.info(f"Failed tasks written to {failed_tasks_output_file}")
+    if dask_client is not None:
+        dask_client.cluster.close()
+        dask_client.close()
 
+    if failed_tasks:
+        write_failed_tasks(failed_tasks)
         raise RuntimeError(f"{len(failed_tasks)} tasks failed")
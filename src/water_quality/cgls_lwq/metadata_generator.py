@@ -22,12 +22,14 @@ from water_quality.cgls_lwq.tiles import get_tile_index_str_tuple
 from water_quality.io import (
     check_directory_exists,
     check_file_exists,
+    create_directory,
     find_geotiff_files,
     get_filesystem,
     is_local_path,
     join_url,
 )
 from water_quality.logs import setup_logging
+from water_quality.work_queue import complete_task, iterate_work_queue
 
 
 def get_stac_item_destination_url(output_dir: str, dataset_tile_id: str) -> str:
@@ -65,9 +67,7 @@ def get_stac_item_destination_url(output_dir: str, dataset_tile_id: str) -> str:
         day,
     )
 
-    if not check_directory_exists(parent_dir):
-        fs = get_filesystem(parent_dir, anon=False)
-        fs.makedirs(parent_dir, exist_ok=True)
+    create_directory(parent_dir)
 
     stac_item_destination_url = join_url(parent_dir, file_name)
     return stac_item_destination_url
@@ -112,9 +112,7 @@ def get_eo3_dataset_doc_file_path(
     )
 
     if write_eo3_dataset_doc:
-        if not check_directory_exists(parent_dir):
-            fs = get_filesystem(parent_dir, anon=False)
-            fs.makedirs(parent_dir, exist_ok=True)
+        create_directory(parent_dir)
 
     eo3_dataset_doc_file_path = join_url(parent_dir, file_name)
     return eo3_dataset_doc_file_path
@@ -156,6 +154,23 @@ def get_eo3_dataset_doc_file_path(
     type=int,
     help="Sequential index which will be used to define the range of geotiffs the pod will work with.",
 )
+@click.option(
+    "--work-queue-dir",
+    default=None,
+    type=str,
+    help="Directory on a shared filesystem or object store to keep a work queue of the "
+    "datasets in. Each worker then claims datasets from the queue until every dataset is "
+    "processed, instead of processing a fixed share of the datasets. Use a new directory "
+    "for each run of the workflow.",
+)
+@click.option(
+    "--lease-duration",
+    default=10,
+    show_default=True,
+    type=float,
+    help="Number of minutes a worker's claim on a dataset in the work queue lasts without "
+    "being renewed, after which another worker can claim the dataset.",
+)
 @click.option(
     "--write-eo3/--no-write-eo3",
     default=False,
@@ -169,6 +184,8 @@ def create_stac_files(
     overwrite: bool,
     max_parallel_steps: int,
     worker_idx: int,
+    work_queue_dir: str,
+    lease_duration: float,
     write_eo3: bool,
 ):
     # Setup logging level
@@ -186,25 +203,39 @@ def create_stac_files(
     all_dataset_paths.sort()
     log.info(f"Found {len(all_dataset_paths)} datasets")
 
-    # Split files equally among the workers
-    task_chunks = np.array_split(np.array(all_dataset_paths), max_parallel_steps)
-    task_chunks = [chunk.tolist() for chunk in task_chunks]
-    task_chunks = list(filter(None, task_chunks))
+    if work_queue_dir:
+        # Every worker claims datasets from the queue, starting from its share of the datasets
+        num_datasets = len(all_dataset_paths)
+        dataset_paths = iterate_work_queue(
+            work_queue_dir,
+            all_dataset_paths,
+            lease_duration * 60,
+            start=worker_idx * num_datasets // max_parallel_steps,
+        )
+        log.info(f"Worker {worker_idx} to claim datasets from the work queue {work_queue_dir}")
+    else:
+        # Split files equally among the workers
+        task_chunks = np.array_split(np.array(all_dataset_paths), max_parallel_steps)
+        task_chunks = [chunk.tolist() for chunk in task_chunks]
+        task_chunks = list(filter(None, task_chunks))
 
-    # In case of the index being bigger than the number of positions in the array, the extra POD isn't necessary
-    if len(task_chunks) <= worker_idx:
-        log.warning(f"Worker {worker_idx} Skipped!")
-        sys.exit(0)
+        # In case of the index being bigger than the number of positions in the array, the extra POD isn't necessary
+        if len(task_chunks) <= worker_idx:
+            log.warning(f"Worker {worker_idx} Skipped!")
+            sys.exit(0)
 
-    log.info(f"Executing worker {worker_idx}")
+        log.info(f"Executing worker {worker_idx}")
 
-    dataset_paths = task_chunks[worker_idx]
-    log.info(f"Worker {worker_idx} to process {len(dataset_paths)} datasets.")
+        dataset_paths = task_chunks[worker_idx]
+        num_datasets = len(dataset_paths)
+        log.info(f"Worker {worker_idx} to process {len(dataset_paths)} datasets.")
 
     failed_tasks = []
     for idx, dataset_path in enumerate(dataset_paths):
+        # Resolved to a Path below for local datasets, the queue task stays the string
+        task = dataset_path
         try:
-            log.info(f"Generating stac file for {dataset_path} {idx + 1}/{len(dataset_paths)}")
+            log.info(f"Generating stac file for {dataset_path} {idx + 1}/{num_datasets}")
 
             # Get the measurement geotiffs that belong to the dataset.
             measurement_files = list(filter(lambda x: dataset_path in x, all_geotiffs))
@@ -223,6 +254,8 @@ def create_stac_files(
                     log.info(
                         f"{stac_item_destination_url} exists! Skipping stac file generation for {dataset_path}"
                     )
+                    if work_queue_dir:
+                        complete_task(work_queue_dir, task)
                     continue
 
             # Dataset docs
@@ -247,6 +280,10 @@ def create_stac_files(
             fs = get_filesystem(str(stac_item_destination_url), anon=False)
             with fs.open(str(stac_item_destination_url), "w") as f:
                 json.dump(stac_item, f, indent=2)  # `indent=4` makes it human-readable
+
+            # Failed datasets are released for the other workers to retry instead
+            if work_queue_dir:
+                complete_task(work_queue_dir, task)
         except Exception as error:
             log.exception(error)
             log.error(f"Failed to generate metedata file for the dataset {dataset_path}")
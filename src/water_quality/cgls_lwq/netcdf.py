@@ -3,6 +3,7 @@ Functions to parse info from Copernicus Global Land Service -
 Lake Water Quality NetCDF files.
 """
 
+import json
 import logging
 import os
 import posixpath
@@ -15,7 +16,14 @@ import rioxarray
 import xarray as xr
 
 from water_quality.cgls_lwq.constants import NAMING_PREFIX
-from water_quality.io import is_local_path
+from water_quality.io import (
+    check_file_exists,
+    create_file_exclusively,
+    get_content_lengths,
+    get_filesystem,
+    is_local_path,
+    join_url,
+)
 
 log = logging.getLogger(__name__)
 
@@ -76,6 +84,7 @@ def parse_netcdf_subdatasets_uri(netcdf_uri: str) -> tuple[str]:
     subdataset_variable = netcdf_uri.split(":")[-1]
 
     netcdf_url = netcdf_uri.removeprefix(f"{driver}:").removesuffix(f":{subdataset_variable}")
+    netcdf_url = netcdf_url.strip('"')
 
     matches = re.search(r"^/vsi[^/]+/", netcdf_url)
     if matches is None:
@@ -105,6 +114,28 @@ def get_netcdf_subdataset_variable(netcdf_uri: str) -> tuple[str]:
     return subdataset_variable
 
 
+def get_netcdf_subdataset_uri(netcdf_url: str, subdataset_variable: str) -> str:
+    """
+    Get the URI of a CGLS Lake Water Quality netcdf subdataset.
+
+    Parameters
+    ----------
+    netcdf_url : str
+        File path or GDAL VSI path of the netcdf file.
+    subdataset_variable : str
+        Name of the subdataset.
+
+    Returns
+    -------
+    str
+        CGLS Lake Water Quality netcdf subdataset URI.
+    """
+    # GDAL only parses paths containing ":" such as /vsicurl/ URLs if quoted
+    if ":" in netcdf_url:
+        netcdf_url = f'"{netcdf_url}"'
+    return f"netcdf:{netcdf_url}:{subdataset_variable}"
+
+
 def get_netcdf_subdatasets_uris(netcdf_url: str) -> dict[str, str]:
     """Get a dictionary mapping a subdatset's name to its URI for all
     subddatasets from a CGLS Lake Water Quality netcdf file
@@ -123,7 +154,14 @@ def get_netcdf_subdatasets_uris(netcdf_url: str) -> dict[str, str]:
     with rasterio.open(netcdf_url, "r") as src:
         subdatasets = src.subdatasets
 
-    netcdf_subdatasets_uris = {get_netcdf_subdataset_variable(i): i for i in subdatasets}
+    netcdf_subdatasets_uris = {}
+    for subdataset_uri in subdatasets:
+        _, vsiprefix, subdataset_url, subdataset_variable = parse_netcdf_subdatasets_uri(
+            subdataset_uri
+        )
+        netcdf_subdatasets_uris[subdataset_variable] = get_netcdf_subdataset_uri(
+            f"{vsiprefix}{subdataset_url}", subdataset_variable
+        )
 
     return netcdf_subdatasets_uris
 
@@ -150,7 +188,67 @@ def get_netcdf_subdatasets_names(netcdf_url: str) -> list[str]:
 def get_netcdf_urls_from_manifest(manifest_file_url: str) -> list[str]:
     # Get all the urls from the manifest file
     r = requests.get(manifest_file_url)
-    all_netcdf_urls = [i.strip() for i in r.text.splitlines()]
+    r.raise_for_status()
+    return parse_netcdf_urls_from_manifest(r.text)
+
+
+def get_netcdf_urls_from_manifest_if_modified(
+    manifest_file_url: str, validators: dict | None = None
+) -> tuple[list[str] | None, dict]:
+    """
+    Get the netcdf urls from a manifest file with a conditional GET, so
+    the manifest is only downloaded again if it has changed.
+
+    Parameters
+    ----------
+    manifest_file_url : str
+        URL of the manifest file.
+    validators : dict | None, optional
+        ETag and Last-Modified headers returned with the manifest last
+        time, by default None to always download the manifest.
+
+    Returns
+    -------
+    tuple[list[str] | None, dict]
+        Netcdf urls in the manifest, or None if the manifest has not
+        changed, and the validators to send with the next request.
+    """
+    headers = {}
+    if validators and validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    r = requests.get(manifest_file_url, headers=headers)
+    r.raise_for_status()
+    if r.status_code == 304:
+        return None, validators
+
+    validators = dict(etag=r.headers.get("ETag"), last_modified=r.headers.get("Last-Modified"))
+    return parse_netcdf_urls_from_manifest(r.text), validators
+
+
+def sort_netcdf_urls_newest_first(netcdf_urls: list[str]) -> list[str]:
+    """Sort CGLS Lake Water Quality netcdf urls from the newest to the oldest date."""
+    return sorted(netcdf_urls, key=lambda url: parse_netcdf_url(url)[2], reverse=True)
+
+
+def parse_netcdf_urls_from_manifest(manifest_text: str) -> list[str]:
+    """
+    Get the sorted, deduplicated netcdf urls listed in the text of a
+    manifest file.
+
+    Parameters
+    ----------
+    manifest_text : str
+        Contents of the manifest file, with one url per line.
+
+    Returns
+    -------
+    list[str]
+        Netcdf urls in the manifest.
+    """
+    all_netcdf_urls = [i.strip() for i in manifest_text.splitlines()]
     all_netcdf_urls = sorted(all_netcdf_urls, key=lambda url: posixpath.basename(url))
 
     # Filter to remove duplicates
@@ -177,6 +275,65 @@ def get_netcdf_urls_from_manifest(manifest_file_url: str) -> list[str]:
     return all_netcdf_urls
 
 
+def get_netcdf_sizes_url(output_dir: str, run_id: str) -> str:
+    """Get the file path of the netcdf file sizes saved for a workflow run."""
+    # Not .json, as the stac files under the output directory are indexed with **/*.json
+    return join_url(output_dir, "netcdf_sizes", f"{run_id}.txt")
+
+
+def _read_netcdf_sizes(sizes_url: str) -> dict[str, int | None]:
+    fs = get_filesystem(sizes_url, anon=False)
+    fs.invalidate_cache(sizes_url)
+    with fs.open(sizes_url, "r") as f:
+        return json.load(f)
+
+
+def get_netcdf_sizes(netcdf_urls: list[str], sizes_url: str | None = None) -> dict[str, int] | None:
+    """
+    Get the size in bytes of CGLS Lake Water Quality netcdf files from the
+    server with concurrent HEAD requests.
+
+    Workers that split the files between them by size must all get the
+    same sizes. If `sizes_url` is given, the first worker of the run saves
+    the sizes there and the other workers load them instead of asking the
+    server again.
+
+    Parameters
+    ----------
+    netcdf_urls : list[str]
+        URLs of the netcdf files.
+    sizes_url : str | None, optional
+        File path to save the sizes for the workflow run in, see
+        `get_netcdf_sizes_url`, by default None
+
+    Returns
+    -------
+    dict[str, int] | None
+        Size of each netcdf file, or None if the server did not report the
+        size of every file.
+    """
+    netcdf_sizes = None
+    if sizes_url is not None and check_file_exists(sizes_url):
+        netcdf_sizes = _read_netcdf_sizes(sizes_url)
+        log.info(f"Loaded the netcdf file sizes for the run from {sizes_url}")
+
+    if netcdf_sizes is None:
+        log.info(f"Getting the size of {len(netcdf_urls)} netcdf files")
+        netcdf_sizes = get_content_lengths(netcdf_urls)
+        if sizes_url is not None:
+            if create_file_exclusively(sizes_url, json.dumps(netcdf_sizes).encode()):
+                log.info(f"Netcdf file sizes for the run written to {sizes_url}")
+            else:
+                netcdf_sizes = _read_netcdf_sizes(sizes_url)
+                log.info("Loaded the netcdf file sizes for the run saved by another worker")
+
+    unknown_urls = [i for i in netcdf_urls if netcdf_sizes.get(i) is None]
+    if unknown_urls:
+        log.warning(f"The server did not report the size of {len(unknown_urls)} netcdf files")
+        return None
+    return {i: netcdf_sizes[i] for i in netcdf_urls}
+
+
 def read_netcdf_url(netcdf_url: str, max_retries: int = 5) -> xr.Dataset | xr.DataArray:
     """
     Read a netcdf url into an xarray object with a retry step.
@@ -0,0 +1,178 @@
+"""
+Plan the Cloud Optimized Geotiffs still to be written for a
+Copernicus Global Land Service - Lake Water Quality product, by comparing
+the COGs expected from the manifest file against the COGs already in the
+cog output directory.
+"""
+
+import logging
+import posixpath
+import warnings
+
+import click
+from rasterio.errors import NotGeoreferencedWarning
+
+from water_quality.cgls_lwq.cog_plan import get_cog_plan_url, write_cog_plan
+from water_quality.cgls_lwq.constants import MANIFEST_FILE_URLS, MEASUREMENTS
+from water_quality.cgls_lwq.download_cogs import get_existing_cog_urls, get_expected_cog_url
+from water_quality.cgls_lwq.netcdf import get_netcdf_urls_from_manifest
+from water_quality.cgls_lwq.skipped_tiles import read_skipped_tiles_manifests
+from water_quality.cgls_lwq.tiles import get_africa_tiles
+from water_quality.logs import setup_logging
+
+# Suppress the warning
+warnings.filterwarnings("ignore", category=NotGeoreferencedWarning)
+
+
+def get_missing_cogs(
+    output_dir: str,
+    netcdf_urls: list[str],
+    measurements: list[str],
+    tile_indices: list[tuple[int, int]],
+    skipped_tiles: dict[str, set[tuple[int, int]]],
+    existing_cog_urls: set[str],
+) -> dict[str, dict[str, list[tuple[int, int]]]]:
+    """
+    Get the COGs expected for a set of netcdf files that are not in the
+    cog output directory, leaving out the tiles skipped for each netcdf file.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory the COG files are written to.
+    netcdf_urls : list[str]
+        URLs of the CGLS Lake Water Quality NetCDF files the COGs are derived from.
+    measurements : list[str]
+        Names of the measurements to write COGs for.
+    tile_indices : list[tuple[int, int]]
+        Tile indices of the COG files.
+    skipped_tiles : dict[str, set[tuple[int, int]]]
+        Indices of the tiles skipped for each netcdf file name, from
+        `read_skipped_tiles_manifests`.
+    existing_cog_urls : set[str]
+        File paths of the existing COG files, from `get_existing_cog_urls`.
+
+    Returns
+    -------
+    dict[str, dict[str, list[tuple[int, int]]]]
+        Indices of the missing tiles for each measurement of each netcdf url,
+        for the netcdf urls with missing COGs only.
+    """
+    missing_cogs = {}
+    for netcdf_url in netcdf_urls:
+        netcdf_skipped_tiles = skipped_tiles.get(posixpath.basename(netcdf_url), set())
+        for measurement_name in measurements:
+            for tile_idx in tile_indices:
+                if tile_idx in netcdf_skipped_tiles:
+                    continue
+                expected_output_cog_url = get_expected_cog_url(
+                    output_dir=output_dir,
+                    source_netcdf_url=netcdf_url,
+                    measurement_name=measurement_name,
+                    tile_index=tile_idx,
+                )
+                if expected_output_cog_url not in existing_cog_urls:
+                    netcdf_missing_cogs = missing_cogs.setdefault(netcdf_url, {})
+                    netcdf_missing_cogs.setdefault(measurement_name, []).append(tile_idx)
+    return missing_cogs
+
+
+@click.command(
+    "plan-cgls-lwq-cogs",
+    help="Plan the Cloud Optimized Geotiffs still to be written for a Copernicus Global "
+    "Land Service Lake Water Quality product, for download-cgls-lwq-cogs --plan-file.",
+    no_args_is_help=True,
+)
+@click.option(
+    "--product-name",
+    type=click.Choice(list(MANIFEST_FILE_URLS.keys()), case_sensitive=True),
+    help="Name of the product to plan the cog files for",
+)
+@click.option(
+    "--cog-output-dir",
+    type=str,
+    help="Directory the cog files are written to",
+)
+@click.option(
+    "--url-filter",
+    default=None,
+    show_default=True,
+    type=str,
+    help="Filter to select netcdf urls to plan cogs for.",
+)
+@click.option(
+    "--plan-file",
+    default=None,
+    type=str,
+    help="File path to write the plan to. Defaults to cog_plan.txt in the cog output directory.",
+)
+def plan_cogs(
+    product_name: str,
+    cog_output_dir: str,
+    url_filter: str,
+    plan_file: str,
+):
+    # Setup logging level
+    setup_logging()
+    log = logging.getLogger(__name__)
+
+    if product_name not in MEASUREMENTS.keys():
+        raise NotImplementedError(
+            f"Required measurements not configured for the product {product_name}"
+        )
+
+    # Read urls available for the product
+    all_netcdf_urls = get_netcdf_urls_from_manifest(MANIFEST_FILE_URLS[product_name])
+    log.info(f"Found {len(all_netcdf_urls)} netcdf urls in the manifest file")
+
+    # Apply filter
+    if url_filter:
+        all_netcdf_urls = [i for i in all_netcdf_urls if url_filter in i]
+        if len(all_netcdf_urls) < 1:
+            raise ValueError(
+                f"No netcdf urls found in manifest file that match the filter '{url_filter}'"
+            )
+        log.info(
+            f"Found {len(all_netcdf_urls)} netcdf urls in the manifest file that match the filter '{url_filter}'"
+        )
+
+    # Define the tiles over Africa
+    if "300m" in all_netcdf_urls[0]:
+        grid_res = 300
+    elif "100m" in all_netcdf_urls[0]:
+        grid_res = 100
+    tile_indices = [tuple(tile_idx) for tile_idx, _ in get_africa_tiles(grid_res)]
+
+    # Tiles with no valid observations are intentionally not written
+    skipped_tiles = read_skipped_tiles_manifests(cog_output_dir)
+
+    log.info(f"Listing the cog files in {cog_output_dir}")
+    existing_cog_urls = get_existing_cog_urls(cog_output_dir, all_netcdf_urls, tile_indices)
+    log.info(f"Found {len(existing_cog_urls)} existing cogs")
+
+    measurements = MEASUREMENTS[product_name]
+    missing_cogs = get_missing_cogs(
+        cog_output_dir,
+        all_netcdf_urls,
+        measurements,
+        tile_indices,
+        skipped_tiles,
+        existing_cog_urls,
+    )
+    num_missing_cogs = sum(
+        len(tiles) for netcdf_cogs in missing_cogs.values() for tiles in netcdf_cogs.values()
+    )
+    log.info(f"Found {num_missing_cogs} missing cogs for {len(missing_cogs)} netcdf files")
+
+    plan_file = plan_file or get_cog_plan_url(cog_output_dir)
+    write_cog_plan(
+        plan_file,
+        product_name,
+        cog_output_dir,
+        missing_cogs,
+        {
+            netcdf_url: skipped_tiles.get(posixpath.basename(netcdf_url), set())
+            for netcdf_url in missing_cogs
+        },
+    )
+    log.info(f"Cog plan written to {plan_file}")
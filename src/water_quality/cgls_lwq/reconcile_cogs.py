@@ -0,0 +1,309 @@
+"""
+Reconcile the datasets expected for a Copernicus Global Land Service -
+Lake Water Quality product with the datasets in the cog output directory,
+reporting the missing datasets and deleting the orphaned ones.
+"""
+
+import logging
+import os
+import posixpath
+import re
+import warnings
+from datetime import datetime
+
+import click
+from rasterio.errors import NotGeoreferencedWarning
+
+from water_quality.cgls_lwq.constants import MANIFEST_FILE_URLS
+from water_quality.cgls_lwq.netcdf import get_netcdf_urls_from_manifest, parse_netcdf_url
+from water_quality.cgls_lwq.skipped_tiles import read_skipped_tiles_manifests
+from water_quality.cgls_lwq.tiles import (
+    get_africa_tiles,
+    get_tile_index_str,
+    get_tile_index_str_tuple,
+)
+from water_quality.io import (
+    DELETE_BATCH_SIZE,
+    delete_files,
+    get_filesystem,
+    is_geotiff,
+    join_url,
+    list_files_under_prefixes,
+)
+from water_quality.logs import setup_logging
+
+# Suppress the warning
+warnings.filterwarnings("ignore", category=NotGeoreferencedWarning)
+
+# Datasets are the directories of the COGs of one tile and date
+DATASET_DIR_PATTERN = re.compile(r"^x\d{3}/y\d{3}/\d{4}/\d{2}/\d{2}$")
+
+# Fraction of the datasets found which can be deleted as orphaned without
+# --force, as more usually means the manifest is incomplete or wrong
+MAX_ORPHANED_DATASETS_FRACTION = 0.01
+
+
+def get_expected_dataset_paths(
+    output_dir: str,
+    netcdf_urls: list[str],
+    tile_indices: list[tuple[int, int]],
+    skipped_tiles: dict[str, set[tuple[int, int]]],
+) -> set[str]:
+    """
+    Get the directories of the datasets expected for a set of netcdf files,
+    in the same form as the directories of the paths from `get_expected_cog_url`.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory the COG files are written to.
+    netcdf_urls : list[str]
+        URLs of the CGLS Lake Water Quality NetCDF files the COGs are derived from.
+    tile_indices : list[tuple[int, int]]
+        Tile indices of the COG files.
+    skipped_tiles : dict[str, set[tuple[int, int]]]
+        Indices of the tiles skipped for each netcdf file name, from
+        `read_skipped_tiles_manifests`. Datasets of skipped tiles are not expected.
+
+    Returns
+    -------
+    set[str]
+        Directories of the expected datasets.
+    """
+    tile_dirs = {
+        tile_idx: get_tile_index_str_tuple(get_tile_index_str(tile_idx))
+        for tile_idx in tile_indices
+    }
+
+    expected_dataset_paths = set()
+    for netcdf_url in netcdf_urls:
+        _, _, date_str, _, _, _, _ = parse_netcdf_url(netcdf_url)
+        date = datetime.strptime(date_str, "%Y%m%d%H%M%S")
+        date_dirs = (str(date.year), f"{date.month:02d}", f"{date.day:02d}")
+
+        netcdf_skipped_tiles = skipped_tiles.get(posixpath.basename(netcdf_url), set())
+        for tile_idx, (tile_index_str_x, tile_index_str_y) in tile_dirs.items():
+            if tile_idx in netcdf_skipped_tiles:
+                continue
+            expected_dataset_paths.add(
+                join_url(output_dir, tile_index_str_x, tile_index_str_y, *date_dirs)
+            )
+    return expected_dataset_paths
+
+
+def get_dataset_path(output_dir: str, file_path: str) -> str | None:
+    """
+    Get the directory of the dataset a file in the cog output directory
+    belongs to, or None if the file is not in a dataset directory.
+    """
+    dataset_path = posixpath.dirname(file_path)
+    relative_path = dataset_path[len(output_dir.rstrip("/")) + 1 :]
+    if DATASET_DIR_PATTERN.match(relative_path):
+        return dataset_path
+    return None
+
+
+def list_dataset_files(output_dir: str) -> set[str]:
+    """
+    List all the files under the tile directories of a cog output directory,
+    listing the tile directories concurrently.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory the COG files are written to.
+
+    Returns
+    -------
+    set[str]
+        File paths found, in the same form as the paths from `get_expected_cog_url`.
+    """
+    fs = get_filesystem(output_dir, anon=True)
+    try:
+        dir_names = [posixpath.basename(i.rstrip("/")) for i in fs.ls(output_dir, detail=False)]
+    except FileNotFoundError:
+        return set()
+
+    prefixes = [join_url(output_dir, i) for i in dir_names if re.match(r"^x\d{3}$", i)]
+    return list_files_under_prefixes(prefixes)
+
+
+def read_dataset_paths(input_file: str) -> set[str]:
+    """Read a list of dataset directories written by `write_dataset_paths`."""
+    with open(input_file) as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def write_dataset_paths(dataset_paths: set[str], output_file: str):
+    """Write a sorted list of dataset directories to a text file, one per line."""
+    with open(output_file, "w") as f:
+        for dataset_path in sorted(dataset_paths):
+            f.write(f"{dataset_path}\n")
+
+
+@click.command(
+    "reconcile-cgls-lwq-cogs",
+    help="Compare the datasets expected for a Copernicus Global Land Service Lake Water "
+    "Quality product with the datasets in the cog output directory, report the missing "
+    "and orphaned datasets and delete the orphaned datasets listed in a reviewed report.",
+    no_args_is_help=True,
+)
+@click.option(
+    "--product-name",
+    type=click.Choice(list(MANIFEST_FILE_URLS.keys()), case_sensitive=True),
+    help="Name of the product to reconcile the cog files for",
+)
+@click.option(
+    "--cog-output-dir",
+    type=str,
+    help="Directory the cog files are written to",
+)
+@click.option(
+    "--report-dir",
+    default=".",
+    show_default=True,
+    type=str,
+    help="Local directory to write the lists of missing and orphaned datasets to.",
+)
+@click.option(
+    "--dryrun/--no-dryrun",
+    default=True,
+    show_default=True,
+    help="Only report the orphaned datasets, without deleting them.",
+)
+@click.option(
+    "--delete-list",
+    default=None,
+    type=str,
+    help="Orphaned datasets file written by a dry run and reviewed. With --no-dryrun only "
+    "the datasets listed in it which are still orphaned are deleted.",
+)
+@click.option(
+    "--force/--no-force",
+    default=False,
+    show_default=True,
+    help="Delete the orphaned datasets even if they are more than "
+    f"{MAX_ORPHANED_DATASETS_FRACTION:.0%} of the datasets found, which usually means the "
+    "manifest is incomplete or wrong.",
+)
+@click.option(
+    "--delete-batch-size",
+    default=DELETE_BATCH_SIZE,
+    show_default=True,
+    type=click.IntRange(1, DELETE_BATCH_SIZE),
+    help="Number of files to delete in each delete request.",
+)
+@click.option(
+    "--delete-workers",
+    default=8,
+    show_default=True,
+    type=int,
+    help="Number of delete requests to send at once.",
+)
+def reconcile_cogs(
+    product_name: str,
+    cog_output_dir: str,
+    report_dir: str,
+    dryrun: bool,
+    delete_list: str,
+    force: bool,
+    delete_batch_size: int,
+    delete_workers: int,
+):
+    # Setup logging level
+    setup_logging()
+    log = logging.getLogger(__name__)
+
+    if not dryrun and delete_list is None:
+        raise click.UsageError(
+            "--no-dryrun deletes the datasets listed in the orphaned datasets file of a "
+            "reviewed dry run, pass it with --delete-list"
+        )
+    if delete_list is not None:
+        # Read before the reports are written, as they may be in the same place
+        reviewed_dataset_paths = read_dataset_paths(delete_list)
+
+    # Read urls available for the product
+    all_netcdf_urls = get_netcdf_urls_from_manifest(MANIFEST_FILE_URLS[product_name])
+    log.info(f"Found {len(all_netcdf_urls)} netcdf urls in the manifest file")
+
+    # Define the tiles over Africa
+    if "300m" in all_netcdf_urls[0]:
+        grid_res = 300
+    elif "100m" in all_netcdf_urls[0]:
+        grid_res = 100
+    tile_indices = [tuple(tile_idx) for tile_idx, _ in get_africa_tiles(grid_res)]
+
+    # Tiles with no valid observations are intentionally not written
+    skipped_tiles = read_skipped_tiles_manifests(cog_output_dir)
+
+    expected_dataset_paths = get_expected_dataset_paths(
+        cog_output_dir, all_netcdf_urls, tile_indices, skipped_tiles
+    )
+    log.info(f"Expecting {len(expected_dataset_paths)} datasets in {cog_output_dir}")
+
+    log.info(f"Listing the files in {cog_output_dir}")
+    existing_dataset_paths = set()
+    orphaned_files = []
+    for file_path in list_dataset_files(cog_output_dir):
+        dataset_path = get_dataset_path(cog_output_dir, file_path)
+        if dataset_path is None:
+            continue
+        if dataset_path not in expected_dataset_paths:
+            orphaned_files.append(file_path)
+        if is_geotiff(file_path):
+            existing_dataset_paths.add(dataset_path)
+    log.info(f"Found {len(existing_dataset_paths)} datasets in {cog_output_dir}")
+
+    missing_dataset_paths = expected_dataset_paths - existing_dataset_paths
+    orphaned_dataset_paths = {posixpath.dirname(i) for i in orphaned_files}
+    log.info(f"Found {len(missing_dataset_paths)} missing datasets")
+    log.info(
+        f"Found {len(orphaned_dataset_paths)} orphaned datasets with {len(orphaned_files)} files"
+    )
+
+    os.makedirs(report_dir, exist_ok=True)
+    missing_datasets_file = os.path.join(report_dir, "missing_datasets.txt")
+    write_dataset_paths(missing_dataset_paths, missing_datasets_file)
+    log.info(f"Missing datasets written to {missing_datasets_file}")
+    orphaned_datasets_file = os.path.join(report_dir, "orphaned_datasets.txt")
+    write_dataset_paths(orphaned_dataset_paths, orphaned_datasets_file)
+    log.info(f"Orphaned datasets written to {orphaned_datasets_file}")
+
+    if dryrun:
+        return
+
+    # Only delete the reviewed datasets, if they are still orphaned
+    deleted_dataset_paths = orphaned_dataset_paths & reviewed_dataset_paths
+    if len(deleted_dataset_paths) < len(reviewed_dataset_paths):
+        log.warning(
+            f"Skipping {len(reviewed_dataset_paths - deleted_dataset_paths)} datasets listed in "
+            f"{delete_list} which are no longer orphaned"
+        )
+    orphaned_files = [i for i in orphaned_files if posixpath.dirname(i) in deleted_dataset_paths]
+    if not orphaned_files:
+        return
+
+    num_dataset_paths = len(existing_dataset_paths | orphaned_dataset_paths)
+    if len(deleted_dataset_paths) > MAX_ORPHANED_DATASETS_FRACTION * num_dataset_paths:
+        if not force:
+            raise click.UsageError(
+                f"Refusing to delete {len(deleted_dataset_paths)} of the {num_dataset_paths} "
+                f"datasets found, check the manifest and pass --force to delete them"
+            )
+        log.warning(
+            f"Deleting {len(deleted_dataset_paths)} of the {num_dataset_paths} datasets found"
+        )
+
+    log.info(
+        f"Deleting {len(orphaned_files)} files in batches of {delete_batch_size}, "
+        f"{delete_workers} batches at a time"
+    )
+    errors = delete_files(
+        sorted(orphaned_files), batch_size=delete_batch_size, max_concurrency=delete_workers
+    )
+    for file_path, error in errors.items():
+        log.error(f"Failed to delete {file_path}: {error}")
+    if errors:
+        raise RuntimeError(f"Failed to delete {len(errors)} files")
+    log.info(f"Deleted {len(deleted_dataset_paths)} orphaned datasets")
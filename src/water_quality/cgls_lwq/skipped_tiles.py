@@ -0,0 +1,132 @@
+"""
+Record the tiles intentionally not written as COGs for a
+Copernicus Global Land Service - Lake Water Quality NetCDF file
+because they contain no valid observations.
+"""
+
+import json
+import logging
+import posixpath
+
+import numpy as np
+import xarray as xr
+
+from water_quality.cgls_lwq.tiles import get_tile_index_int_tuple, get_tile_index_str
+from water_quality.io import (
+    check_directory_exists,
+    create_parent_directory,
+    get_filesystem,
+    join_url,
+)
+
+log = logging.getLogger(__name__)
+
+
+def is_empty_tile(cropped_da: xr.DataArray, nodata: float | int | None) -> bool:
+    """
+    Check if a netcdf subdataset cropped to a tile has no valid pixels.
+
+    Parameters
+    ----------
+    cropped_da : xr.DataArray
+        Netcdf subdataset cropped and masked to the tile extent.
+    nodata : float | int | None
+        Nodata value of the netcdf subdataset.
+
+    Returns
+    -------
+    bool
+        True if every pixel in the tile is nodata or masked.
+    """
+    data = cropped_da.values
+    if np.issubdtype(data.dtype, np.floating):
+        valid = ~np.isnan(data)
+    else:
+        valid = np.ones(data.shape, dtype=bool)
+
+    if nodata is not None and not np.isnan(nodata):
+        valid &= data != nodata
+
+    return not valid.any()
+
+
+def get_skipped_tiles_manifest_url(output_dir: str, netcdf_url: str) -> str:
+    """
+    Get the file path of the skipped tiles manifest for a netcdf file.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory the product's COG files are written to.
+    netcdf_url : str
+        URL or file path of the CGLS LWQ netcdf file.
+
+    Returns
+    -------
+    str
+        File path of the skipped tiles manifest.
+    """
+    netcdf_file_name = posixpath.basename(netcdf_url)
+    return join_url(output_dir, "skipped_tiles", f"{netcdf_file_name}.txt")
+
+
+def write_skipped_tiles_manifest(
+    output_dir: str, netcdf_url: str, skipped_tiles: list[tuple[int, int]]
+) -> str:
+    """
+    Write the indices of the tiles skipped for a netcdf file as a JSON array.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory the product's COG files are written to.
+    netcdf_url : str
+        URL or file path of the CGLS LWQ netcdf file.
+    skipped_tiles : list[tuple[int, int]]
+        Indices of the tiles that were skipped.
+
+    Returns
+    -------
+    str
+        File path the skipped tiles manifest was written to.
+    """
+    manifest_url = get_skipped_tiles_manifest_url(output_dir, netcdf_url)
+
+    create_parent_directory(manifest_url)
+    fs = get_filesystem(manifest_url, anon=False)
+
+    skipped_tiles_str = sorted(get_tile_index_str(tile_idx) for tile_idx in skipped_tiles)
+    with fs.open(manifest_url, "w") as f:
+        f.write(json.dumps(skipped_tiles_str))
+    return manifest_url
+
+
+def read_skipped_tiles_manifests(output_dir: str) -> dict[str, set[tuple[int, int]]]:
+    """
+    Read all the skipped tiles manifests for a product.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory the product's COG files are written to.
+
+    Returns
+    -------
+    dict[str, set[tuple[int, int]]]
+        Mapping of netcdf file name to the indices of the tiles skipped
+        for the netcdf file.
+    """
+    manifests_dir = join_url(output_dir, "skipped_tiles")
+    if not check_directory_exists(manifests_dir):
+        return {}
+
+    fs = get_filesystem(manifests_dir, anon=True)
+
+    skipped_tiles = {}
+    for manifest_path in fs.glob(join_url(manifests_dir, "*.txt")):
+        netcdf_file_name = posixpath.basename(manifest_path).removesuffix(".txt")
+        with fs.open(manifest_path, "r") as f:
+            skipped_tiles[netcdf_file_name] = {get_tile_index_int_tuple(i) for i in json.load(f)}
+
+    log.info(f"Found skipped tiles manifests for {len(skipped_tiles)} netcdf files")
+    return skipped_tiles
@@ -0,0 +1,552 @@
+"""
+Read Copernicus Global Land Service - Lake Water Quality NetCDF
+subdatasets one tile window at a time.
+"""
+
+import json
+import logging
+from collections.abc import Iterator
+
+import numpy as np
+import xarray as xr
+from affine import Affine
+from odc.geo.geobox import GeoBox
+from odc.geo.geom import Geometry
+from odc.geo.roi import roi_is_empty
+from odc.geo.xr import mask
+from rasterio.io import DatasetReader
+from rasterio.windows import Window
+
+from water_quality.cgls_lwq.tiles import get_africa_tiles
+from water_quality.io import (
+    check_file_exists,
+    create_parent_directory,
+    get_filesystem,
+    join_url,
+)
+
+log = logging.getLogger(__name__)
+
+# Minimum number of rows read at once when streaming a subdataset in rows of
+# chunks, for subdatasets stored in chunks of few rows or not chunked
+MIN_BAND_ROWS = 128
+
+
+def get_tile_source_roi(
+    tile_geobox: GeoBox, source_geobox: GeoBox
+) -> tuple[tuple[slice, slice], Geometry]:
+    """
+    Get the region of interest on the source pixel grid covered by a tile.
+
+    Parameters
+    ----------
+    tile_geobox : GeoBox
+        Geobox of the tile to crop the source to.
+    source_geobox : GeoBox
+        Geobox of the CGLS LWQ netcdf subdataset.
+
+    Returns
+    -------
+    tuple[tuple[slice, slice], Geometry]
+        Row and column slices into the source pixel grid and the tile
+        extent in the source crs.
+    """
+    tile_extent = tile_geobox.extent.to_crs(source_geobox.crs)
+
+    # Same pixel selection as `odc.geo.xr.crop`
+    roi = source_geobox.overlap_roi(source_geobox.enclosing(tile_extent))
+    if roi_is_empty(roi):
+        raise ValueError("The tile does not overlap spatially with the source grid.")
+
+    return roi, tile_extent
+
+
+def read_tile_window(
+    src: DatasetReader,
+    da: xr.DataArray,
+    roi: tuple[slice, slice],
+    tile_extent: Geometry,
+) -> xr.DataArray:
+    """
+    Read only the pixels of a CGLS LWQ netcdf subdataset that fall
+    within a tile.
+
+    Parameters
+    ----------
+    src : DatasetReader
+        Open rasterio dataset for the netcdf subdataset.
+    da : xr.DataArray
+        Lazily loaded netcdf subdataset to take the coordinates and
+        attributes of the cropped array from.
+    roi : tuple[slice, slice]
+        Row and column slices into the source pixel grid for the tile.
+    tile_extent : Geometry
+        Tile extent in the source crs, used to mask pixels outside the tile.
+
+    Returns
+    -------
+    xr.DataArray
+        Netcdf subdataset cropped and masked to the tile extent.
+    """
+    data = src.read(1, window=Window.from_slices(*roi))
+    return crop_tile_window(da, data, roi, tile_extent)
+
+
+def crop_tile_window(
+    da: xr.DataArray,
+    data: np.ndarray,
+    roi: tuple[slice, slice],
+    tile_extent: Geometry,
+) -> xr.DataArray:
+    """
+    Wrap the pixels read for a tile window of a CGLS LWQ netcdf subdataset
+    into a data array masked to the tile extent.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Lazily loaded netcdf subdataset to take the coordinates and
+        attributes of the cropped array from.
+    data : np.ndarray
+        Pixels of the subdataset within the tile window.
+    roi : tuple[slice, slice]
+        Row and column slices into the source pixel grid for the tile.
+    tile_extent : Geometry
+        Tile extent in the source crs, used to mask pixels outside the tile.
+
+    Returns
+    -------
+    xr.DataArray
+        Netcdf subdataset cropped and masked to the tile extent.
+    """
+    y_dim, x_dim = da.odc.spatial_dims
+    cropped_da = da.isel({y_dim: roi[0], x_dim: roi[1]}).copy(deep=False, data=data)
+
+    # Mask pixels outside the tile the same way `odc.geo.xr.crop` does
+    cropped_da = mask(cropped_da, tile_extent, all_touched=True)
+    return cropped_da
+
+
+def _merge_intervals(intervals: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """Merge overlapping or touching intervals."""
+    merged = []
+    for start, stop in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def get_band_rows(chunk_rows: int) -> int:
+    """Get the number of rows of the bands of whole chunk rows a subdataset is streamed in."""
+    return chunk_rows * -(-MIN_BAND_ROWS // chunk_rows)
+
+
+def estimate_peak_memory(
+    windows: list[tuple[slice, slice]],
+    chunk_shape: tuple[int, int],
+    itemsize: int,
+) -> int:
+    """
+    Estimate the peak number of bytes held by `read_windows_by_chunk_rows`
+    when reading a set of windows: the buffers of the windows overlapping a
+    band of chunk rows plus the pixels read for the band.
+
+    Parameters
+    ----------
+    windows : list[tuple[slice, slice]]
+        Row and column slices into the source pixel grid of each window.
+    chunk_shape : tuple[int, int]
+        Number of rows and columns of the chunks of the subdataset.
+    itemsize : int
+        Number of bytes of each pixel.
+
+    Returns
+    -------
+    int
+        Upper bound of the bytes held while reading the windows.
+    """
+    if not windows:
+        return 0
+    chunk_rows, chunk_cols = chunk_shape
+    band_rows = get_band_rows(chunk_rows)
+
+    first_bands = np.array([rows.start // band_rows for rows, _ in windows])
+    last_bands = np.array([(rows.stop - 1) // band_rows for rows, _ in windows])
+    window_bytes = np.array(
+        [(rows.stop - rows.start) * (cols.stop - cols.start) * itemsize for rows, cols in windows]
+    )
+    band_read_bytes = np.array(
+        [
+            band_rows
+            * (-(-cols.stop // chunk_cols) - cols.start // chunk_cols)
+            * chunk_cols
+            * itemsize
+            for _, cols in windows
+        ]
+    )
+
+    # Bytes held in each band, each window is held from its first to its last band
+    held_bytes = np.zeros(last_bands.max() + 2, dtype="int64")
+    np.add.at(held_bytes, first_bands, window_bytes + band_read_bytes)
+    np.add.at(held_bytes, last_bands + 1, -(window_bytes + band_read_bytes))
+    return int(np.cumsum(held_bytes).max())
+
+
+def split_windows_into_strips(
+    windows: list[tuple[slice, slice]],
+    chunk_shape: tuple[int, int],
+    itemsize: int,
+    memory_budget: int,
+) -> list[list[int]]:
+    """
+    Split windows into strips of whole columns of windows, from west to
+    east, so each strip can be read with `read_windows_by_chunk_rows` within
+    a memory budget.
+
+    Parameters
+    ----------
+    windows : list[tuple[slice, slice]]
+        Row and column slices into the source pixel grid of each window.
+    chunk_shape : tuple[int, int]
+        Number of rows and columns of the chunks of the subdataset.
+    itemsize : int
+        Number of bytes of each pixel.
+    memory_budget : int
+        Maximum number of bytes to hold while reading a strip.
+
+    Returns
+    -------
+    list[list[int]]
+        Indices of the windows in each strip.
+    """
+    # Windows starting at the same column form a column of windows
+    columns = {}
+    for i, (_, cols) in enumerate(windows):
+        columns.setdefault(cols.start, []).append(i)
+
+    strips = []
+    strip = []
+    max_column_peak_memory = 0
+    for _, column in sorted(columns.items()):
+        max_column_peak_memory = max(
+            max_column_peak_memory,
+            estimate_peak_memory([windows[i] for i in column], chunk_shape, itemsize),
+        )
+        if strip and (
+            estimate_peak_memory([windows[i] for i in strip + column], chunk_shape, itemsize)
+            > memory_budget
+        ):
+            strips.append(strip)
+            strip = []
+        strip = strip + column
+    if strip:
+        strips.append(strip)
+
+    if max_column_peak_memory > memory_budget:
+        log.warning(
+            f"Reading a column of windows needs up to {max_column_peak_memory / 1024**2:.1f} MB, "
+            f"above the memory budget of {memory_budget / 1024**2:.1f} MB"
+        )
+    return strips
+
+
+def read_windows_by_chunk_rows(
+    src: DatasetReader,
+    windows: list[tuple[slice, slice]],
+    memory_budget: int | None = None,
+) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    Read windows of the first band of a netcdf subdataset by streaming the
+    subdataset one row of chunks at a time, so each chunk shared by
+    neighbouring windows is only decompressed once.
+
+    Each row of chunks is read over the chunk-aligned columns of the
+    windows it overlaps and the pixels are copied into the windows, which
+    are handed out as soon as their last row is read.
+
+    Parameters
+    ----------
+    src : DatasetReader
+        Open rasterio dataset for the netcdf subdataset.
+    windows : list[tuple[slice, slice]]
+        Row and column slices into the source pixel grid of each window.
+    memory_budget : int | None, optional
+        Maximum number of bytes to hold while reading. If set, the windows
+        are read in strips of columns of windows, see
+        `split_windows_into_strips`, and the chunks shared by neighbouring
+        strips are decompressed once per strip. By default all the windows
+        are read in one pass.
+
+    Yields
+    ------
+    tuple[int, np.ndarray]
+        Index of the window in `windows` and the pixels of the window, in
+        the order the windows are completed.
+    """
+    if memory_budget is None:
+        yield from _read_windows_by_chunk_rows(src, windows)
+        return
+
+    strips = split_windows_into_strips(
+        windows, src.block_shapes[0], np.dtype(src.dtypes[0]).itemsize, memory_budget
+    )
+    if len(strips) > 1:
+        log.info(f"Reading {len(windows)} windows in {len(strips)} strips")
+    for strip in strips:
+        for i, data in _read_windows_by_chunk_rows(src, [windows[i] for i in strip]):
+            yield strip[i], data
+
+
+def _read_windows_by_chunk_rows(
+    src: DatasetReader, windows: list[tuple[slice, slice]]
+) -> Iterator[tuple[int, np.ndarray]]:
+    """Read windows in a single pass, see `read_windows_by_chunk_rows`."""
+    if not windows:
+        return
+
+    chunk_rows, chunk_cols = src.block_shapes[0]
+    band_rows = get_band_rows(chunk_rows)
+    dtype = np.dtype(src.dtypes[0])
+
+    pending = sorted(range(len(windows)), key=lambda i: windows[i][0].start)
+    next_pending = 0
+    buffers = {}
+    first_row = windows[pending[0]][0].start
+    last_row = max(rows.stop for rows, _ in windows)
+    for band_start in range(first_row // band_rows * band_rows, last_row, band_rows):
+        band_stop = min(band_start + band_rows, src.height)
+
+        # Start filling the windows beginning within the row of chunks
+        while next_pending < len(pending) and windows[pending[next_pending]][0].start < band_stop:
+            rows, cols = windows[pending[next_pending]]
+            buffers[pending[next_pending]] = np.empty(
+                (rows.stop - rows.start, cols.stop - cols.start), dtype=dtype
+            )
+            next_pending += 1
+        if not buffers:
+            continue
+
+        read_rows = (
+            max(band_start, min(windows[i][0].start for i in buffers)),
+            min(band_stop, max(windows[i][0].stop for i in buffers)),
+        )
+        col_intervals = _merge_intervals(
+            [
+                (
+                    windows[i][1].start // chunk_cols * chunk_cols,
+                    min(-(-windows[i][1].stop // chunk_cols) * chunk_cols, src.width),
+                )
+                for i in buffers
+            ]
+        )
+        for col_start, col_stop in col_intervals:
+            data = src.read(1, window=Window.from_slices(read_rows, (col_start, col_stop)))
+            for i, buffer in buffers.items():
+                rows, cols = windows[i]
+                overlap_rows = (max(rows.start, read_rows[0]), min(rows.stop, read_rows[1]))
+                overlap_cols = (max(cols.start, col_start), min(cols.stop, col_stop))
+                if overlap_rows[0] >= overlap_rows[1] or overlap_cols[0] >= overlap_cols[1]:
+                    continue
+                buffer[
+                    overlap_rows[0] - rows.start : overlap_rows[1] - rows.start,
+                    overlap_cols[0] - cols.start : overlap_cols[1] - cols.start,
+                ] = data[
+                    overlap_rows[0] - read_rows[0] : overlap_rows[1] - read_rows[0],
+                    overlap_cols[0] - col_start : overlap_cols[1] - col_start,
+                ]
+
+        for i in sorted(i for i in buffers if windows[i][0].stop <= band_stop):
+            yield i, buffers.pop(i)
+
+
+def read_tile_windows(
+    src: DatasetReader,
+    da: xr.DataArray,
+    tile_tasks: list[tuple],
+    memory_budget: int | None = None,
+) -> Iterator[tuple[tuple, xr.DataArray]]:
+    """
+    Read the tile windows of a CGLS LWQ netcdf subdataset, decompressing
+    each chunk of the subdataset once, see `read_windows_by_chunk_rows`.
+
+    Parameters
+    ----------
+    src : DatasetReader
+        Open rasterio dataset for the netcdf subdataset.
+    da : xr.DataArray
+        Lazily loaded netcdf subdataset to take the coordinates and
+        attributes of the cropped arrays from.
+    tile_tasks : list[tuple]
+        Tile index, source window and tile extent, followed by any other
+        items such as the output COG file path, for each tile to read.
+    memory_budget : int | None, optional
+        Maximum number of bytes of source pixels to hold while reading,
+        by default None for no limit.
+
+    Yields
+    ------
+    tuple[tuple, xr.DataArray]
+        Tile task and the netcdf subdataset cropped and masked to the tile
+        extent, in the order the tiles are completed.
+    """
+    windows = [task[1] for task in tile_tasks]
+    for i, data in read_windows_by_chunk_rows(src, windows, memory_budget):
+        _, roi, tile_extent, *_ = tile_tasks[i]
+        yield tile_tasks[i], crop_tile_window(da, data, roi, tile_extent)
+
+
+def get_tile_window_plan_url(output_dir: str) -> str:
+    """
+    Get the file path of the tile window plan for a product.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory the product's COG files are written to.
+
+    Returns
+    -------
+    str
+        File path of the tile window plan.
+    """
+    return join_url(output_dir, "tile_window_plan.txt")
+
+
+def create_tile_window_plan(tiles: list, source_geobox: GeoBox, grid_res: int | float) -> dict:
+    """
+    Map each tile to its window on the source pixel grid.
+
+    Parameters
+    ----------
+    tiles : list
+        List of tiles, each item contains the tile index and the tile geobox.
+    source_geobox : GeoBox
+        Geobox of the CGLS LWQ netcdf subdatasets.
+    grid_res : int | float
+        Grid resolution the tiles were defined with.
+
+    Returns
+    -------
+    dict
+        Tile window plan containing the source geobox, grid resolution and
+        a list of the tile index, source window and tile extent for each tile.
+    """
+    tile_windows = []
+    for tile_idx, tile_geobox in tiles:
+        roi, tile_extent = get_tile_source_roi(tile_geobox, source_geobox)
+        tile_windows.append((tuple(tile_idx), roi, tile_extent))
+
+    tile_window_plan = dict(source_geobox=source_geobox, grid_res=grid_res, tiles=tile_windows)
+    return tile_window_plan
+
+
+def write_tile_window_plan(tile_window_plan: dict, plan_url: str):
+    """
+    Write a tile window plan to a file as JSON.
+
+    Parameters
+    ----------
+    tile_window_plan : dict
+        Tile window plan to write.
+    plan_url : str
+        File path to write the tile window plan to.
+    """
+    source_geobox = tile_window_plan["source_geobox"]
+    plan_doc = dict(
+        source_geobox=dict(
+            crs=str(source_geobox.crs),
+            shape=list(source_geobox.shape),
+            transform=list(source_geobox.transform)[:6],
+        ),
+        grid_res=tile_window_plan["grid_res"],
+        tiles=[
+            dict(
+                tile_index=list(tile_idx),
+                roi=[[roi[0].start, roi[0].stop], [roi[1].start, roi[1].stop]],
+                tile_extent=tile_extent.json,
+            )
+            for tile_idx, roi, tile_extent in tile_window_plan["tiles"]
+        ],
+    )
+
+    create_parent_directory(plan_url)
+    fs = get_filesystem(plan_url, anon=False)
+    with fs.open(plan_url, "w") as f:
+        json.dump(plan_doc, f)
+
+
+def read_tile_window_plan(plan_url: str) -> dict:
+    """
+    Read a tile window plan written by `write_tile_window_plan`.
+
+    Parameters
+    ----------
+    plan_url : str
+        File path of the tile window plan.
+
+    Returns
+    -------
+    dict
+        Tile window plan.
+    """
+    fs = get_filesystem(plan_url, anon=True)
+    with fs.open(plan_url, "r") as f:
+        plan_doc = json.load(f)
+
+    source_geobox = GeoBox(
+        shape=tuple(plan_doc["source_geobox"]["shape"]),
+        affine=Affine(*plan_doc["source_geobox"]["transform"]),
+        crs=plan_doc["source_geobox"]["crs"],
+    )
+    tile_windows = [
+        (
+            tuple(tile["tile_index"]),
+            (slice(*tile["roi"][0]), slice(*tile["roi"][1])),
+            Geometry(tile["tile_extent"], crs=source_geobox.crs),
+        )
+        for tile in plan_doc["tiles"]
+    ]
+    tile_window_plan = dict(
+        source_geobox=source_geobox, grid_res=plan_doc["grid_res"], tiles=tile_windows
+    )
+    return tile_window_plan
+
+
+def get_tile_window_plan(plan_url: str, source_geobox: GeoBox, grid_res: int | float) -> dict:
+    """
+    Load the tile window plan for a product if it exists and matches the
+    source grid, otherwise compute it from the tiles over Africa and
+    persist it for reuse.
+
+    Parameters
+    ----------
+    plan_url : str
+        File path of the tile window plan.
+    source_geobox : GeoBox
+        Geobox of the CGLS LWQ netcdf subdatasets.
+    grid_res : int | float
+        Grid resolution of the tiles over Africa.
+
+    Returns
+    -------
+    dict
+        Tile window plan.
+    """
+    if check_file_exists(plan_url):
+        tile_window_plan = read_tile_window_plan(plan_url)
+        if (
+            tile_window_plan["source_geobox"] == source_geobox
+            and tile_window_plan["grid_res"] == grid_res
+        ):
+            log.info(f"Loaded tile window plan from {plan_url}")
+            return tile_window_plan
+        else:
+            log.warning(f"Tile window plan {plan_url} does not match the source grid")
+
+    tiles = get_africa_tiles(grid_res)
+    tile_window_plan = create_tile_window_plan(tiles, source_geobox, grid_res)
+    write_tile_window_plan(tile_window_plan, plan_url)
+    log.info(f"Tile window plan for {len(tiles)} tiles written to {plan_url}")
+    return tile_window_plan
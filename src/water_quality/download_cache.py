@@ -0,0 +1,202 @@
+"""
+Size-bounded cache of downloaded files shared between the processes
+on a node, with file locking and least recently used eviction.
+
+Each URL gets its own entry directory in the cache, named after the
+SHA-256 hash of the URL, holding the downloaded file and a lock file.
+As entries are keyed by URL and not by content, the cached file is
+revalidated with the server on every hit (see `download_file_to_cache`)
+and replaced in its entry when it has changed.
+Processes hold a shared lock on an entry while they use the file and
+an exclusive lock while they download it, so an entry is never evicted
+or replaced while in use. The modification time of the lock file
+records when the entry was last used.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import posixpath
+import shutil
+from typing import TextIO
+
+log = logging.getLogger(__name__)
+
+LOCK_FILE_NAME = ".lock"
+
+
+def get_cache_entry_dir(cache_dir: str, url: str) -> str:
+    """
+    Get the directory of the cache entry for a URL.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Local directory of the cache.
+    url : str
+        URL of the cached file.
+
+    Returns
+    -------
+    str
+        Directory of the cache entry.
+    """
+    url_hash = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(cache_dir, "entries", url_hash[:2], url_hash)
+
+
+def get_cached_file_path(cache_dir: str, url: str) -> str:
+    """
+    Get the file path a URL is downloaded to in the cache.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Local directory of the cache.
+    url : str
+        URL of the cached file.
+
+    Returns
+    -------
+    str
+        File path of the cached file.
+    """
+    return os.path.join(get_cache_entry_dir(cache_dir, url), posixpath.basename(url))
+
+
+def get_cache_ledger_path(cache_dir: str) -> str:
+    """Get the file path of the download ledger for the files in the cache."""
+    return os.path.join(cache_dir, "download_ledger.db")
+
+
+def _lock(lock_file_path: str, operation: int) -> TextIO | None:
+    """Lock a file, making sure the lock is held on the file currently at
+    `lock_file_path` and not on one removed by an eviction in the meantime.
+    Returns None if `operation` is non-blocking and the lock is held elsewhere."""
+    while True:
+        os.makedirs(os.path.dirname(lock_file_path), exist_ok=True)
+        lock_file = open(lock_file_path, "a")
+        try:
+            fcntl.flock(lock_file, operation)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_file_path).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+
+def lock_cache_entry(file_path: str, exclusive: bool = False) -> TextIO:
+    """
+    Lock the cache entry of a cached file and mark it as recently used.
+
+    Parameters
+    ----------
+    file_path : str
+        File path of the cached file.
+    exclusive : bool, optional
+        If True, take an exclusive lock to download or replace the file,
+        otherwise a shared lock to read it, by default False
+
+    Returns
+    -------
+    TextIO
+        Open lock file holding the lock, to pass to `release_cache_entry`.
+    """
+    lock_file_path = os.path.join(os.path.dirname(file_path), LOCK_FILE_NAME)
+    lock_file = _lock(lock_file_path, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    os.utime(lock_file_path)
+    return lock_file
+
+
+def share_cache_entry_lock(lock_file: TextIO):
+    """Downgrade an exclusive lock on a cache entry to a shared lock."""
+    fcntl.flock(lock_file, fcntl.LOCK_SH)
+
+
+def release_cache_entry(lock_file: TextIO):
+    """Release the lock on a cache entry taken by `lock_cache_entry`."""
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+
+def _get_directory_size(directory: str) -> int:
+    size = 0
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file_name))
+            except FileNotFoundError:
+                continue
+    return size
+
+
+def evict_cache_entries(cache_dir: str, max_size: int, reserve: int = 0) -> int:
+    """
+    Remove the least recently used entries not in use by any process
+    until the cache, plus the space to reserve, fits within `max_size`.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Local directory of the cache.
+    max_size : int
+        Maximum size of the cache in bytes.
+    reserve : int, optional
+        Number of bytes to free up for a file about to be downloaded, by default 0
+
+    Returns
+    -------
+    int
+        Number of bytes freed.
+    """
+    entries_dir = os.path.join(cache_dir, "entries")
+    if not os.path.exists(entries_dir):
+        return 0
+
+    # Only one process evicts at a time so the cache size is not double counted
+    eviction_lock = _lock(os.path.join(cache_dir, ".eviction.lock"), fcntl.LOCK_EX)
+    try:
+        entries = []
+        for prefix in os.listdir(entries_dir):
+            for url_hash in os.listdir(os.path.join(entries_dir, prefix)):
+                entry_dir = os.path.join(entries_dir, prefix, url_hash)
+                lock_file_path = os.path.join(entry_dir, LOCK_FILE_NAME)
+                try:
+                    last_used = os.path.getmtime(lock_file_path)
+                except FileNotFoundError:
+                    last_used = 0
+                entries.append((last_used, entry_dir, _get_directory_size(entry_dir)))
+
+        cache_size = sum(size for _, _, size in entries)
+        freed = 0
+        for _, entry_dir, size in sorted(entries):
+            if cache_size + reserve - freed <= max_size:
+                break
+
+            lock_file = _lock(
+                os.path.join(entry_dir, LOCK_FILE_NAME), fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+            if lock_file is None:
+                # In use by another process
+                continue
+            try:
+                shutil.rmtree(entry_dir)
+            finally:
+                release_cache_entry(lock_file)
+            freed += size
+            log.info(f"Evicted {entry_dir} from the cache, freeing {size / 1024**3:.2f} GB")
+    finally:
+        release_cache_entry(eviction_lock)
+
+    if cache_size + reserve - freed > max_size:
+        log.warning(
+            f"Cache {cache_dir} exceeds its {max_size / 1024**3:.1f} GB limit, "
+            "the remaining entries are in use"
+        )
+    return freed
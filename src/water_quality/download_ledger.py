@@ -0,0 +1,124 @@
+"""
+Keep a local ledger of the files downloaded from URLs, with their
+checksum and the validators (ETag, Last-Modified, Content-Length)
+returned by the server, so unchanged files are not downloaded twice.
+"""
+
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+LEDGER_COLUMNS = [
+    "url",
+    "file_path",
+    "sha256",
+    "etag",
+    "last_modified",
+    "content_length",
+    "downloaded_at",
+]
+
+
+def _connect(ledger_path: str) -> sqlite3.Connection:
+    parent_dir = os.path.dirname(os.path.abspath(ledger_path))
+    os.makedirs(parent_dir, exist_ok=True)
+
+    # Wait for other threads or processes writing to the ledger
+    connection = sqlite3.connect(ledger_path, timeout=60)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS downloads (
+            url TEXT PRIMARY KEY,
+            file_path TEXT,
+            sha256 TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            content_length INTEGER,
+            downloaded_at TEXT
+        )
+        """
+    )
+    return connection
+
+
+def get_download_ledger_entry(ledger_path: str, url: str) -> dict | None:
+    """
+    Get the ledger entry for the last download of a URL.
+
+    Parameters
+    ----------
+    ledger_path : str
+        File path of the download ledger.
+    url : str
+        URL the file was downloaded from.
+
+    Returns
+    -------
+    dict | None
+        Ledger entry for the URL or None if the URL has not been downloaded.
+    """
+    if not os.path.exists(ledger_path):
+        return None
+
+    connection = _connect(ledger_path)
+    try:
+        row = connection.execute(
+            f"SELECT {', '.join(LEDGER_COLUMNS)} FROM downloads WHERE url = ?", (url,)
+        ).fetchone()
+    finally:
+        connection.close()
+
+    if row is None:
+        return None
+    else:
+        return dict(zip(LEDGER_COLUMNS, row))
+
+
+def record_download(
+    ledger_path: str,
+    url: str,
+    file_path: str,
+    sha256: str,
+    etag: str | None,
+    last_modified: str | None,
+    content_length: int,
+):
+    """
+    Record a completed download in the ledger, replacing any previous
+    entry for the URL.
+
+    Parameters
+    ----------
+    ledger_path : str
+        File path of the download ledger.
+    url : str
+        URL the file was downloaded from.
+    file_path : str
+        File path the file was downloaded to.
+    sha256 : str
+        SHA-256 checksum of the downloaded file.
+    etag : str | None
+        ETag header returned by the server.
+    last_modified : str | None
+        Last-Modified header returned by the server.
+    content_length : int
+        Size of the downloaded file in bytes.
+    """
+    connection = _connect(ledger_path)
+    try:
+        with connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO downloads ({', '.join(LEDGER_COLUMNS)}) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    os.path.abspath(file_path),
+                    sha256,
+                    etag,
+                    last_modified,
+                    content_length,
+                    datetime.now(timezone.utc).isoformat(),
+                ),
+            )
+    finally:
+        connection.close()
@@ -2,15 +2,25 @@
 Utilities for interacting with local, cloud (S3, GCS), and HTTP filesystems
 """
 
+import asyncio
+import hashlib
+import json
 import logging
 import os
 import posixpath
 import re
+import shutil
+import tempfile
+from collections import deque
+from collections.abc import Iterable
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from email.utils import parsedate_to_datetime
+from typing import TextIO
 from urllib.parse import urlparse
 
 import fsspec
 import requests
+from fsspec.asyn import AsyncFileSystem, sync
 from fsspec.implementations.http import HTTPFileSystem
 from fsspec.implementations.local import LocalFileSystem
 from gcsfs import GCSFileSystem
@@ -18,27 +28,73 @@ from odc.aws import s3_url_parse
 from s3fs.core import S3FileSystem
 from tqdm import tqdm
 
+from water_quality.download_cache import (
+    evict_cache_entries,
+    get_cache_ledger_path,
+    get_cached_file_path,
+    lock_cache_entry,
+    release_cache_entry,
+    share_cache_entry_lock,
+)
+from water_quality.download_ledger import get_download_ledger_entry, record_download
+
 log = logging.getLogger(__name__)
 
+# GDAL configuration for reading windows of remote files over HTTP with /vsicurl/
+GDAL_VSICURL_CONFIG = dict(
+    # Fetch the byte ranges of a window in as few requests as possible
+    GDAL_HTTP_MULTIRANGE="YES",
+    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES="YES",
+    GDAL_HTTP_MULTIPLEX="YES",
+    GDAL_HTTP_VERSION="2",
+    CPL_VSIL_CURL_CHUNK_SIZE=str(2 * 1024**2),
+    CPL_VSIL_CURL_CACHE_SIZE=str(512 * 1024**2),
+    VSI_CACHE="TRUE",
+    VSI_CACHE_SIZE=str(512 * 1024**2),
+    # Do not list the server directory or probe for sidecar files
+    GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS=".nc",
+    GDAL_HTTP_MAX_RETRY="5",
+    GDAL_HTTP_RETRY_DELAY="1",
+)
+
+# Part size and number of parts in flight for multipart uploads of files held in memory
+UPLOAD_PART_SIZE = 8 * 1024**2
+UPLOAD_MAX_CONCURRENCY = 8
+
+# Maximum number of keys in one S3 multi-object delete request
+DELETE_BATCH_SIZE = 1000
+
+
+S3_SCHEMES = ("s3", "s3a")
+GCS_SCHEMES = ("gs", "gcs")
+HTTP_SCHEMES = ("http", "https")
+LOCAL_SCHEMES = ("", "file", "local")
+
+
+def get_url_scheme(path: str) -> str:
+    """Get the lower case scheme of a URL, or an empty string for a local path."""
+    scheme = urlparse(path).scheme.lower()
+    # Windows drive letters are parsed as a single letter scheme
+    if len(scheme) == 1:
+        return ""
+    return scheme
+
 
 def is_s3_path(path: str) -> bool:
-    fs, _ = fsspec.core.url_to_fs(path)
-    return isinstance(fs, S3FileSystem)
+    return get_url_scheme(path) in S3_SCHEMES
 
 
 def is_gcsfs_path(path: str) -> bool:
-    fs, _ = fsspec.core.url_to_fs(path)
-    return isinstance(fs, GCSFileSystem)
+    return get_url_scheme(path) in GCS_SCHEMES
 
 
 def is_http_url(path: str) -> bool:
-    fs, _ = fsspec.core.url_to_fs(path)
-    return isinstance(fs, HTTPFileSystem)
+    return get_url_scheme(path) in HTTP_SCHEMES
 
 
 def is_local_path(path: str) -> bool:
-    fs, _ = fsspec.core.url_to_fs(path)
-    return isinstance(fs, LocalFileSystem)
+    return get_url_scheme(path) in LOCAL_SCHEMES
 
 
 def join_url(base, *paths) -> str:
@@ -49,26 +105,56 @@ def join_url(base, *paths) -> str:
         return posixpath.join(base, *paths)
 
 
+# Filesystem instances keyed by protocol and anon, reused so connection pools
+# and credentials are kept across calls
+_filesystems = {}
+_filesystems_pid = os.getpid()
+
+
 def get_filesystem(
     path: str,
     anon: bool = True,
 ) -> S3FileSystem | LocalFileSystem | GCSFileSystem:
+    global _filesystems_pid
+    # Instances created before a fork are not safe to use in the child process
+    if _filesystems_pid != os.getpid():
+        _filesystems.clear()
+        _filesystems_pid = os.getpid()
+
     if is_s3_path(path=path):
+        protocol = "s3"
+    elif is_gcsfs_path(path=path):
+        protocol = "gcs"
+    elif is_http_url(path):
+        protocol = "http"
+    elif is_local_path(path=path):
+        protocol = "file"
+    else:
+        fs, _ = fsspec.core.url_to_fs(path)
+        return fs
+
+    key = (protocol, anon)
+    fs = _filesystems.get(key)
+    if fs is not None:
+        return fs
+
+    if protocol == "s3":
         fs = S3FileSystem(
             anon=anon,
             # Use profile only on sandbox
             # profile="default",
             s3_additional_kwargs={"ACL": "bucket-owner-full-control"},
         )
-    elif is_gcsfs_path(path=path):
+    elif protocol == "gcs":
         if anon:
             fs = GCSFileSystem(token="anon")
         else:
             fs = GCSFileSystem()
-    elif is_http_url(path):
+    elif protocol == "http":
         fs = HTTPFileSystem()
-    elif is_local_path(path=path):
+    elif protocol == "file":
         fs = LocalFileSystem()
+    _filesystems[key] = fs
     return fs
 
 
@@ -88,6 +174,76 @@ def check_directory_exists(path: str) -> bool:
         return False
 
 
+# Directories created or seen by this process, so each is only created once
+_known_directories = set()
+
+
+def create_directory(path: str):
+    """
+    Create a directory and its parents if they do not exist.
+
+    Directories already created or seen by this process are skipped
+    without a round trip. Object stores such as S3 and GCS have no
+    directories, so nothing is created for them.
+
+    Parameters
+    ----------
+    path : str
+        Directory to create.
+    """
+    if path in _known_directories:
+        return
+
+    if is_local_path(path):
+        os.makedirs(path, exist_ok=True)
+    _known_directories.add(path)
+
+
+def create_parent_directory(file_path: str):
+    """Create the parent directory of a file if it does not exist, see `create_directory`."""
+    if is_local_path(file_path):
+        create_directory(os.path.dirname(os.path.abspath(file_path)))
+    else:
+        create_directory(posixpath.dirname(file_path))
+
+
+def create_file_exclusively(file_url: str, data: bytes) -> bool:
+    """
+    Write a file only if it does not exist yet, returning whether it was
+    written. The file is created atomically on local and shared
+    filesystems and with a conditional write on S3, so of several workers
+    writing the same file exactly one wins. On other object stores the
+    last writer wins.
+    """
+    create_parent_directory(file_url)
+    fs = get_filesystem(file_url, anon=False)
+
+    if is_local_path(file_url):
+        # Link a complete temporary file so the file is never read half written
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(file_url), delete=False) as f:
+            f.write(data)
+        try:
+            os.link(f.name, file_url)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(f.name)
+        return True
+
+    if isinstance(fs, S3FileSystem):
+        try:
+            fs.pipe_file(file_url, data, mode="create")
+        except OSError:
+            # Precondition failed, another worker wrote the file first
+            return False
+        return True
+
+    if fs.exists(file_url):
+        return False
+    fs.pipe_file(file_url, data)
+    return True
+
+
 def check_file_extension(path: str, accepted_file_extensions: list[str]) -> bool:
     _, file_extension = os.path.splitext(path)
     if file_extension.lower() in accepted_file_extensions:
@@ -154,9 +310,281 @@ def find_json_files(directory_path: str, file_name_pattern: str = ".*") -> list[
     return json_file_paths
 
 
-def download_file_from_url(url: str, output_file_path: str, chunks: int = 100) -> str:
+def list_files_under_prefixes(prefixes: list[str], max_workers: int = 16) -> set[str]:
+    """
+    List all the files under a set of directory prefixes concurrently, with
+    one recursive listing per prefix.
+
+    Parameters
+    ----------
+    prefixes : list[str]
+        Directory prefixes to list the files under. Prefixes that do not
+        exist are ignored.
+    max_workers : int, optional
+        Maximum number of prefixes to list at once, by default 16
+
+    Returns
+    -------
+    set[str]
+        File paths found, in the same form as the prefixes they were found
+        under so they can be compared with paths built with `join_url`.
+    """
+    if not prefixes:
+        return set()
+
+    fs = get_filesystem(prefixes[0], anon=True)
+
+    def _list_prefix(prefix: str) -> list[str]:
+        stripped_prefix = fs._strip_protocol(prefix).rstrip("/")
+        file_paths = []
+        for file_path in fs.find(prefix):
+            if file_path.startswith(f"{stripped_prefix}/"):
+                file_paths.append(prefix.rstrip("/") + file_path[len(stripped_prefix) :])
+        return file_paths
+
+    file_paths = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for prefix_file_paths in executor.map(_list_prefix, prefixes):
+            file_paths.update(prefix_file_paths)
+    return file_paths
+
+
+def get_download_checkpoint_paths(output_file_path: str) -> tuple[str, str]:
+    """
+    Get the file paths of the partial file and the checkpoint sidecar
+    used while downloading to a local file.
+
+    Parameters
+    ----------
+    output_file_path : str
+        File path the download is written to once complete.
+
+    Returns
+    -------
+    tuple[str, str]
+        File paths of the partial file and the checkpoint sidecar.
+    """
+    return f"{output_file_path}.part", f"{output_file_path}.part.json"
+
+
+def _get_response_validators(headers) -> dict:
+    return dict(etag=headers.get("ETag"), last_modified=headers.get("Last-Modified"))
+
+
+def _read_download_checkpoint(checkpoint_file_path: str) -> dict | None:
+    if not os.path.exists(checkpoint_file_path):
+        return None
+    try:
+        with open(checkpoint_file_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        log.warning(f"Ignoring unreadable download checkpoint {checkpoint_file_path}")
+        return None
+
+
+def _write_download_checkpoint(checkpoint_file_path: str, checkpoint: dict):
+    # Replace the sidecar in one step so it is never left half written
+    tmp_file_path = f"{checkpoint_file_path}.tmp"
+    with open(tmp_file_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file_path, checkpoint_file_path)
+
+
+def _merge_byte_ranges(byte_ranges: list) -> list[list[int]]:
+    """Merge overlapping or adjacent inclusive byte ranges."""
+    merged = []
+    for start, end in sorted(byte_ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _get_missing_byte_ranges(
+    total: int, completed_ranges: list, range_size: int
+) -> list[tuple[int, int]]:
+    """Split the bytes of a file not covered by `completed_ranges` into ranges of at
+    most `range_size` bytes."""
+    missing_ranges = []
+    position = 0
+    for start, end in _merge_byte_ranges(completed_ranges) + [[total, total]]:
+        for range_start in range(position, start, range_size):
+            missing_ranges.append((range_start, min(range_start + range_size, start) - 1))
+        position = max(position, end + 1)
+    return missing_ranges
+
+
+def _finalise_download(
+    part_file_path: str, checkpoint_file_path: str, output_file_path: str, total: int
+):
+    """Move a complete partial file to its final path."""
+    size = os.path.getsize(part_file_path)
+    if total and size != total:
+        raise RuntimeError(
+            f"Downloaded {size} of {total} bytes to {part_file_path}, keeping the partial file"
+        )
+    os.replace(part_file_path, output_file_path)
+    if os.path.exists(checkpoint_file_path):
+        os.remove(checkpoint_file_path)
+
+
+def _get_file_sha256(file_path: str, size: int | None = None, chunks: int = 100):
+    """Hash the first `size` bytes of a local file, or the whole file if `size` is None."""
+    hasher = hashlib.sha256()
+    remaining = os.path.getsize(file_path) if size is None else size
+    with open(file_path, "rb") as f:
+        while remaining > 0:
+            block = f.read(min(chunks * 1024**2, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+def is_unchanged_since_download(
+    url: str,
+    output_file_path: str,
+    ledger_path: str,
+    session: requests.Session | None = None,
+) -> bool:
+    """
+    Check if a file previously downloaded to `output_file_path` is still
+    current, using a conditional GET with the ETag and Last-Modified
+    headers recorded in the download ledger.
+
+    Parameters
+    ----------
+    url : str
+        URL the file was downloaded from.
+    output_file_path : str
+        Local file path the file was downloaded to.
+    ledger_path : str
+        File path of the download ledger.
+    session : requests.Session | None, optional
+        Session to send the request with, by default a new connection.
+
+    Returns
+    -------
+    bool
+        True if the local file matches the ledger and the server reports
+        the file has not been modified since it was downloaded.
+    """
+    if not os.path.exists(output_file_path):
+        return False
+
+    entry = get_download_ledger_entry(ledger_path, url)
+    if (
+        entry is None
+        or entry["file_path"] != os.path.abspath(output_file_path)
+        or entry["content_length"] != os.path.getsize(output_file_path)
+    ):
+        return False
+
+    headers = {}
+    if entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    if entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    if not headers:
+        return False
+
+    # Only the status is needed, the body is not read if the file has changed
+    with (session or requests).get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        return r.status_code == 304
+
+
+def _stream_to_part_file(
+    url: str,
+    headers: dict,
+    resume_from: int,
+    part_file_path: str,
+    checkpoint_file_path: str,
+    output_file_path: str,
+    chunks: int,
+):
+    """
+    Stream a file from a URL to its partial file, resuming from
+    `resume_from` if the server answers the Range request with a partial
+    response, and keep the checkpoint sidecar up to date.
+
+    Returns the SHA-256 hasher of the whole file, its size and the
+    server's validators.
+    """
+    r = requests.get(url, headers=headers, stream=True)
+    if r.status_code == 416:
+        # The partial file does not fit the file on the server, start over
+        r.close()
+        log.warning(f"Server rejected resuming {url} from byte {resume_from}, downloading again")
+        r = requests.get(url, stream=True)
+
+    with r:
+        r.raise_for_status()
+        if r.status_code == 206:
+            log.info(f"Resuming download of {url} from byte {resume_from}")
+            total = int(r.headers["Content-Range"].split("/")[-1])
+            mode = "r+b"
+            # Carry on the checksum from the bytes already on disk
+            hasher = _get_file_sha256(part_file_path, size=resume_from, chunks=chunks)
+        else:
+            resume_from = 0
+            total = int(r.headers.get("content-length", 0))
+            mode = "wb"
+            hasher = hashlib.sha256()
+
+        validators = _get_response_validators(r.headers)
+        checkpoint = dict(
+            url=url,
+            content_length=total,
+            **validators,
+            completed_ranges=[[0, resume_from - 1]] if resume_from else [],
+        )
+        _write_download_checkpoint(checkpoint_file_path, checkpoint)
+
+        with open(part_file_path, mode) as f:
+            f.seek(resume_from)
+            f.truncate()
+            with tqdm(
+                desc=output_file_path,
+                total=total,
+                initial=resume_from,
+                unit="B",
+                unit_scale=True,
+                unit_divisor=1024,
+            ) as bar:
+                position = resume_from
+                for chunk in r.iter_content(chunk_size=chunks * 1024**2):
+                    size = f.write(chunk)
+                    f.flush()
+                    hasher.update(chunk)
+                    position += size
+                    bar.update(size)
+                    checkpoint["completed_ranges"] = [[0, position - 1]]
+                    _write_download_checkpoint(checkpoint_file_path, checkpoint)
+    return hasher, total, validators
+
+
+def download_file_from_url(
+    url: str, output_file_path: str, chunks: int = 100, ledger_path: str | None = None
+) -> str:
     """Download a file from a URL
 
+    Local downloads are written to a `.part` file alongside a checkpoint
+    sidecar recording the bytes received and the server's ETag and
+    Last-Modified headers. An interrupted download is resumed from the
+    checkpoint with a Range request, and the partial file is only renamed
+    to `output_file_path` once its size matches the size of the remote file.
+    A partial file the checkpoint shows is complete is renamed without a
+    request, and one the server refuses to resume is downloaded again.
+
+    A SHA-256 checksum is computed while the file is streamed. If a
+    `ledger_path` is given, the checksum and the server's validators are
+    recorded in the download ledger, and a file already downloaded to
+    `output_file_path` is only downloaded again if a conditional GET shows
+    it has changed on the server.
+
     Parameters
     ----------
     url : str
@@ -165,37 +593,815 @@ def download_file_from_url(url: str, output_file_path: str, chunks: int = 100) -
         File path to download to.
     chunks : int, optional
         Chunk size in MB, by default 100
+    ledger_path : str | None, optional
+        File path of the local download ledger, by default None
 
     Returns
     -------
     str
         The file path the file has been downloaded to.
     """
-    fs = get_filesystem(output_file_path, anon=False)
+    create_parent_directory(output_file_path)
+
+    if not is_local_path(output_file_path):
+        fs = get_filesystem(output_file_path, anon=False)
+        with requests.get(url, stream=True) as r:
+            r.raise_for_status()
+            total = int(r.headers.get("content-length", 0))
+            with fs.open(output_file_path, "wb") as f:
+                with tqdm(
+                    desc=output_file_path,
+                    total=total,
+                    unit="B",
+                    unit_scale=True,
+                    unit_divisor=1024,
+                ) as bar:
+                    for chunk in r.iter_content(chunk_size=chunks * 1024**2):
+                        size = f.write(chunk)
+                        bar.update(size)
+        return output_file_path
+
+    if ledger_path is not None and is_unchanged_since_download(url, output_file_path, ledger_path):
+        log.info(f"{url} is unchanged since it was downloaded to {output_file_path}")
+        return output_file_path
+
+    part_file_path, checkpoint_file_path = get_download_checkpoint_paths(output_file_path)
+
+    # Resume from the bytes received so far only if the file has not
+    # changed on the server since, which If-Range checks for us.
+    headers = {}
+    resume_from = 0
+    checkpoint = _read_download_checkpoint(checkpoint_file_path)
+    if checkpoint and os.path.exists(part_file_path):
+        completed_ranges = _merge_byte_ranges(checkpoint["completed_ranges"])
+        validator = checkpoint.get("etag") or checkpoint.get("last_modified")
+        if completed_ranges and completed_ranges[0][0] == 0 and validator:
+            resume_from = completed_ranges[0][1] + 1
+            headers = {"Range": f"bytes={resume_from}-", "If-Range": validator}
+
+    if resume_from and resume_from == checkpoint["content_length"]:
+        # Stopped after receiving the last byte but before moving the partial file
+        log.info(f"{part_file_path} is complete, finishing the download of {url}")
+        total = resume_from
+        validators = dict(
+            etag=checkpoint.get("etag"), last_modified=checkpoint.get("last_modified")
+        )
+        hasher = _get_file_sha256(part_file_path, size=total, chunks=chunks)
+    else:
+        hasher, total, validators = _stream_to_part_file(
+            url,
+            headers,
+            resume_from,
+            part_file_path,
+            checkpoint_file_path,
+            output_file_path,
+            chunks,
+        )
+
+    _finalise_download(part_file_path, checkpoint_file_path, output_file_path, total)
+    if ledger_path is not None:
+        record_download(
+            ledger_path,
+            url,
+            output_file_path,
+            sha256=hasher.hexdigest(),
+            content_length=os.path.getsize(output_file_path),
+            **validators,
+        )
+    return output_file_path
+
+
+def get_http_session(connections: int = 1) -> requests.Session:
+    """Get a requests session with a connection pool sized for `connections` threads."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=connections, pool_maxsize=connections, max_retries=3
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    # Create the parent directories if they do not exist
-    parent_dir = fs._parent(output_file_path)
-    if not check_directory_exists(parent_dir):
-        fs.makedirs(parent_dir, exist_ok=True)
 
-    with requests.get(url, stream=True) as r:
+def _download_byte_range(
+    session: requests.Session,
+    url: str,
+    output_file_path: str,
+    byte_range: tuple[int, int],
+    chunks: int,
+    bar: tqdm,
+) -> int:
+    """Download the inclusive `byte_range` of a file into the same offsets of a local file."""
+    start, end = byte_range
+    headers = {"Range": f"bytes={start}-{end}"}
+    with session.get(url, headers=headers, stream=True) as r:
         r.raise_for_status()
-        total = int(r.headers.get("content-length", 0))
-        with fs.open(output_file_path, "wb") as f:
-            with tqdm(
+        if r.status_code != 206:
+            raise RuntimeError(f"Server did not return a partial response for range {start}-{end}")
+        written = 0
+        with open(output_file_path, "r+b") as f:
+            f.seek(start)
+            for chunk in r.iter_content(chunk_size=chunks * 1024**2):
+                size = f.write(chunk)
+                written += size
+                bar.update(size)
+
+    if written != end - start + 1:
+        raise RuntimeError(
+            f"Expected {end - start + 1} bytes for range {start}-{end}, got {written}"
+        )
+    return written
+
+
+def download_file_from_url_in_ranges(
+    url: str,
+    output_file_path: str,
+    connections: int = 8,
+    chunks: int = 100,
+    ledger_path: str | None = None,
+) -> str:
+    """
+    Download a file from a URL over multiple connections using HTTP
+    Range requests.
+
+    The file is split into byte ranges of `chunks` MB which are fetched
+    concurrently and written at their offsets into a preallocated `.part`
+    file. Completed ranges are recorded in a checkpoint sidecar so an
+    interrupted download only fetches the missing ranges on the next
+    attempt, provided the server's ETag and Last-Modified headers are
+    unchanged. If the server does not advertise support for byte ranges,
+    or the output is not on the local file system, the file is downloaded
+    as a single stream instead.
+
+    If a `ledger_path` is given, a file already downloaded to
+    `output_file_path` is only downloaded again if a conditional GET shows
+    it has changed on the server, and the SHA-256 checksum of the completed
+    file is recorded in the download ledger with the server's validators.
+
+    Parameters
+    ----------
+    url : str
+        URL to download file from.
+    output_file_path : str
+        File path to download to.
+    connections : int, optional
+        Maximum number of concurrent connections, by default 8
+    chunks : int, optional
+        Byte range and chunk size in MB, by default 100
+    ledger_path : str | None, optional
+        File path of the local download ledger, by default None
+
+    Returns
+    -------
+    str
+        The file path the file has been downloaded to.
+    """
+    session = get_http_session(connections)
+    with session:
+        if (
+            ledger_path is not None
+            and is_local_path(output_file_path)
+            and is_unchanged_since_download(url, output_file_path, ledger_path, session=session)
+        ):
+            log.info(f"{url} is unchanged since it was downloaded to {output_file_path}")
+            return output_file_path
+
+        r = session.head(url, allow_redirects=True)
+        r.raise_for_status()
+        total = int(r.headers.get("Content-Length", 0))
+        accepts_ranges = r.headers.get("Accept-Ranges", "").lower() == "bytes"
+        validators = _get_response_validators(r.headers)
+
+        if not (accepts_ranges and total > 0 and is_local_path(output_file_path)):
+            log.info(f"Byte ranges not supported for {url}, downloading as a single stream")
+            return download_file_from_url(
+                url, output_file_path, chunks=chunks, ledger_path=ledger_path
+            )
+
+        # Range requests go to the final URL after any redirects
+        url = r.url
+
+        create_parent_directory(output_file_path)
+
+        part_file_path, checkpoint_file_path = get_download_checkpoint_paths(output_file_path)
+
+        checkpoint = _read_download_checkpoint(checkpoint_file_path)
+        if (
+            checkpoint
+            and os.path.exists(part_file_path)
+            and any(validators.values())
+            and all(checkpoint.get(k) == v for k, v in validators.items())
+            and checkpoint.get("content_length") == total
+        ):
+            completed_ranges = checkpoint["completed_ranges"]
+            log.info(f"Resuming download of {url} from checkpoint {checkpoint_file_path}")
+        else:
+            completed_ranges = []
+            # Preallocate the file so each range can be written at its offset
+            with open(part_file_path, "wb") as f:
+                f.truncate(total)
+
+        checkpoint = dict(
+            url=url, content_length=total, **validators, completed_ranges=completed_ranges
+        )
+        _write_download_checkpoint(checkpoint_file_path, checkpoint)
+
+        byte_ranges = _get_missing_byte_ranges(total, completed_ranges, chunks * 1024**2)
+
+        errors = []
+        with (
+            tqdm(
                 desc=output_file_path,
                 total=total,
+                initial=total - sum(end - start + 1 for start, end in byte_ranges),
                 unit="B",
                 unit_scale=True,
                 unit_divisor=1024,
-            ) as bar:
-                for chunk in r.iter_content(chunk_size=chunks * 1024**2):
-                    size = f.write(chunk)
-                    bar.update(size)
+            ) as bar,
+            ThreadPoolExecutor(max_workers=connections) as executor,
+        ):
+            futures = {
+                executor.submit(
+                    _download_byte_range, session, url, part_file_path, byte_range, chunks, bar
+                ): byte_range
+                for byte_range in byte_ranges
+            }
+            # Checkpoint every range as it completes, even if others fail
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    continue
+                checkpoint["completed_ranges"] = _merge_byte_ranges(
+                    checkpoint["completed_ranges"] + [list(futures[future])]
+                )
+                _write_download_checkpoint(checkpoint_file_path, checkpoint)
+
+        if errors:
+            raise errors[0]
+
+    _finalise_download(part_file_path, checkpoint_file_path, output_file_path, total)
+    if ledger_path is not None:
+        # Ranges arrive out of order so the checksum is computed once complete
+        record_download(
+            ledger_path,
+            url,
+            output_file_path,
+            sha256=_get_file_sha256(output_file_path, chunks=chunks).hexdigest(),
+            content_length=total,
+            **validators,
+        )
+    return output_file_path
+
+
+def get_content_length(url: str) -> int | None:
+    """Returns the size in bytes of the file at a URL if the server reports it."""
+    response = requests.head(url, allow_redirects=True)
+    response.raise_for_status()
+    content_length = response.headers.get("Content-Length")
+    if content_length:
+        return int(content_length)
+    else:
+        return None
+
 
+def get_url_validators(urls: list[str], max_workers: int = 32) -> dict[str, dict | None]:
+    """
+    Get the validators (ETag, Last-Modified, Content-Length) of the files
+    at a list of URLs with concurrent HEAD requests.
+
+    Parameters
+    ----------
+    urls : list[str]
+        URLs of the files.
+    max_workers : int, optional
+        Maximum number of requests to send at once, by default 32
+
+    Returns
+    -------
+    dict[str, dict | None]
+        ETag, Last-Modified and size in bytes of the file at each URL, as
+        reported by the server, or None if the request failed.
+    """
+    session = get_http_session(connections=max_workers)
+
+    def _get_validators(url: str) -> dict | None:
+        try:
+            response = session.head(url, allow_redirects=True)
+            response.raise_for_status()
+        except requests.RequestException as error:
+            log.warning(f"Failed to get the headers of {url}: {error}")
+            return None
+        content_length = response.headers.get("Content-Length")
+        return dict(
+            **_get_response_validators(response.headers),
+            content_length=int(content_length) if content_length else None,
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        validators = dict(zip(urls, executor.map(_get_validators, urls)))
+    return validators
+
+
+def get_content_lengths(urls: list[str], max_workers: int = 32) -> dict[str, int | None]:
+    """Get the size in bytes of the files at a list of URLs, or None if the
+    server did not report it, with concurrent HEAD requests."""
+    return {
+        url: validators["content_length"] if validators else None
+        for url, validators in get_url_validators(urls, max_workers).items()
+    }
+
+
+def _download_file_if_missing(
+    url: str,
+    output_file_path: str,
+    chunks: int,
+    connections: int,
+    ledger_path: str | None = None,
+) -> str:
+    # With a ledger an existing file is revalidated with the server instead
+    if ledger_path is None and check_file_exists(output_file_path):
+        log.info(f"{output_file_path} already exists! Skippping download ...")
+    else:
+        log.info(f"Downloading {url} to {output_file_path}")
+        if connections > 1:
+            output_file_path = download_file_from_url_in_ranges(
+                url=url,
+                output_file_path=output_file_path,
+                connections=connections,
+                chunks=chunks,
+                ledger_path=ledger_path,
+            )
+        else:
+            output_file_path = download_file_from_url(
+                url=url, output_file_path=output_file_path, chunks=chunks, ledger_path=ledger_path
+            )
+        log.info(f"Download of {url} complete!")
     return output_file_path
 
 
+def _get_download_size(
+    url: str, output_file_path: str, ledger_path: str | None, default: int
+) -> int:
+    """Get the number of bytes `_download_file_if_missing` will download for a
+    URL: 0 if the file at `output_file_path` will be reused, otherwise the size
+    of the file reported by the server, or `default` if it is unknown."""
+    if check_file_exists(output_file_path):
+        if ledger_path is None:
+            return 0
+        try:
+            # Same conditional GET the download runs before reusing the file
+            if is_unchanged_since_download(url, output_file_path, ledger_path):
+                return 0
+        except Exception:
+            pass
+    try:
+        return get_content_length(url) or default
+    except Exception:
+        return default
+
+
+def download_file_to_cache(
+    url: str,
+    cache_dir: str,
+    cache_size: int | None = None,
+    chunks: int = 100,
+    connections: int = 1,
+) -> tuple[str, TextIO]:
+    """
+    Download a file into a local cache shared by the processes on a node,
+    or reuse the cached copy if it is unchanged on the server.
+
+    Every cache hit is revalidated with a conditional GET using the ETag
+    and Last-Modified headers recorded in the cache's download ledger, and
+    a cached copy that changed on the server, or has no ledger entry, is
+    downloaded again.
+
+    The cache entry is locked exclusively while the file is downloaded,
+    so other processes wanting the same file wait for the download and
+    reuse it. Before a new file is downloaded, the least recently used
+    entries not in use are evicted to keep the cache within `cache_size`.
+
+    Parameters
+    ----------
+    url : str
+        URL to download file from.
+    cache_dir : str
+        Local directory of the cache.
+    cache_size : int | None, optional
+        Maximum size of the cache in bytes, by default unbounded.
+    chunks : int, optional
+        Chunk size in MB, by default 100
+    connections : int, optional
+        Number of concurrent connections to download the file over using
+        HTTP Range requests, by default 1
+
+    Returns
+    -------
+    tuple[str, TextIO]
+        The file path of the cached file and the open lock file holding a
+        shared lock on it, to pass to `release_cache_entry` once the file
+        is no longer needed.
+    """
+    output_file_path = get_cached_file_path(cache_dir, url)
+    ledger_path = get_cache_ledger_path(cache_dir)
+    lock_file = lock_cache_entry(output_file_path, exclusive=True)
+    try:
+        if is_unchanged_since_download(url, output_file_path, ledger_path):
+            log.info(f"{url} is unchanged since it was cached at {output_file_path}")
+        else:
+            if cache_size is not None:
+                try:
+                    reserve = get_content_length(url) or 0
+                except Exception:
+                    reserve = 0
+                evict_cache_entries(cache_dir, cache_size, reserve=reserve)
+
+            _download_file_if_missing(url, output_file_path, chunks, connections, ledger_path)
+        # Let other processes read the file while it is in use
+        share_cache_entry_lock(lock_file)
+    except Exception:
+        release_cache_entry(lock_file)
+        raise
+    return output_file_path, lock_file
+
+
+def prefetch_files_from_urls(
+    urls: Iterable[str],
+    output_dir: str,
+    prefetch: int = 1,
+    disk_budget: int | None = None,
+    chunks: int = 100,
+    connections: int = 1,
+    ledger_path: str | None = None,
+    cache: bool = False,
+    cache_size: int | None = None,
+):
+    """
+    Download files from URLs in the background, up to `prefetch` files
+    ahead of the file currently being used.
+
+    Each file's disk space is counted against the budget from the
+    moment its download is started until the caller asks for the next
+    file, so the caller should delete a file it no longer needs before
+    moving on. Files already in `output_dir` only count against the
+    budget if they will be downloaded again because they changed on the
+    server.
+
+    If `cache` is True, `output_dir` is used as a download cache shared
+    with the other processes on the node (see `download_file_to_cache`).
+    Each file is locked in the cache until the caller asks for the next
+    file, and should not be deleted by the caller.
+
+    Parameters
+    ----------
+    urls : Iterable[str]
+        URLs to download files from, in the order they will be used. URLs are
+        only taken from the iterable when there is room to schedule their download.
+    output_dir : str
+        Local directory to download the files to.
+    prefetch : int, optional
+        Maximum number of files to download ahead of the current file, by default 1
+    disk_budget : int | None, optional
+        Maximum number of bytes the downloaded files can take up at once,
+        by default the free space in `output_dir`.
+    chunks : int, optional
+        Chunk size in MB, by default 100
+    connections : int, optional
+        Number of concurrent connections to download each file over using
+        HTTP Range requests, by default 1
+    ledger_path : str | None, optional
+        File path of the local download ledger used to revalidate files
+        already in `output_dir` instead of downloading them again, by default None.
+        The cache keeps its own ledger.
+    cache : bool, optional
+        If True, use `output_dir` as a shared download cache, by default False
+    cache_size : int | None, optional
+        Maximum size of the cache in bytes, by default unbounded.
+
+    Yields
+    ------
+    tuple[str, str, Exception | None]
+        The URL, the file path it was downloaded to and the error raised if
+        the download failed, in the order of `urls`.
+    """
+    create_directory(output_dir)
+
+    if disk_budget is None:
+        disk_budget = shutil.disk_usage(output_dir).free
+    if prefetch > 0:
+        log.info(
+            f"Prefetching up to {prefetch} files within a {disk_budget / 1024**3:.1f} GB budget"
+        )
+
+    urls = iter(urls)
+    executor = ThreadPoolExecutor(max_workers=prefetch + 1)
+    # URL, file path, download future and reserved bytes for each scheduled file
+    scheduled = deque()
+    reserved = 0
+    # URL taken from `urls` but not scheduled yet as it did not fit in the budget
+    pending_url = None
+    try:
+        while True:
+            while len(scheduled) <= prefetch:
+                if pending_url is None:
+                    pending_url = next(urls, None)
+                    if pending_url is None:
+                        break
+                url = pending_url
+                if cache:
+                    output_file_path = get_cached_file_path(output_dir, url)
+                else:
+                    output_file_path = join_url(output_dir, posixpath.basename(url))
+                size = _get_download_size(
+                    url,
+                    output_file_path,
+                    get_cache_ledger_path(output_dir) if cache else ledger_path,
+                    default=disk_budget,
+                )
+                # Always allow the current file, prefetch only within the budget
+                if scheduled and reserved + size > disk_budget:
+                    break
+                if cache:
+                    future = executor.submit(
+                        download_file_to_cache, url, output_dir, cache_size, chunks, connections
+                    )
+                else:
+                    future = executor.submit(
+                        _download_file_if_missing,
+                        url,
+                        output_file_path,
+                        chunks,
+                        connections,
+                        ledger_path,
+                    )
+                scheduled.append((url, output_file_path, future, size))
+                reserved += size
+                pending_url = None
+
+            if not scheduled:
+                break
+            url, output_file_path, future, size = scheduled.popleft()
+            try:
+                yield url, output_file_path, future.exception()
+            finally:
+                if cache and future.exception() is None:
+                    release_cache_entry(future.result()[1])
+            reserved -= size
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if cache:
+            for _, _, future, _ in scheduled:
+                if not future.cancelled() and future.exception() is None:
+                    release_cache_entry(future.result()[1])
+
+
+def upload_files_from_bytes(
+    files: list[tuple[str, bytes]],
+    part_size: int = UPLOAD_PART_SIZE,
+    max_concurrency: int = UPLOAD_MAX_CONCURRENCY,
+) -> list[Exception | None]:
+    """
+    Upload files held in memory to the same filesystem, concurrently in
+    one batch of requests on filesystems with an async implementation
+    such as S3 and GCS.
+
+    On S3, files of at least twice `part_size` are uploaded as multipart
+    uploads with up to `max_concurrency` parts in flight, and smaller
+    files with a single PUT request.
+
+    Parameters
+    ----------
+    files : list[tuple[str, bytes]]
+        File path and contents of each file to upload.
+    part_size : int, optional
+        Size in bytes of the parts of multipart uploads, by default UPLOAD_PART_SIZE
+    max_concurrency : int, optional
+        Maximum number of parts of a multipart upload to upload at once,
+        by default UPLOAD_MAX_CONCURRENCY
+
+    Returns
+    -------
+    list[Exception | None]
+        Error raised uploading each file, or None if the upload succeeded,
+        in the order of `files`.
+    """
+    if not files:
+        return []
+
+    fs = get_filesystem(files[0][0], anon=False)
+    kwargs = dict(chunksize=part_size)
+    if isinstance(fs, S3FileSystem):
+        kwargs["max_concurrency"] = max_concurrency
+
+    if isinstance(fs, AsyncFileSystem) and fs.async_impl:
+
+        async def _upload_files():
+            return await asyncio.gather(
+                *[fs._pipe_file(path, data, **kwargs) for path, data in files],
+                return_exceptions=True,
+            )
+
+        results = sync(fs.loop, _upload_files)
+        return [i if isinstance(i, Exception) else None for i in results]
+
+    errors = []
+    for path, data in files:
+        try:
+            fs.pipe_file(path, data)
+        except Exception as error:
+            errors.append(error)
+        else:
+            errors.append(None)
+    return errors
+
+
+def upload_file_from_bytes(path: str, data: bytes):
+    """
+    Upload a file held in memory, using a concurrent multipart upload
+    for large files on S3.
+
+    Parameters
+    ----------
+    path : str
+        File path to upload the file to.
+    data : bytes
+        Contents of the file.
+    """
+    (error,) = upload_files_from_bytes([(path, data)])
+    if error is not None:
+        raise error
+
+
+def upload_files_in_background(
+    files,
+    max_in_flight: int = 16,
+    batch_size: int = 8,
+    multipart_threshold: int = 2 * UPLOAD_PART_SIZE,
+):
+    """
+    Upload files held in memory in the background while the caller
+    produces the next files.
+
+    Files smaller than `multipart_threshold` are uploaded in batches of
+    up to `batch_size` concurrent requests and larger files are uploaded
+    on their own as multipart uploads. At most `max_in_flight` files are
+    held in memory waiting for or being uploaded at once, so no more
+    files are taken from `files` until uploads complete.
+
+    Parameters
+    ----------
+    files : Iterable[tuple[str, bytes]]
+        File path and contents of each file to upload, all on the same filesystem.
+    max_in_flight : int, optional
+        Maximum number of files waiting for or being uploaded at once, by default 16
+    batch_size : int, optional
+        Maximum number of small files to upload in one batch, by default 8
+    multipart_threshold : int, optional
+        Size in bytes from which files are uploaded on their own as multipart
+        uploads, by default twice UPLOAD_PART_SIZE
+
+    Yields
+    ------
+    tuple[str, Exception | None]
+        The file path and the error raised if the upload failed, in the
+        order the uploads complete.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    # Paths of the files in each batch being uploaded
+    uploads = {}
+    batch = []
+    in_flight = 0
+
+    def _submit(batch):
+        future = executor.submit(upload_files_from_bytes, batch)
+        uploads[future] = [path for path, _ in batch]
+
+    def _completed():
+        done, _ = wait(uploads, return_when=FIRST_COMPLETED)
+        for future in done:
+            paths = uploads.pop(future)
+            if future.exception() is not None:
+                errors = [future.exception()] * len(paths)
+            else:
+                errors = future.result()
+            yield from zip(paths, errors)
+
+    try:
+        for path, data in files:
+            if len(data) >= multipart_threshold:
+                _submit([(path, data)])
+            else:
+                batch.append((path, data))
+                if len(batch) >= batch_size:
+                    _submit(batch)
+                    batch = []
+            in_flight += 1
+
+            while in_flight >= max_in_flight:
+                if batch:
+                    # Nothing else can be queued until the pending batch is sent
+                    _submit(batch)
+                    batch = []
+                for result in _completed():
+                    in_flight -= 1
+                    yield result
+
+        if batch:
+            _submit(batch)
+            batch = []
+        while uploads:
+            for result in _completed():
+                in_flight -= 1
+                yield result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def delete_files(
+    paths: list[str],
+    batch_size: int = DELETE_BATCH_SIZE,
+    max_concurrency: int = 8,
+) -> dict[str, str]:
+    """
+    Delete files on the same filesystem in batches, with several batches
+    deleted at once. On S3 each batch is one multi-object delete request.
+
+    Parameters
+    ----------
+    paths : list[str]
+        File paths of the files to delete.
+    batch_size : int, optional
+        Maximum number of files to delete in one batch, by default
+        DELETE_BATCH_SIZE, the most one S3 delete request can take.
+    max_concurrency : int, optional
+        Maximum number of batches to delete at once, by default 8
+
+    Returns
+    -------
+    dict[str, str]
+        Error for each file that could not be deleted.
+    """
+    if not paths:
+        return {}
+
+    fs = get_filesystem(paths[0], anon=False)
+    batch_size = min(batch_size, DELETE_BATCH_SIZE)
+
+    if isinstance(fs, S3FileSystem):
+        # A delete request can only remove keys from one bucket
+        keys_by_bucket = {}
+        for path in paths:
+            bucket, key, _ = fs.split_path(path)
+            keys_by_bucket.setdefault(bucket, {})[key] = path
+        batches = []
+        for bucket, keys in keys_by_bucket.items():
+            keys = list(keys)
+            for i in range(0, len(keys), batch_size):
+                batches.append((bucket, keys[i : i + batch_size]))
+
+        async def _delete_batch(semaphore, bucket, keys):
+            async with semaphore:
+                response = await fs._call_s3(
+                    "delete_objects",
+                    Bucket=bucket,
+                    Delete=dict(Objects=[dict(Key=key) for key in keys], Quiet=True),
+                )
+            return response.get("Errors", [])
+
+        async def _delete_batches():
+            semaphore = asyncio.Semaphore(max_concurrency)
+            return await asyncio.gather(
+                *[_delete_batch(semaphore, bucket, keys) for bucket, keys in batches],
+                return_exceptions=True,
+            )
+
+        results = sync(fs.loop, _delete_batches)
+        fs.invalidate_cache()
+
+        errors = {}
+        for (bucket, keys), result in zip(batches, results):
+            if isinstance(result, Exception):
+                errors.update({keys_by_bucket[bucket][key]: repr(result) for key in keys})
+            else:
+                for error in result:
+                    path = keys_by_bucket[bucket][error["Key"]]
+                    errors[path] = f"{error.get('Code')}: {error.get('Message')}"
+        return errors
+
+    def _delete_batch(batch):
+        try:
+            fs.rm(batch)
+        except Exception as error:
+            return {path: repr(error) for path in batch if fs.exists(path)}
+        return {}
+
+    errors = {}
+    batches = [paths[i : i + batch_size] for i in range(0, len(paths), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for batch_errors in executor.map(_delete_batch, batches):
+            errors.update(batch_errors)
+    return errors
+
+
 def get_gdal_vsi_prefix(file_path) -> str:
     # Based on file extension
     _, file_extension = os.path.splitext(file_path)
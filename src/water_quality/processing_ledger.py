@@ -0,0 +1,285 @@
+"""
+Keep a ledger of the files processed by a workflow, with the validators
+(ETag, Last-Modified, Content-Length) reported by the server for each
+file and the number of outputs written from it, so later runs only
+process the files that are new or have changed on the server.
+
+The ledger is kept next to the outputs, which may be on an object store,
+as one SQLite database per worker so the workers never write to the same
+file. Each worker updates a local copy of its database and uploads it
+after every file it records.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+
+from water_quality.io import (
+    check_file_exists,
+    create_directory,
+    create_file_exclusively,
+    get_filesystem,
+    get_url_validators,
+    is_local_path,
+    join_url,
+)
+
+log = logging.getLogger(__name__)
+
+LEDGER_COLUMNS = [
+    "url",
+    "etag",
+    "last_modified",
+    "content_length",
+    "output_count",
+    "skipped_count",
+    "processed_at",
+]
+
+
+def get_processing_ledger_dir(output_dir: str) -> str:
+    """Get the directory of the processing ledger for a product."""
+    return join_url(output_dir, "processing_ledger")
+
+
+def _connect(ledger_path: str) -> sqlite3.Connection:
+    parent_dir = os.path.dirname(os.path.abspath(ledger_path))
+    os.makedirs(parent_dir, exist_ok=True)
+
+    connection = sqlite3.connect(ledger_path, timeout=60)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS processed (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            content_length INTEGER,
+            output_count INTEGER,
+            skipped_count INTEGER,
+            processed_at TEXT
+        )
+        """
+    )
+    return connection
+
+
+def get_processing_ledger_shard(ledger_dir: str, worker_idx: int, local_dir: str) -> str:
+    """
+    Get the local file path of a worker's database in the processing
+    ledger, downloading the existing database if the ledger is remote.
+
+    Parameters
+    ----------
+    ledger_dir : str
+        Directory of the processing ledger.
+    worker_idx : int
+        Index of the worker.
+    local_dir : str
+        Local directory to keep a copy of the database in if the ledger is remote.
+
+    Returns
+    -------
+    str
+        Local file path of the worker's database, to pass to `record_processed_file`.
+    """
+    shard_name = f"worker_{worker_idx}.db"
+    if is_local_path(ledger_dir):
+        return join_url(ledger_dir, shard_name)
+
+    shard_url = join_url(ledger_dir, shard_name)
+    ledger_path = os.path.join(local_dir, shard_name)
+    create_directory(local_dir)
+    if check_file_exists(shard_url):
+        fs = get_filesystem(shard_url, anon=True)
+        fs.get(shard_url, ledger_path)
+    elif os.path.exists(ledger_path):
+        # Left over from a run against another ledger
+        os.remove(ledger_path)
+    return ledger_path
+
+
+def record_processed_file(
+    ledger_dir: str,
+    ledger_path: str,
+    url: str,
+    validators: dict | None,
+    output_count: int,
+    skipped_count: int,
+):
+    """
+    Record a processed file in a worker's database in the processing
+    ledger, replacing any previous entry for the URL, and upload the
+    database if the ledger is remote.
+
+    Parameters
+    ----------
+    ledger_dir : str
+        Directory of the processing ledger.
+    ledger_path : str
+        Local file path of the worker's database from `get_processing_ledger_shard`.
+    url : str
+        URL of the processed file.
+    validators : dict | None
+        ETag, Last-Modified and Content-Length of the file from
+        `get_url_validators`, or None if they are not known.
+    output_count : int
+        Number of outputs written or already existing for the file.
+    skipped_count : int
+        Number of outputs intentionally not written for the file.
+    """
+    validators = validators or {}
+    connection = _connect(ledger_path)
+    try:
+        with connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO processed ({', '.join(LEDGER_COLUMNS)}) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    validators.get("etag"),
+                    validators.get("last_modified"),
+                    validators.get("content_length"),
+                    output_count,
+                    skipped_count,
+                    datetime.now(timezone.utc).isoformat(),
+                ),
+            )
+    finally:
+        connection.close()
+
+    if not is_local_path(ledger_dir):
+        fs = get_filesystem(ledger_dir, anon=False)
+        fs.put(ledger_path, join_url(ledger_dir, os.path.basename(ledger_path)))
+
+
+def read_processing_ledger(ledger_dir: str) -> dict[str, dict]:
+    """
+    Read the entries of every worker's database in the processing ledger.
+
+    Parameters
+    ----------
+    ledger_dir : str
+        Directory of the processing ledger.
+
+    Returns
+    -------
+    dict[str, dict]
+        Latest ledger entry for each processed URL.
+    """
+    fs = get_filesystem(ledger_dir, anon=True)
+    fs.invalidate_cache(ledger_dir)
+    try:
+        shard_urls = [i for i in fs.ls(ledger_dir, detail=False) if i.endswith(".db")]
+    except FileNotFoundError:
+        return {}
+
+    entries = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for shard_url in shard_urls:
+            if is_local_path(ledger_dir):
+                ledger_path = shard_url
+            else:
+                ledger_path = os.path.join(tmp_dir, os.path.basename(shard_url))
+                fs.get(shard_url, ledger_path)
+
+            connection = _connect(ledger_path)
+            try:
+                rows = connection.execute(
+                    f"SELECT {', '.join(LEDGER_COLUMNS)} FROM processed"
+                ).fetchall()
+            finally:
+                connection.close()
+
+            for row in rows:
+                entry = dict(zip(LEDGER_COLUMNS, row))
+                existing_entry = entries.get(entry["url"])
+                if existing_entry is None or existing_entry["processed_at"] < entry["processed_at"]:
+                    entries[entry["url"]] = entry
+    return entries
+
+
+def is_changed_since_processed(entry: dict | None, validators: dict | None) -> bool:
+    """
+    Check if a file has to be processed, because it is not in the ledger
+    or the server reports a different ETag, Last-Modified or size than
+    when it was processed. Files the server reports no validators for are
+    always processed.
+    """
+    if entry is None or validators is None:
+        return True
+
+    compared = False
+    for key in ["etag", "last_modified", "content_length"]:
+        if entry[key] is not None and validators.get(key) is not None:
+            if entry[key] != validators[key]:
+                return True
+            compared = True
+    return not compared
+
+
+def _read_manifest_delta(delta_url: str) -> dict:
+    fs = get_filesystem(delta_url, anon=False)
+    fs.invalidate_cache(delta_url)
+    with fs.open(delta_url, "r") as f:
+        return json.load(f)
+
+
+def get_unprocessed_urls(
+    ledger_dir: str, urls: list[str], run_id: str | None = None
+) -> tuple[list[str], list[str], dict]:
+    """
+    Get the URLs from a manifest that are new or have changed since they
+    were last processed, according to the processing ledger. The outputs
+    of the changed files already exist but are stale, so they have to be
+    overwritten.
+
+    Workers that split the URLs between them must all get the same list,
+    even after some of them have started recording the files they
+    processed. If `run_id` is given, the first worker of the run saves
+    the list in the ledger directory and the other workers load it. A
+    worker which loses the race to save the list loads the saved one.
+
+    Parameters
+    ----------
+    ledger_dir : str
+        Directory of the processing ledger.
+    urls : list[str]
+        URLs of the files in the manifest.
+    run_id : str | None, optional
+        Identifier of the workflow run shared by all its workers, by default None
+
+    Returns
+    -------
+    tuple[list[str], list[str], dict]
+        URLs to process, in the order of `urls`, the URLs among them which
+        were processed before and have changed since, and the validators
+        of every URL from `get_url_validators`.
+    """
+    validators = get_url_validators(urls)
+
+    if run_id is not None:
+        # Not .json, as the stac files under the output directory are indexed with **/*.json
+        delta_url = join_url(ledger_dir, "manifest_deltas", f"{run_id}.txt")
+        if check_file_exists(delta_url):
+            delta = _read_manifest_delta(delta_url)
+            log.info(f"Loaded the manifest delta for the run {run_id} from {delta_url}")
+            return delta["unprocessed_urls"], delta["changed_urls"], validators
+
+    entries = read_processing_ledger(ledger_dir)
+    unprocessed_urls = [
+        url for url in urls if is_changed_since_processed(entries.get(url), validators[url])
+    ]
+    changed_urls = [url for url in unprocessed_urls if url in entries]
+
+    if run_id is not None:
+        delta = dict(unprocessed_urls=unprocessed_urls, changed_urls=changed_urls)
+        if create_file_exclusively(delta_url, json.dumps(delta).encode()):
+            log.info(f"Manifest delta for the run {run_id} written to {delta_url}")
+        else:
+            delta = _read_manifest_delta(delta_url)
+            log.info(f"Loaded the manifest delta for the run {run_id} saved by another worker")
+            return delta["unprocessed_urls"], delta["changed_urls"], validators
+    return unprocessed_urls, changed_urls, validators
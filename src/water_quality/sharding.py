@@ -0,0 +1,45 @@
+"""
+Split a list of tasks between the workers of a workflow so each worker
+gets about the same amount of work.
+"""
+
+import heapq
+
+
+def split_tasks_by_size(tasks: list[str], sizes: dict[str, int], num_workers: int) -> list[list]:
+    """
+    Split tasks between workers so each worker gets about the same total
+    size, using greedy longest processing time first bin packing: tasks
+    are assigned from the largest to the smallest, each to the worker with
+    the smallest total so far.
+
+    The split only depends on the tasks and their sizes, so workers which
+    split the tasks independently get the same split only if they are
+    given the same sizes, for example sizes saved once for the whole run.
+
+    Parameters
+    ----------
+    tasks : list[str]
+        Tasks to split.
+    sizes : dict[str, int]
+        Size of each task, for example the size in bytes of the file to process.
+    num_workers : int
+        Number of workers to split the tasks between.
+
+    Returns
+    -------
+    list[list]
+        Tasks for each worker, in the same order as in `tasks`.
+    """
+    # Largest first, ties broken by the task so the split is deterministic
+    order = sorted(range(len(tasks)), key=lambda i: (-sizes[tasks[i]], tasks[i]))
+
+    # Total size and index of each worker
+    workers = [(0, worker_idx) for worker_idx in range(num_workers)]
+    assigned = [[] for _ in range(num_workers)]
+    for task_idx in order:
+        total_size, worker_idx = heapq.heappop(workers)
+        assigned[worker_idx].append(task_idx)
+        heapq.heappush(workers, (total_size + sizes[tasks[task_idx]], worker_idx))
+
+    return [[tasks[i] for i in sorted(task_indices)] for task_indices in assigned]
@@ -0,0 +1,394 @@
+"""
+Share a list of tasks between the workers of a workflow through a queue
+directory on a shared filesystem or object store.
+
+Workers claim tasks by writing a lease file with an expiry time for each
+task and keep renewing the leases of the tasks they are working on. A
+task processed successfully gets a done marker. The lease on a task that
+failed is released, so the other workers retry it, but the worker it
+failed on does not. Tasks whose lease has expired, for example because
+the worker processing them crashed, are claimed again by the next worker
+that finds them, so every task is completed as long as one worker that
+can process it keeps running.
+
+Leases are claimed atomically on local and shared filesystems, using
+exclusive file creation, and on S3, using conditional writes. On other
+object stores a lease is verified by reading it back after writing it,
+which can let two workers claim the same task in rare cases, so tasks
+should be safe to repeat.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from s3fs.core import S3FileSystem
+
+from water_quality.io import create_directory, get_filesystem, is_local_path, join_url
+
+log = logging.getLogger(__name__)
+
+# Identifies the leases written by this process
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+# Leases held by this process keyed by lease file path, with the lease
+# duration in seconds and the version of the lease file on S3
+_held_leases = {}
+_held_leases_lock = threading.Lock()
+_renewal_thread = None
+
+
+def get_task_id(task: str) -> str:
+    """Get the identifier used to name the lease and done marker files of a task."""
+    return hashlib.sha256(task.encode()).hexdigest()
+
+
+def get_lease_url(queue_dir: str, task: str) -> str:
+    """Get the file path of the lease file of a task."""
+    # Not .json, so a queue kept under an output directory indexed with **/*.json is not indexed
+    return join_url(queue_dir, "leases", f"{get_task_id(task)}.txt")
+
+
+def get_done_marker_url(queue_dir: str, task: str) -> str:
+    """Get the file path of the marker written once a task is completed."""
+    return join_url(queue_dir, "done", f"{get_task_id(task)}.txt")
+
+
+def _list_task_ids(directory: str) -> set[str]:
+    fs = get_filesystem(directory, anon=False)
+    # Listings are cached by the object store filesystems
+    fs.invalidate_cache(directory)
+    try:
+        file_paths = fs.ls(directory, detail=False)
+    except FileNotFoundError:
+        return set()
+    return {os.path.basename(i.rstrip("/")).removesuffix(".txt") for i in file_paths}
+
+
+def _read_lease(lease_url: str) -> tuple[dict | None, str | None]:
+    """Read a lease file, returning the lease and its ETag on S3, or None if it does not exist."""
+    fs = get_filesystem(lease_url, anon=False)
+    fs.invalidate_cache(lease_url)
+    try:
+        etag = fs.info(lease_url).get("ETag") if isinstance(fs, S3FileSystem) else None
+        lease = json.loads(fs.cat_file(lease_url))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None, None
+    return lease, etag
+
+
+def _write_lease(lease_url: str, lease: dict, etag: str | None = None) -> tuple[bool, str | None]:
+    """
+    Write a lease file if it does not exist yet, or if `etag` is given,
+    replace it on S3 only if it has not changed since it was read.
+    Returns whether the lease was written and its new ETag on S3.
+    """
+    fs = get_filesystem(lease_url, anon=False)
+    data = json.dumps(lease).encode()
+
+    if is_local_path(lease_url):
+        try:
+            fd = os.open(lease_url, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False, None
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return True, None
+
+    if isinstance(fs, S3FileSystem):
+        try:
+            if etag is None:
+                fs.pipe_file(lease_url, data, mode="create")
+            else:
+                fs.pipe_file(lease_url, data, IfMatch=etag)
+        except OSError:
+            # Precondition failed, another worker wrote the lease first
+            return False, None
+        _, etag = _read_lease(lease_url)
+        return True, etag
+
+    if etag is None and fs.exists(lease_url):
+        return False, None
+    fs.pipe_file(lease_url, data)
+    written_lease, _ = _read_lease(lease_url)
+    return written_lease == lease, None
+
+
+def _take_over_lease(
+    lease_url: str, lease: dict, expired_lease: dict, etag: str | None
+) -> tuple[bool, str | None]:
+    """Replace an expired lease, unless another worker replaced it first."""
+    if not is_local_path(lease_url):
+        fs = get_filesystem(lease_url, anon=False)
+        if not isinstance(fs, S3FileSystem):
+            fs.rm(lease_url)
+        return _write_lease(lease_url, lease, etag)
+
+    # Only one worker can move the expired lease out of the way
+    expired_lease_url = f"{lease_url}.{WORKER_ID}.expired"
+    try:
+        os.rename(lease_url, expired_lease_url)
+    except FileNotFoundError:
+        return False, None
+    try:
+        with open(expired_lease_url) as f:
+            moved_lease = json.load(f)
+        if moved_lease != expired_lease:
+            # Another worker renewed or replaced the lease in the meantime, put it back
+            try:
+                os.link(expired_lease_url, lease_url)
+            except FileExistsError:
+                pass
+            return False, None
+    finally:
+        os.remove(expired_lease_url)
+    return _write_lease(lease_url, lease)
+
+
+def _renew_leases():
+    """Renew the leases held by this process before they expire."""
+    while True:
+        time.sleep(1)
+        with _held_leases_lock:
+            held_leases = list(_held_leases.items())
+        for lease_url, (lease, lease_duration, etag) in held_leases:
+            if lease["expires"] - time.time() > lease_duration * 2 / 3:
+                continue
+            try:
+                current_lease, current_etag = _read_lease(lease_url)
+                if current_lease != lease:
+                    log.warning(f"Lost the lease {lease_url} on the task {lease['task']}")
+                    with _held_leases_lock:
+                        _held_leases.pop(lease_url, None)
+                    continue
+
+                renewed_lease = dict(lease, expires=time.time() + lease_duration)
+                if is_local_path(lease_url):
+                    tmp_lease_url = f"{lease_url}.{WORKER_ID}.tmp"
+                    with open(tmp_lease_url, "w") as f:
+                        json.dump(renewed_lease, f)
+                    os.replace(tmp_lease_url, lease_url)
+                    written = True
+                else:
+                    written, etag = _write_lease(lease_url, renewed_lease, current_etag)
+            except Exception as error:
+                log.warning(f"Failed to renew the lease {lease_url}: {error!r}")
+                continue
+
+            with _held_leases_lock:
+                if lease_url in _held_leases:
+                    if written:
+                        _held_leases[lease_url] = (renewed_lease, lease_duration, etag)
+                    else:
+                        log.warning(f"Lost the lease {lease_url} on the task {lease['task']}")
+                        _held_leases.pop(lease_url)
+
+
+def claim_tasks(
+    queue_dir: str,
+    tasks: list[str],
+    lease_duration: float,
+    start: int = 0,
+    poll_interval: float = 60,
+    skip_tasks: set[str] | None = None,
+):
+    """
+    Claim tasks from a work queue one at a time, skipping the tasks that
+    are completed or leased by a live worker.
+
+    While no task can be claimed but other workers still hold leases,
+    wait for their tasks to be completed or their leases to expire, as
+    long as every task claimed by this process has been completed.
+    Otherwise return, so the caller can complete the tasks it holds and
+    claim again, see `iterate_work_queue`.
+
+    Parameters
+    ----------
+    queue_dir : str
+        Directory of the work queue shared by the workers.
+    tasks : list[str]
+        Every task of the workflow, in the same order for all the workers.
+    lease_duration : float
+        Number of seconds a lease is valid for. Leases of claimed tasks
+        are renewed in the background until the task is completed.
+    start : int, optional
+        Index of the task to start claiming from, by default 0. Spread the
+        workers over the tasks to reduce contention.
+    poll_interval : float, optional
+        Number of seconds to wait between checks for expired leases, by default 60
+    skip_tasks : set[str] | None, optional
+        Tasks not to claim, for example because they failed in this process,
+        by default None
+
+    Yields
+    ------
+    str
+        Task claimed by this process, to pass to `complete_task` once done.
+    """
+    global _renewal_thread
+    if _renewal_thread is None:
+        _renewal_thread = threading.Thread(target=_renew_leases, daemon=True)
+        _renewal_thread.start()
+
+    create_directory(join_url(queue_dir, "leases"))
+    create_directory(join_url(queue_dir, "done"))
+
+    tasks = tasks[start:] + tasks[:start]
+    while True:
+        done_task_ids = _list_task_ids(join_url(queue_dir, "done"))
+        leased_task_ids = _list_task_ids(join_url(queue_dir, "leases"))
+
+        claimed = False
+        waiting = False
+        for task in tasks:
+            task_id = get_task_id(task)
+            lease_url = get_lease_url(queue_dir, task)
+            if task_id in done_task_ids or lease_url in _held_leases:
+                continue
+            if skip_tasks and task in skip_tasks:
+                continue
+
+            lease = dict(task=task, worker=WORKER_ID, expires=time.time() + lease_duration)
+            if task_id in leased_task_ids:
+                existing_lease, etag = _read_lease(lease_url)
+                if existing_lease is None:
+                    written, etag = _write_lease(lease_url, lease)
+                elif existing_lease["expires"] < time.time():
+                    log.info(
+                        f"Lease on the task {task} held by {existing_lease['worker']} has expired"
+                    )
+                    written, etag = _take_over_lease(lease_url, lease, existing_lease, etag)
+                else:
+                    written = False
+            else:
+                written, etag = _write_lease(lease_url, lease)
+
+            if not written:
+                waiting = True
+                continue
+
+            with _held_leases_lock:
+                _held_leases[lease_url] = (lease, lease_duration, etag)
+
+            # Completed by another worker since the done markers were listed
+            fs = get_filesystem(queue_dir, anon=False)
+            fs.invalidate_cache(get_done_marker_url(queue_dir, task))
+            if fs.exists(get_done_marker_url(queue_dir, task)):
+                release_task(queue_dir, task)
+                continue
+
+            claimed = True
+            yield task
+
+        if claimed:
+            # Look again for leases which expired during the pass
+            continue
+        if not waiting or _held_leases:
+            return
+        log.info(f"Waiting for the tasks leased by other workers, checking every {poll_interval}s")
+        time.sleep(poll_interval)
+
+
+def release_task(queue_dir: str, task: str):
+    """Stop renewing the lease on a task and remove it so other workers can claim the task."""
+    lease_url = get_lease_url(queue_dir, task)
+    with _held_leases_lock:
+        held_lease = _held_leases.pop(lease_url, None)
+    if held_lease is None:
+        return
+
+    lease, _, _ = held_lease
+    current_lease, _ = _read_lease(lease_url)
+    if current_lease == lease:
+        fs = get_filesystem(lease_url, anon=False)
+        try:
+            fs.rm(lease_url)
+        except FileNotFoundError:
+            pass
+
+
+def complete_task(queue_dir: str, task: str):
+    """
+    Mark a task claimed with `claim_tasks` as completed and release its lease.
+
+    Parameters
+    ----------
+    queue_dir : str
+        Directory of the work queue shared by the workers.
+    task : str
+        Completed task.
+    """
+    done_marker_url = get_done_marker_url(queue_dir, task)
+    fs = get_filesystem(done_marker_url, anon=False)
+    fs.pipe_file(
+        done_marker_url,
+        json.dumps(dict(task=task, worker=WORKER_ID, completed=time.time())).encode(),
+    )
+    release_task(queue_dir, task)
+
+
+def is_work_queue_finished(queue_dir: str, tasks: list[str]) -> bool:
+    """Check if every task in a work queue has been completed."""
+    done_task_ids = _list_task_ids(join_url(queue_dir, "done"))
+    return all(get_task_id(task) in done_task_ids for task in tasks)
+
+
+def _is_task_held(queue_dir: str, task: str) -> bool:
+    with _held_leases_lock:
+        return get_lease_url(queue_dir, task) in _held_leases
+
+
+def iterate_work_queue(
+    queue_dir: str,
+    tasks: list[str],
+    lease_duration: float,
+    start: int = 0,
+    pipeline=None,
+):
+    """
+    Claim and yield tasks from a work queue until every task has been
+    completed by one of the workers, or has failed in this process.
+
+    The caller marks each task processed successfully as completed with
+    `complete_task`. A task not completed by the time the caller asks for
+    the next one has failed: its lease is released so the other workers
+    can retry it, and it is not claimed again by this process.
+
+    Parameters
+    ----------
+    queue_dir : str
+        Directory of the work queue shared by the workers.
+    tasks : list[str]
+        Every task of the workflow, in the same order for all the workers.
+    lease_duration : float
+        Number of seconds a lease is valid for, see `claim_tasks`.
+    start : int, optional
+        Index of the task to start claiming from, by default 0
+    pipeline : callable, optional
+        Function to apply to the iterator of claimed tasks, for example to
+        download the files for the next tasks ahead of time. It must yield
+        a tuple starting with the task for each claimed task, in order.
+
+    Yields
+    ------
+    str | tuple
+        Claimed task, or the items yielded by `pipeline`.
+    """
+    failed_tasks = set()
+    while not is_work_queue_finished(queue_dir, [i for i in tasks if i not in failed_tasks]):
+        claimed_tasks = claim_tasks(
+            queue_dir, tasks, lease_duration, start=start, skip_tasks=failed_tasks
+        )
+        items = claimed_tasks if pipeline is None else pipeline(claimed_tasks)
+        for item in items:
+            yield item
+            task = item if pipeline is None else item[0]
+            if _is_task_held(queue_dir, task):
+                log.warning(f"Task {task} was not completed, releasing it for the other workers")
+                failed_tasks.add(task)
+                release_task(queue_dir, task)
@@ -0,0 +1,67 @@
+"""
+Check that the COGs written from real Copernicus Global Land Service -
+Lake Water Quality NetCDF files are identical to the COGs written from
+the tiles cropped from the GDAL subdatasets with rioxarray, so upgrading
+GDAL, rioxarray or odc-geo cannot silently change the pixels or tags of
+the COGs.
+
+The netcdf files are too large to keep in the repository. Set
+CGLS_LWQ_TEST_NETCDFS to a comma separated list of downloaded netcdf
+files, for example one file of each product, to run the tests. They are
+skipped otherwise.
+"""
+
+import os
+import posixpath
+
+import numpy as np
+import pytest
+import rasterio
+from odc.geo.xr import assign_crs, mask
+
+from water_quality.cgls_lwq.cogs import write_tile_cog
+from water_quality.cgls_lwq.netcdf import get_netcdf_subdatasets_uris, read_netcdf_url
+from water_quality.cgls_lwq.tile_windows import create_tile_window_plan, read_tile_windows
+from water_quality.cgls_lwq.tiles import get_africa_tiles
+
+NETCDF_PATHS = [i for i in os.environ.get("CGLS_LWQ_TEST_NETCDFS", "").split(",") if i]
+
+# Number of tiles to check for each measurement, spread over Africa
+NUM_TILES = 8
+
+
+@pytest.mark.skipif(not NETCDF_PATHS, reason="CGLS_LWQ_TEST_NETCDFS is not set")
+@pytest.mark.parametrize("netcdf_path", NETCDF_PATHS, ids=posixpath.basename)
+def test_tile_cogs_match_rioxarray_crop(netcdf_path, tmp_path):
+    grid_res = 100 if "LWQ100" in posixpath.basename(netcdf_path) else 300
+    tiles = get_africa_tiles(grid_res)
+    tiles = tiles[:: max(len(tiles) // NUM_TILES, 1)]
+
+    for var, subdataset_uri in get_netcdf_subdatasets_uris(netcdf_path).items():
+        da = read_netcdf_url(subdataset_uri).squeeze()
+        da = assign_crs(da, da.rio.crs)
+        tile_windows = create_tile_window_plan(tiles, da.odc.geobox, grid_res)["tiles"]
+        tile_tasks = [
+            (tile_idx, roi, tile_extent, str(tmp_path / f"{var}_{i}.tif"))
+            for i, (tile_idx, roi, tile_extent) in enumerate(tile_windows)
+        ]
+
+        with rasterio.open(subdataset_uri) as src:
+            for (_, roi, tile_extent, cog_path), cropped_da in read_tile_windows(
+                src, da, tile_tasks
+            ):
+                write_tile_cog(cropped_da, cog_path, da.attrs)
+
+                y_dim, x_dim = da.odc.spatial_dims
+                expected_da = mask(
+                    da.isel({y_dim: roi[0], x_dim: roi[1]}).load(), tile_extent, all_touched=True
+                )
+                expected_cog_path = cog_path.replace(".tif", "_expected.tif")
+                write_tile_cog(expected_da, expected_cog_path, da.attrs)
+
+                with rasterio.open(cog_path) as cog, rasterio.open(expected_cog_path) as expected:
+                    assert cog.profile == expected.profile, f"Profile of {var} differs"
+                    assert cog.tags() == expected.tags(), f"Tags of {var} differ"
+                    np.testing.assert_array_equal(cog.read(), expected.read())
+                with open(cog_path, "rb") as f, open(expected_cog_path, "rb") as g:
+                    assert f.read() == g.read(), f"COG of {var} differs"